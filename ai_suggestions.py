@@ -0,0 +1,295 @@
+"""AI subject-line suggestions with an on-disk cache.
+
+Talks to any OpenAI-compatible chat completions endpoint: OpenRouter by
+default, or a local inference server (Ollama, llama.cpp, vLLM) or a mock via
+ai_base_url. The OpenRouter key only ever goes to OpenRouter; other servers
+get ai_api_key (or a placeholder). The client comes from the server-wide pool
+(resource_pools.py).
+
+Completions are cached in SQLite keyed by (model, prompt hash, temperature):
+asking again for the same body is instant and costs nothing. The cache is an
+LRU capped at CACHE_MAX_ENTRIES. stream() yields the text as it arrives and
+caches it once complete.
+
+generate_variants() writes a subject and intro per value of a segment column
+(e.g. per Industry): one request per distinct prompt, not per recipient, sent
+concurrently under request and token rate limits and retried on rate-limit
+errors. apply_variants() adds them to the recipients as AI_Subject and
+AI_Intro, so templates use them like any other column.
+"""
+import hashlib
+import json
+import random
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from resource_pools import openai_client
+from send_pipeline import RateLimiter
+
+DEFAULT_AI_CACHE_DB = "ai_cache.db"
+DEFAULT_BASE_URL = "https://openrouter.ai/api/v1"
+DEFAULT_MODEL = "mistralai/mistral-7b-instruct"
+DEFAULT_TEMPERATURE = 0.7
+MAX_TOKENS = 150
+CACHE_MAX_ENTRIES = 2000
+LOCAL_API_KEY = "local" # The openai client wants a key; local servers ignore it
+VARIANT_MAX_TOKENS = 200
+DEFAULT_VARIANT_CONCURRENCY = 4
+RATE_LIMIT_RETRIES = 5
+VARIANT_FIELDS = ("AI_Subject", "AI_Intro")
+
+SYSTEM_PROMPT = "You are an expert email marketer. Generate concise, engaging subject lines."
+
+_LIST_MARKER_RE = re.compile(r"^\s*(?:\d+\s*[.):-]|[-*•])\s*")
+_PREAMBLE_RE = re.compile(r"(?i)^(?:here are|sure|suggested subject lines?)\b.*:\s*$")
+
+
+def subject_prompt(body, count=3):
+    return f"""Given the following email body, please generate {count} distinct and engaging subject line options.
+Each subject line should be concise and relevant to the email's content.
+Return the subject lines as a numbered list (e.g., 1. Subject A, 2. Subject B, ...).
+
+Email Body:
+---
+{body}
+---
+Suggested subject lines:"""
+
+
+def variant_prompt(body, column, value):
+    return f"""Write an email subject line and a one or two sentence opening paragraph for recipients whose {column} is "{value}".
+Tailor both to that audience and keep them relevant to the email body below.
+Answer in exactly this format:
+Subject: <subject line>
+Intro: <opening paragraph>
+
+Email Body:
+---
+{body}
+---"""
+
+
+def parse_variant(text):
+    """(subject, intro) from a 'Subject: ... / Intro: ...' answer; unlabeled lines fill the gaps in order."""
+    subject = intro = None
+    unlabeled = []
+    for line in (text or "").splitlines():
+        line = line.strip()
+        match = re.match(r"(?i)^\**\s*(subject(?: line)?|intro(?:duction)?|opening)\s*\**\s*:\s*\**\s*(.*)$", line)
+        if match:
+            value = match.group(2).strip().strip("*").strip().strip("\"'")
+            if match.group(1).lower().startswith("subject"):
+                subject = subject or value
+            else:
+                intro = intro or value
+        elif line:
+            unlabeled.append(line)
+    if subject is None and unlabeled:
+        subject = unlabeled.pop(0)
+    if intro is None and unlabeled:
+        intro = " ".join(unlabeled)
+    return subject or "", intro or ""
+
+
+def parse_suggestions(text):
+    """Subject lines from a numbered or bulleted list (or one per line); markers, quotes and preambles removed."""
+    suggestions = []
+    for line in (text or "").splitlines():
+        line = line.strip()
+        if not line or _PREAMBLE_RE.match(line):
+            continue
+        line = _LIST_MARKER_RE.sub("", line).strip()
+        line = re.sub(r"^\*\*(.*)\*\*$", r"\1", line).strip() # Markdown bold
+        if len(line) >= 2 and line[0] == line[-1] and line[0] in "\"'":
+            line = line[1:-1].strip()
+        if line and line not in suggestions:
+            suggestions.append(line)
+    return suggestions
+
+
+def cache_key(model, messages, temperature):
+    prompt_hash = hashlib.sha256(json.dumps(messages, sort_keys=True).encode()).hexdigest()
+    return f"{model}\0{prompt_hash}\0{temperature:g}"
+
+
+class CompletionCache:
+    """LRU of completion texts in SQLite, shared by every session and process on the machine."""
+
+    def __init__(self, path=DEFAULT_AI_CACHE_DB, max_entries=CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS completions (
+                key         TEXT PRIMARY KEY,
+                model       TEXT,
+                text        TEXT NOT NULL,
+                created     REAL,
+                last_used   REAL
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)")
+        self.conn.commit()
+
+    def get(self, key):
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT text FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.conn.execute("UPDATE completions SET last_used = ? WHERE key = ?", (time.time(), key))
+        return row[0] if row else None
+
+    def put(self, key, model, text):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)", (key, model, text, now, now))
+            self.conn.execute("""
+                DELETE FROM completions WHERE key IN (
+                    SELECT key FROM completions ORDER BY last_used DESC LIMIT -1 OFFSET ?)""", (self.max_entries,))
+
+    def close(self):
+        self.conn.close()
+
+
+class SubjectSuggester:
+    def __init__(self, api_key=None, base_url=None, model=None, temperature=DEFAULT_TEMPERATURE, cache=None):
+        self.api_key = api_key or LOCAL_API_KEY
+        self.base_url = base_url or DEFAULT_BASE_URL
+        self.model = model or DEFAULT_MODEL
+        self.temperature = temperature
+        self.cache = cache
+
+    @classmethod
+    def from_config(cls, config, cache=None):
+        base_url = (config.get('ai_base_url') or "").strip() or None
+        if base_url is None or base_url.rstrip("/") == DEFAULT_BASE_URL:
+            api_key = config.get('openrouter_api_key')
+        else: # Never send the OpenRouter key to another server
+            api_key = config.get('ai_api_key')
+        return cls(api_key, base_url, config.get('ai_model'), float(config.get('ai_temperature', DEFAULT_TEMPERATURE)), cache)
+
+    def _messages(self, body):
+        return [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": subject_prompt(body)}]
+
+    def cached(self, body):
+        """The cached completion text for this body, or None."""
+        return self.cached_messages(self._messages(body))
+
+    def cached_messages(self, messages):
+        if self.cache is None:
+            return None
+        return self.cache.get(cache_key(self.model, messages, self.temperature))
+
+    def stream(self, body):
+        """Yields the completion text in pieces as the model produces them (one piece if cached)."""
+        messages = self._messages(body)
+        key = cache_key(self.model, messages, self.temperature)
+        text = self.cache.get(key) if self.cache is not None else None
+        if text is not None:
+            yield text
+            return
+        client = openai_client(self.api_key, self.base_url)
+        response = client.chat.completions.create(model=self.model, messages=messages, temperature=self.temperature,
+                                                  max_tokens=MAX_TOKENS, stream=True)
+        pieces = []
+        for chunk in response:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                pieces.append(delta)
+                yield delta
+        if pieces and self.cache is not None: # Only complete answers are cached
+            self.cache.put(key, self.model, "".join(pieces))
+
+    def suggest(self, body):
+        """Parsed subject lines (blocking)."""
+        return parse_suggestions("".join(self.stream(body)))
+
+    def complete(self, messages, max_tokens=MAX_TOKENS, on_rate_limit=None):
+        """The completion text for messages (cached); retries with backoff when rate limited."""
+        import openai
+        key = cache_key(self.model, messages, self.temperature)
+        text = self.cache.get(key) if self.cache is not None else None
+        if text is not None:
+            return text
+        client = openai_client(self.api_key, self.base_url)
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            try:
+                response = client.chat.completions.create(model=self.model, messages=messages,
+                                                          temperature=self.temperature, max_tokens=max_tokens)
+                break
+            except openai.RateLimitError as e_limit:
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise
+                retry_after = e_limit.response.headers.get("retry-after") if e_limit.response is not None else None
+                try:
+                    wait = float(retry_after)
+                except (TypeError, ValueError):
+                    wait = min(30.0, 2 ** attempt) * (0.5 + random.random()) # Jittered, so workers don't retry in step
+                if on_rate_limit is not None:
+                    on_rate_limit(wait)
+                time.sleep(wait)
+        text = response.choices[0].message.content or ""
+        if text and self.cache is not None:
+            self.cache.put(key, self.model, text)
+        return text
+
+
+def _estimated_tokens(messages, max_tokens):
+    # ~4 characters per token for the prompt, plus the most the answer may use
+    return sum(len(message["content"]) for message in messages) // 4 + max_tokens
+
+
+def generate_variants(suggester, body, column, values, concurrency=DEFAULT_VARIANT_CONCURRENCY,
+                      requests_per_minute=None, tokens_per_minute=None, progress=None):
+    """{value: (subject, intro)} for each distinct value, plus {value: error} for the ones that failed.
+
+    progress(done, total), if given, is called from the calling thread as answers arrive.
+    """
+    prompts = {} # cache key -> (messages, [values]); identical prompts are requested once
+    for value in values:
+        if value is None or not str(value).strip():
+            continue
+        value = str(value).strip()
+        messages = [{"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": variant_prompt(body, column, value)}]
+        entry = prompts.setdefault(cache_key(suggester.model, messages, suggester.temperature), (messages, []))
+        if value not in entry[1]:
+            entry[1].append(value)
+
+    requests = RateLimiter(requests_per_minute / 60.0 if requests_per_minute else None)
+    tokens = RateLimiter(tokens_per_minute / 60.0 if tokens_per_minute else None,
+                         burst=tokens_per_minute / 6.0 if tokens_per_minute else None) # Up to 10 s of budget at once
+
+    def request(messages):
+        if suggester.cached_messages(messages) is None: # Cached answers cost neither requests nor tokens
+            tokens.acquire(_estimated_tokens(messages, VARIANT_MAX_TOKENS))
+            requests.acquire()
+        return suggester.complete(messages, VARIANT_MAX_TOKENS)
+
+    variants, errors = {}, {}
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futures = {pool.submit(request, messages): prompt_values for messages, prompt_values in prompts.values()}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                variant = parse_variant(future.result())
+                for value in futures[future]:
+                    variants[value] = variant
+            except Exception as e_request:
+                for value in futures[future]:
+                    errors[value] = str(e_request)
+            if progress is not None:
+                progress(done, len(futures))
+    return variants, errors
+
+
+def apply_variants(df, ai_variants):
+    """df with VARIANT_FIELDS columns mapped from the segment column (no-op without variants for its column)."""
+    if not ai_variants or ai_variants.get("column") not in getattr(df, "columns", ()):
+        return df
+    keys = df[ai_variants["column"]].astype("string").str.strip()
+    by_value = ai_variants["variants"]
+    return df.assign(**{field: keys.map({value: variant[i] for value, variant in by_value.items()}).fillna("")
+                        for i, field in enumerate(VARIANT_FIELDS)})
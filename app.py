@@ -113,6 +113,56 @@ import os
 
 import re
 
+import smtplib # Exceptions surfaced from the SMTP transport
+import time
+import datetime
+from zoneinfo import ZoneInfo
+from google_auth_oauthlib.flow import Flow # Added for Google OAuth
+from urllib.parse import urlparse, parse_qs # Added for state verification
+from google.auth.transport.requests import Request # For token refresh
+# from google.oauth2.credentials import Credentials # Might need later for building service
+import openai # Exception types for OpenRouter/OpenAI API calls; clients come from resource_pools
+# SendGrid and MIME message construction live in rendering.py (run in the render process pool)
+
+from recipient_store import ANY_COLUMN, PAGE_SIZES, get_store, sync_session
+from send_pipeline import DEFAULT_DELIVERY_WORKERS, SendPipeline, build_campaign, iter_row_chunks
+from bounces import BounceProcessor, iter_maildir, iter_mbox
+from spool import SPOOL_FORMATS, Spool, SpoolTransport
+from suppression import DEFAULT_SUPPRESSION_DB, SOFT_BOUNCE_WINDOW_DAYS, SuppressionStore
+from sendgrid_events import DEFAULT_EVENTS_DB, EventStore
+from list_store import ADD_NEW, UPSERT, ContactListStore
+from segments import ENGAGEMENT_FIELDS, SegmentError, SegmentLibrary, load_engagement
+from transports import (
+    DEFAULT_COMMAND_TIMEOUT, DEFAULT_CONNECT_TIMEOUT, DEFAULT_DATA_TIMEOUT, DEFAULT_HTTP_TIMEOUT, DEFAULT_SENDMAIL_COMMAND,
+    PickupDirectoryTransport, SendmailTransport, SmtpTransport, delivery_deadlines, pooled_transport_factory, transport_for
+)
+from resource_pools import DEFAULT_MAX_CONNECTIONS, pool_stats, sheets_service
+from ai_suggestions import (
+    DEFAULT_AI_CACHE_DB, DEFAULT_BASE_URL as DEFAULT_AI_BASE_URL, DEFAULT_MODEL as DEFAULT_AI_MODEL,
+    DEFAULT_VARIANT_CONCURRENCY, VARIANT_FIELDS, CompletionCache, SubjectSuggester, apply_variants, generate_variants,
+    parse_suggestions
+)
+from work_queue import open_queue
+from campaign_worker import enqueue_campaign
+from scheduler import (
+    ALL_DAYS, Schedule, SendWindow, background_worker_running, plan_send_times, schedule_summary, start_background_worker
+)
+
+DEFAULT_WORK_QUEUE_URL = "sqlite:///campaigns.db"
+
+from profiling import profile_settings, top_functions
+from dkim_signing import DEFAULT_SIGNED_HEADERS, load_private_key
+from templating import JINJA, PLACEHOLDERS, TEMPLATE_SYNTAXES, check_templates
+from inline_images import DEFAULT_MAX_WIDTH, content_id, optimize_image, referenced_cids
+from preview import PreviewRenderer
+
+# Per-campaign output (profiles, spools) goes under this directory
+CAMPAIGN_OUTPUT_DIR = "campaign_output"
+
+import metrics
+# Prometheus scrape endpoint for the send pipeline; set MAILER_METRICS_PORT=0 to disable
+METRICS_PORT = int(os.environ.get("MAILER_METRICS_PORT", "9108"))
+
 # ... (other imports and code remain the same) ...
 
 # Helper function for basic email validation
@@ -139,9 +189,101 @@ def load_data(uploaded_file):
         st.error(f"Error reading file: {e}")
         return None
 
+# Engagement for segment expressions (last_open etc.), reloaded only when the event store changes
+def segment_engagement(events_db):
+    try:
+        stamp = (events_db, os.path.getmtime(events_db),
+                 os.path.getmtime(events_db + "-wal") if os.path.exists(events_db + "-wal") else None)
+    except OSError:
+        return None
+    cached = st.session_state.get('segment_engagement')
+    if cached is None or cached[0] != stamp:
+        cached = (stamp, load_engagement(events_db))
+        st.session_state.segment_engagement = cached
+    return cached[1]
+
+# One connection to the AI suggestion cache for the whole server
+@st.cache_resource
+def ai_cache():
+    return CompletionCache(DEFAULT_AI_CACHE_DB)
+
+# The scheduler.Schedule described by the schedule settings in config
+def campaign_schedule(config):
+    default_tz = config.get('schedule_default_tz') or "UTC"
+    start = datetime.datetime.combine(datetime.date.fromisoformat(config['schedule_date']),
+                                      datetime.time.fromisoformat(config['schedule_time']), ZoneInfo(default_tz))
+    start_hour, end_hour = config.get('schedule_hours', (9, 17))
+    tz_column = config.get('schedule_tz_column')
+    return Schedule(max(start.timestamp(), time.time()), SendWindow(start_hour, end_hour, tuple(config.get('schedule_weekdays', ALL_DAYS))),
+                    float(config.get('schedule_spread_hours') or 0) * 3600,
+                    None if tz_column in (None, "(none)") else tz_column, default_tz)
+
+# Paginated recipient grid. Only the visible page is sent to the browser;
+# filtering, sorting and edits are handled by the RecipientStore on the server.
+def render_recipient_grid(store, key_prefix, editable=False):
+    columns = list(store.df.columns)
+
+    filter_col, text_col, sort_col, order_col = st.columns([1, 2, 1, 1])
+    with filter_col:
+        filter_column = st.selectbox("Filter column", [ANY_COLUMN] + columns, key=f"{key_prefix}_filter_column")
+    with text_col:
+        filter_text = st.text_input("Filter rows", key=f"{key_prefix}_filter_text", placeholder="Type to filter...")
+    with sort_col:
+        sort_by = st.selectbox("Sort by", ["(none)"] + columns, key=f"{key_prefix}_sort_by")
+    with order_col:
+        ascending = st.radio("Order", ("Ascending", "Descending"), key=f"{key_prefix}_sort_order", horizontal=True) == "Ascending"
+
+    view_spec = {
+        "filter_text": filter_text,
+        "filter_column": filter_column,
+        "sort_by": None if sort_by == "(none)" else sort_by,
+        "ascending": ascending,
+    }
+    matching_rows = len(store.view_keys(**view_spec))
+
+    size_col, page_col, info_col = st.columns([1, 1, 2])
+    with size_col:
+        page_size = st.selectbox("Rows per page", PAGE_SIZES, key=f"{key_prefix}_page_size")
+    page_count = max(1, -(-matching_rows // page_size))
+    page_key = f"{key_prefix}_page"
+    if st.session_state.get(page_key, 1) > page_count: # Filter shrank the view
+        st.session_state[page_key] = page_count
+    with page_col:
+        page_number = st.number_input("Page", min_value=1, max_value=page_count, value=1, key=page_key)
+
+    page_df, _ = store.page(page_number - 1, page_size, **view_spec)
+    first_row = (page_number - 1) * page_size
+    with info_col:
+        st.write("") # Spacer for alignment
+        st.caption(f"Rows {min(first_row + 1, matching_rows)}-{first_row + len(page_df)} of {matching_rows}"
+                   + (f" (filtered from {len(store)})" if matching_rows != len(store) else ""))
+
+    if not editable:
+        st.dataframe(page_df)
+        return
+
+    # The editor key includes the store version so that deltas already written back
+    # are not re-applied on the next rerun.
+    edited_page = st.data_editor(
+        page_df,
+        num_rows="dynamic",
+        key=f"{key_prefix}_editor_{store.version}_{page_number}_{page_size}"
+    )
+    if isinstance(edited_page, pd.DataFrame) and store.apply_page_edits(page_df, edited_page):
+        sync_session(st.session_state, store)
+        st.rerun()
+
 def run_sender_app():
     st.header("Configure, Compose, and Send Your Emails")
 
+    if METRICS_PORT and 'metrics_endpoint' not in st.session_state:
+        try:
+            host, port = metrics.start_metrics_server(METRICS_PORT)
+            st.session_state.metrics_endpoint = f"http://{host}:{port}/metrics"
+        except OSError as e: # Port taken by another app; the in-app summary still works
+            st.session_state.metrics_endpoint = None
+            st.sidebar.caption(f"Metrics endpoint unavailable on port {METRICS_PORT}: {e}")
+
     # Initialize session state for data if not already present
     if 'recipient_df' not in st.session_state:
         st.session_state.recipient_df = None # Will hold the DataFrame of recipients
@@ -175,6 +317,40 @@ def run_sender_app():
         )
         st.caption("Note: For Gmail, you might need to generate an 'App Password'. For other providers, use your regular email password.")
 
+        delivery_methods = {"SMTP relay": SmtpTransport.name, "Local sendmail": SendmailTransport.name,
+                            "Pickup directory": PickupDirectoryTransport.name}
+        current_method = next((label for label, name in delivery_methods.items()
+                               if name == st.session_state.config.get('delivery_transport')), "SMTP relay")
+        delivery_method = st.radio(
+            "Delivery method", list(delivery_methods), index=list(delivery_methods).index(current_method),
+            key='delivery_transport_radio', horizontal=True,
+            help="On a host with its own MTA (Postfix, Exim...), handing messages to it locally skips the network round trips."
+        )
+        st.session_state.config['delivery_transport'] = delivery_methods[delivery_method]
+        if delivery_method == "Local sendmail":
+            st.session_state.config['sendmail_command'] = st.text_input(
+                "sendmail command",
+                value=st.session_state.config.get('sendmail_command', DEFAULT_SENDMAIL_COMMAND),
+                key='sendmail_command_input',
+                help="Any sendmail-compatible binary; `python fake_sendmail.py` stands in for one when testing."
+            )
+            st.session_state.config['sendmail_mode'] = st.selectbox(
+                "sendmail mode", ["bs", "t"],
+                index=["bs", "t"].index(st.session_state.config.get('sendmail_mode', "bs")),
+                format_func=lambda mode: {"bs": "-bs: long-lived SMTP session per connection (Postfix, Exim, Sendmail)",
+                                          "t": "-t -oi: one process per email (msmtp, ssmtp)"}[mode],
+                key='sendmail_mode_select'
+            )
+        elif delivery_method == "Pickup directory":
+            st.session_state.config['pickup_dir'] = st.text_input(
+                "Pickup directory", value=st.session_state.config.get('pickup_dir', ""), key='pickup_dir_input',
+                help="Directory your MTA picks .eml files up from; files appear there only once fully written."
+            )
+            st.session_state.config['pickup_envelope_headers'] = st.checkbox(
+                "Add X-Sender/X-Receiver envelope headers", value=st.session_state.config.get('pickup_envelope_headers', True),
+                key='pickup_envelope_headers_checkbox', help="Needed by IIS/Exchange-style pickup directories."
+            )
+
         st.subheader("SMTP Server Details")
 
         common_smtp = {
@@ -230,9 +406,55 @@ def run_sender_app():
             index=default_security_index,
             key='smtp_security_input_field'
         )
+        st.session_state.config['smtp_ca_file'] = st.text_input(
+            "Trusted CA certificate file (optional)",
+            value=st.session_state.config.get('smtp_ca_file', ""),
+            help="PEM file to trust for a relay with a private or self-signed certificate (e.g. smtp_stub.py --tls). Leave empty to use the system store.",
+            key='smtp_ca_file_input_field'
+        )
 
         st.info("Ensure your email account allows SMTP access. For Gmail, you may need to enable 'Less secure app access' or use an 'App Password'.")
 
+        st.subheader("✍️ DKIM Signing (SMTP)")
+        st.session_state.config['dkim_enabled'] = st.checkbox(
+            "Sign outgoing SMTP mail with DKIM",
+            value=st.session_state.config.get('dkim_enabled', False),
+            key='dkim_enabled_checkbox'
+        )
+        if st.session_state.config['dkim_enabled']:
+            dkim_col1, dkim_col2 = st.columns(2)
+            with dkim_col1:
+                st.session_state.config['dkim_domain'] = st.text_input(
+                    "Signing domain (d=)",
+                    value=st.session_state.config.get('dkim_domain', ""),
+                    key='dkim_domain_input'
+                )
+            with dkim_col2:
+                st.session_state.config['dkim_selector'] = st.text_input(
+                    "Selector (s=)",
+                    value=st.session_state.config.get('dkim_selector', ""),
+                    key='dkim_selector_input'
+                )
+            st.session_state.config['dkim_key_path'] = st.text_input(
+                "Private key file (PEM, RSA or Ed25519)",
+                value=st.session_state.config.get('dkim_key_path', ""),
+                help="Read by each render process (and each campaign worker), so it must exist at this path wherever mail is rendered.",
+                key='dkim_key_path_input'
+            )
+            st.session_state.config['dkim_headers'] = st.text_input(
+                "Signed headers",
+                value=st.session_state.config.get('dkim_headers', ", ".join(DEFAULT_SIGNED_HEADERS)),
+                key='dkim_headers_input'
+            )
+            try:
+                if st.session_state.config['dkim_key_path']:
+                    with open(st.session_state.config['dkim_key_path'], "rb") as key_file:
+                        _, dkim_algorithm = load_private_key(key_file.read())
+                    st.caption(f"Key loaded: {dkim_algorithm}. Publish the public key at "
+                               f"`{st.session_state.config.get('dkim_selector') or '<selector>'}._domainkey.{st.session_state.config.get('dkim_domain') or '<domain>'}`.")
+            except Exception as e_key:
+                st.warning(f"Could not load the DKIM key: {e_key}")
+
         if st.button("🔄 Reset Configuration to Defaults", key="reset_config_button"):
             st.session_state.config = {
                 "sender_email": "",
@@ -246,6 +468,7 @@ def run_sender_app():
             st.session_state.config['sendgrid_api_key'] = ""
             st.session_state.config['enable_sendgrid_tracking'] = False
             st.session_state.config['openrouter_api_key'] = ""
+            st.session_state.config['ai_api_key'] = ""
             st.success("Configuration reset to defaults (Gmail), SendGrid & OpenRouter settings cleared.")
             st.rerun()
 
@@ -300,6 +523,30 @@ def run_sender_app():
         )
         if st.session_state.config.get('openrouter_api_key'):
             st.caption("OpenRouter API Key entered.")
+        ai_url_col, ai_model_col = st.columns(2)
+        with ai_url_col:
+            st.session_state.config['ai_base_url'] = st.text_input(
+                "AI server URL (optional)",
+                value=st.session_state.config.get('ai_base_url', ""),
+                placeholder=DEFAULT_AI_BASE_URL,
+                key="ai_base_url_input",
+                help="Any OpenAI-compatible API, e.g. a local model server such as http://localhost:11434/v1 (Ollama). "
+                     "Empty = OpenRouter. Local servers usually need no API key."
+            )
+            if (st.session_state.config.get('ai_base_url') or "").strip().rstrip("/") not in ("", DEFAULT_AI_BASE_URL):
+                st.session_state.config['ai_api_key'] = st.text_input(
+                    "AI server API key (optional)",
+                    type="password",
+                    value=st.session_state.config.get('ai_api_key', ""),
+                    key="ai_api_key_input",
+                    help="Sent to the server above instead of your OpenRouter key, which only goes to OpenRouter."
+                )
+        with ai_model_col:
+            st.session_state.config['ai_model'] = st.text_input(
+                "Model",
+                value=st.session_state.config.get('ai_model', DEFAULT_AI_MODEL),
+                key="ai_model_input"
+            )
 
 
     # 2. Data Input Section
@@ -330,12 +577,17 @@ def run_sender_app():
                 key="file_uploader"
             )
             if uploaded_file is not None:
-                df = load_data(uploaded_file)
-                if df is not None:
-                    st.session_state.recipient_df = df
-                    st.success(f"Successfully loaded {uploaded_file.name}")
-                    # Clear manual data if file is uploaded
-                    st.session_state.manual_data = []
+                # Only parse the file when a different one is uploaded; re-reading it on every
+                # rerun would also throw away edits made in the recipient grid.
+                file_signature = (uploaded_file.name, uploaded_file.size)
+                if st.session_state.get('loaded_file_signature') != file_signature:
+                    df = load_data(uploaded_file)
+                    if df is not None:
+                        st.session_state.recipient_df = df
+                        st.session_state.loaded_file_signature = file_signature
+                        st.success(f"Successfully loaded {uploaded_file.name}")
+                        # Clear manual data if file is uploaded
+                        st.session_state.manual_data = []
 
             # Sample CSV Download Button
             sample_csv_data = "Email,Name,Company,Birthday,CustomField1\n" \
@@ -358,60 +610,32 @@ def run_sender_app():
         elif data_input_method == "Manual Entry":
             st.subheader("Create or Edit Data Manually")
 
-            # Use st.data_editor for a basic table editing experience
-            # Initialize if empty or if switching from file upload
-            if not st.session_state.manual_data or st.session_state.recipient_df is not None:
-                 if st.session_state.recipient_df is not None and not st.session_state.recipient_df.empty:
-                     # If switching from file upload with data, offer to convert it to manual editing
-                     if st.button("Edit Uploaded Data Manually"):
-                         st.session_state.manual_data = st.session_state.recipient_df.to_dict('records')
-                         st.session_state.recipient_df = None # Clear uploaded df
-                 elif not st.session_state.manual_data : # Initialize with a default row if empty
-                     st.session_state.manual_data = [{"Email": "contact@example.com", "Name": "New Contact"}]
-
-
-            if st.session_state.manual_data:
-                edited_data = st.data_editor(
-                    pd.DataFrame(st.session_state.manual_data), # Convert to DF for data_editor
-                    num_rows="dynamic",
-                    key="manual_data_editor"
-                )
-                # Update session state with edited data
-                if isinstance(edited_data, pd.DataFrame):
-                    st.session_state.manual_data = edited_data.to_dict('records')
-                    # Convert manual data to recipient_df for consistent processing later
-                    st.session_state.recipient_df = pd.DataFrame(st.session_state.manual_data)
-            else: # if manual_data list is empty (e.g. after clearing an upload)
-                 st.info("Click 'Add Row' in the table above (if available with st.data_editor) or re-initialize if needed.")
-                 # Re-initialize button or automatically add a row
-                 if st.button("Add first manual entry row"):
-                     st.session_state.manual_data = [{"Email": "contact@example.com", "Name": "New Contact"}]
-                     st.session_state.recipient_df = pd.DataFrame(st.session_state.manual_data)
-                     st.rerun()
+            # Manual entry edits the same recipient store as uploads, one page at a time
+            if st.session_state.recipient_df is None:
+                if not st.session_state.manual_data: # Initialize with a default row if empty
+                    st.session_state.manual_data = [{"Email": "contact@example.com", "Name": "New Contact"}]
+                st.session_state.recipient_df = pd.DataFrame(st.session_state.manual_data)
+
+            manual_store = get_store(st.session_state)
+            render_recipient_grid(manual_store, "manual_grid", editable=True)
+            st.caption("Edits are saved to the current recipient list as you make them. Use the table's '+' to add rows.")
 
 
         # Display the final DataFrame that will be used for mailing
-        if st.session_state.recipient_df is not None and not st.session_state.recipient_df.empty:
+        recipient_store = get_store(st.session_state)
+        if recipient_store is not None and len(recipient_store):
             st.subheader("Current Recipient Data for Mailing:")
-            st.dataframe(st.session_state.recipient_df)
-            st.caption(f"{len(st.session_state.recipient_df)} recipients loaded.")
+            render_recipient_grid(recipient_store, "mailing_grid")
+            st.caption(f"{len(recipient_store)} recipients loaded.")
+            # Counts come from the store's cached aggregates, recomputed only after edits
+            email_stats = recipient_store.email_stats()
             # Check for 'Email' column
-            if 'Email' not in st.session_state.recipient_df.columns:
+            if not email_stats["has_email_column"]:
                 st.error("🚨 Critical: The data does not contain an 'Email' column. This column is required to send emails.")
             else:
-                # Perform email validation
-                valid_email_count = 0
-                invalid_format_count = 0
-                empty_email_count = 0
-
-                email_column = st.session_state.recipient_df['Email']
-                for email_val in email_column:
-                    if pd.isna(email_val) or str(email_val).strip() == "":
-                        empty_email_count += 1
-                    elif is_valid_email(str(email_val).strip()):
-                        valid_email_count += 1
-                    else:
-                        invalid_format_count += 1
+                valid_email_count = email_stats["valid"]
+                invalid_format_count = email_stats["invalid"]
+                empty_email_count = email_stats["empty"]
 
                 if valid_email_count > 0:
                     st.success(f"✅ {valid_email_count} valid email addresses found.")
@@ -703,8 +927,6 @@ def run_sender_app():
                                 st.session_state.google_sheet_load_in_progress = False
                                 st.rerun()
 
-                        service = build('sheets', 'v4', credentials=creds)
-
                         # Extract Sheet ID from URL or use directly if ID is provided
                         sheet_id_input = st.session_state.get('google_sheet_url_id', "").strip()
                         # Basic regex to extract ID from a typical sheets URL
@@ -729,9 +951,11 @@ def run_sender_app():
 
                         st.caption(f"Attempting to fetch: Spreadsheet ID='{spreadsheet_id}', Range='{range_to_fetch}'")
 
-                        result = service.spreadsheets().values().get(
-                            spreadsheetId=spreadsheet_id, range=range_to_fetch
-                        ).execute()
+                        # Services are pooled per Google login for the whole server (building one parses the discovery doc)
+                        with sheets_service(creds) as service:
+                            result = service.spreadsheets().values().get(
+                                spreadsheetId=spreadsheet_id, range=range_to_fetch
+                            ).execute()
 
                         values = result.get('values', [])
 
@@ -772,12 +996,19 @@ def run_sender_app():
                 st.error(f"Could not create directory for contact lists: {CONTACT_LIST_DIR}. Saved lists may not work. Error: {e}")
                 # If directory can't be made, this feature will be largely non-functional.
 
+        # Saved lists live in a keyed store (contact_lists/lists.db): saves and merges write only changed rows
+        if st.session_state.get('contact_list_store') is None:
+            try:
+                st.session_state.contact_list_store = ContactListStore(CONTACT_LIST_DIR)
+            except Exception as e:
+                st.error(f"Could not open the saved contact lists: {e}")
+        list_store = st.session_state.get('contact_list_store')
+
         def get_saved_lists():
-            if not os.path.exists(CONTACT_LIST_DIR) or not os.path.isdir(CONTACT_LIST_DIR):
+            if list_store is None:
                 return []
             try:
-                files = [f for f in os.listdir(CONTACT_LIST_DIR) if f.endswith(".csv")]
-                return sorted([os.path.splitext(f)[0] for f in files])
+                return list_store.names()
             except Exception as e:
                 # st.error(f"Error reading saved contact lists: {e}") # Can be noisy
                 return []
@@ -809,10 +1040,8 @@ def run_sender_app():
                     if not safe_list_name:
                         st.error("Invalid list name. Please use letters, numbers, spaces, underscores, or hyphens. Name cannot be empty after sanitization.")
                     else:
-                        filepath = os.path.join(CONTACT_LIST_DIR, safe_list_name + ".csv")
-
                         # Overwrite confirmation logic
-                        if os.path.exists(filepath) and f"overwrite_confirmed_{safe_list_name}" not in st.session_state:
+                        if safe_list_name in saved_lists and f"overwrite_confirmed_{safe_list_name}" not in st.session_state:
                             st.session_state[f"confirm_overwrite_{safe_list_name}"] = True
                             st.rerun() # Rerun to show confirmation buttons
 
@@ -832,8 +1061,10 @@ def run_sender_app():
                         else:
                             # Proceed with save if no confirmation needed or if confirmed
                             try:
-                                st.session_state.recipient_df.to_csv(filepath, index=False)
-                                st.success(f"Contact list '{safe_list_name}' saved successfully!")
+                                save_stats = list_store.save(safe_list_name, st.session_state.recipient_df)
+                                st.success(f"Contact list '{safe_list_name}' saved successfully! ({save_stats['added']} added, "
+                                           f"{save_stats['updated']} updated, {save_stats['removed']} removed"
+                                           + (f", {save_stats['skipped']} rows without an email skipped" if save_stats['skipped'] else "") + ")")
                                 st.session_state.contact_list_name_input = ""
                                 if f"overwrite_confirmed_{safe_list_name}" in st.session_state:
                                     del st.session_state[f"overwrite_confirmed_{safe_list_name}"]
@@ -857,14 +1088,13 @@ def run_sender_app():
                 st.write("") # Spacer
                 st.write("") # Spacer
                 if st.button("📂 Load List", key="load_contact_list_btn", disabled=not selected_list_to_action, use_container_width=True):
-                    filepath = os.path.join(CONTACT_LIST_DIR, selected_list_to_action + ".csv")
                     try:
-                        loaded_df = pd.read_csv(filepath)
+                        loaded_df = list_store.load(selected_list_to_action)
                         st.session_state.recipient_df = loaded_df
                         st.session_state.manual_data = loaded_df.to_dict('records')
                         st.success(f"List '{selected_list_to_action}' loaded!")
                         st.rerun()
-                    except FileNotFoundError:
+                    except (FileNotFoundError, KeyError):
                         st.error(f"List '{selected_list_to_action}' not found.")
                     except pd.errors.EmptyDataError:
                         st.error(f"List '{selected_list_to_action}' is empty or not valid CSV.")
@@ -884,9 +1114,8 @@ def run_sender_app():
                     col_del_1, col_del_2 = st.columns(2)
                     with col_del_1:
                         if st.button(f"✅ Yes, Delete '{selected_list_to_action}'", key=f"delete_yes_{selected_list_to_action}"):
-                            filepath = os.path.join(CONTACT_LIST_DIR, selected_list_to_action + ".csv")
                             try:
-                                os.remove(filepath)
+                                list_store.delete(selected_list_to_action)
                                 st.success(f"Contact list '{selected_list_to_action}' deleted!")
                                 del st.session_state[f"confirm_delete_{selected_list_to_action}"]
                                 # Reset selectbox to avoid trying to delete again on auto-rerun
@@ -906,6 +1135,40 @@ def run_sender_app():
                             st.info(f"Deletion of '{selected_list_to_action}' cancelled.")
                             st.rerun()
 
+            if selected_list_to_action:
+                merge_mode_col, merge_btn_col, undo_btn_col = st.columns([2, 1, 1])
+                with merge_mode_col:
+                    merge_mode = st.radio(
+                        f"Merge the current data into '{selected_list_to_action}' by email:",
+                        ("Update matching rows and add new ones", "Only add new emails"),
+                        key="merge_contact_list_mode", horizontal=True,
+                        help="Blank cells in the current data don't erase values already in the saved list."
+                    )
+                with merge_btn_col:
+                    st.write("") # Spacer
+                    st.write("") # Spacer
+                    if st.button("🔀 Merge Into List", key="merge_contact_list_btn", use_container_width=True,
+                                 disabled=st.session_state.recipient_df is None or st.session_state.recipient_df.empty):
+                        try:
+                            merge_stats = list_store.merge(selected_list_to_action, st.session_state.recipient_df,
+                                                           ADD_NEW if merge_mode == "Only add new emails" else UPSERT)
+                            st.success(f"Merged into '{selected_list_to_action}': {merge_stats['added']} added, "
+                                       f"{merge_stats['updated']} updated, {merge_stats['unchanged']} unchanged"
+                                       + (f", {merge_stats['skipped']} rows without an email skipped" if merge_stats['skipped'] else "") + ".")
+                        except Exception as e:
+                            st.error(f"Error merging into '{selected_list_to_action}': {e}")
+                last_list_change = list_store.last_change(selected_list_to_action) if selected_list_to_action in saved_lists else None
+                with undo_btn_col:
+                    st.write("") # Spacer
+                    st.write("") # Spacer
+                    if st.button("↩️ Undo Last Change", key="undo_contact_list_btn", disabled=last_list_change is None,
+                                 use_container_width=True):
+                        restored = list_store.undo(selected_list_to_action)
+                        st.success(f"Undid the last change to '{selected_list_to_action}' ({restored} rows restored).")
+                if last_list_change is not None:
+                    st.caption(f"Last change: {last_list_change[1]} rows on "
+                               f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(last_list_change[2]))}.")
+
     # 3. Email Composition Section
     with st.expander("✍️ Step 3: Compose Your Email", expanded=True): # Expanded by default
         st.subheader("Email Content")
@@ -918,6 +1181,17 @@ def run_sender_app():
             st.session_state.suggested_subjects = []
         if 'subject_suggestion_error' not in st.session_state:
             st.session_state.subject_suggestion_error = None
+        if 'template_syntax' not in st.session_state:
+            st.session_state.template_syntax = PLACEHOLDERS
+
+        st.session_state.template_syntax = st.radio(
+            "Template syntax",
+            TEMPLATE_SYNTAXES,
+            index=TEMPLATE_SYNTAXES.index(st.session_state.template_syntax),
+            format_func=lambda syntax: "Simple placeholders ({Name})" if syntax == PLACEHOLDERS else "Jinja (conditions, loops, filters)",
+            horizontal=True,
+            key='template_syntax_radio'
+        )
 
         st.session_state.email_subject = st.text_input(
             "Subject",
@@ -931,20 +1205,45 @@ def run_sender_app():
             height=300, # Increased height for potentially longer HTML
             placeholder="<h1>Hello {Name},</h1>\n<p>This is an <b>HTML</b> email. You can use HTML tags for formatting.</p>\n<p>For example, a link: <a href='https://www.example.com'>Visit Example.com</a></p>\n<p>Best regards,<br>Your Company</p>"
         )
-        st.caption("Use placeholders like `{ColumnName}` (e.g., `{Name}`, `{Email}`). Write HTML directly for rich formatting.")
+        if st.session_state.template_syntax == JINJA:
+            st.caption("Jinja syntax: `{{ Name }}`, `{{ Name | default('there') }}`, `{% if Plan == 'Pro' %}...{% endif %}`, "
+                       "`{% for item in Products | split(';') %}...{% endfor %}`, `{{ row['First Name'] }}`. "
+                       "Column values are HTML-escaped in the body; use `| safe` for trusted HTML.")
+        else:
+            st.caption("Use placeholders like `{ColumnName}` (e.g., `{Name}`, `{Email}`). Write HTML directly for rich formatting.")
+
+        html_col1, html_col2, html_col3 = st.columns(3)
+        with html_col1:
+            st.session_state.config['html_inline_css'] = st.checkbox(
+                "Inline CSS", value=st.session_state.config.get('html_inline_css', True), key='html_inline_css_checkbox',
+                help="Copies <style> rules into style attributes, for mail clients that ignore <style> (needs premailer or css_inline)."
+            )
+        with html_col2:
+            st.session_state.config['html_minify'] = st.checkbox(
+                "Minify HTML", value=st.session_state.config.get('html_minify', True), key='html_minify_checkbox'
+            )
+        with html_col3:
+            st.session_state.config['html_text_alternative'] = st.checkbox(
+                "Add plain-text version", value=st.session_state.config.get('html_text_alternative', True),
+                key='html_text_alternative_checkbox',
+                help="Sends multipart/alternative with a text/plain part generated from the HTML."
+            )
+        st.caption("These run once on the template when the campaign starts, not per recipient.")
 
         # AI Subject Line Suggestion via OpenRouter
         openrouter_api_key = st.session_state.config.get('openrouter_api_key', "")
+        # A custom (e.g. local) OpenAI-compatible server may not need a key
+        ai_configured = bool(openrouter_api_key or st.session_state.config.get('ai_base_url'))
         email_body_present = st.session_state.email_body and st.session_state.email_body.strip() != ""
 
-        disable_ai_subject_button = not (openrouter_api_key and email_body_present)
+        disable_ai_subject_button = not (ai_configured and email_body_present)
         ai_subject_help_text = ""
-        if not openrouter_api_key:
-            ai_subject_help_text = "OpenRouter API Key not configured in Step 1."
+        if not ai_configured:
+            ai_subject_help_text = "OpenRouter API Key (or an AI server URL) not configured in Step 1."
         elif not email_body_present:
             ai_subject_help_text = "Email body is empty. Write some content to generate subject lines."
 
-        if st.button("✨ Suggest Subjects with AI (OpenRouter)", key="suggest_subjects_openrouter", disabled=disable_ai_subject_button, help=ai_subject_help_text if disable_ai_subject_button else "Generates subject line suggestions using OpenRouter AI."):
+        if st.button("✨ Suggest Subjects with AI", key="suggest_subjects_openrouter", disabled=disable_ai_subject_button, help=ai_subject_help_text if disable_ai_subject_button else "Generates subject line suggestions (OpenRouter or your AI server). Repeat requests for the same body come from the cache."):
             # Logic for API call will be in the next step
             # For now, this just sets up the button state.
             # We will set a flag here to trigger API call in next step of plan.
@@ -953,73 +1252,50 @@ def run_sender_app():
             st.session_state.subject_suggestion_error = None # Clear previous error
             # Actual API call logic will be triggered by this flag below
 
-        # --- Logic for OpenRouter API call (if button was clicked) ---
+        # --- Logic for the AI call (if button was clicked) ---
         if st.session_state.get("generate_subjects_clicked"):
-            with st.spinner("🧠 Thinking of subject lines... Please wait."):
-                try:
-                    api_key = st.session_state.config.get('openrouter_api_key')
-                    email_body_content = st.session_state.email_body
-
-                    if not api_key: # Should be caught by button disable, but double check
-                        st.session_state.subject_suggestion_error = "OpenRouter API Key is not configured."
-                    elif not email_body_content.strip(): # Also caught by button disable
-                        st.session_state.subject_suggestion_error = "Email body is empty."
+            try:
+                email_body_content = st.session_state.email_body
+                if not ai_configured: # Should be caught by button disable, but double check
+                    st.session_state.subject_suggestion_error = "OpenRouter API Key is not configured."
+                elif not email_body_content.strip(): # Also caught by button disable
+                    st.session_state.subject_suggestion_error = "Email body is empty."
+                else:
+                    suggester = SubjectSuggester.from_config(st.session_state.config, ai_cache())
+                    suggestions_text = suggester.cached(email_body_content)
+                    if suggestions_text is None:
+                        # Show the tokens as they arrive instead of a spinner for the whole completion
+                        stream_box = st.empty()
+                        pieces = []
+                        last_update = 0.0
+                        for piece in suggester.stream(email_body_content):
+                            pieces.append(piece)
+                            now = time.monotonic()
+                            if now - last_update > 0.1:
+                                last_update = now
+                                stream_box.markdown("🧠 " + "".join(pieces))
+                        stream_box.empty()
+                        suggestions_text = "".join(pieces)
+
+                    parsed_suggestions = parse_suggestions(suggestions_text)
+                    if parsed_suggestions:
+                       st.session_state.suggested_subjects = parsed_suggestions
                     else:
-                        client = openai.OpenAI(
-                            base_url="https://openrouter.ai/api/v1",
-                            api_key=api_key,
-                        )
-
-                        prompt = f"""Given the following email body, please generate 3 distinct and engaging subject line options.
-Each subject line should be concise and relevant to the email's content.
-Return the subject lines as a numbered list (e.g., 1. Subject A, 2. Subject B, ...).
-
-Email Body:
----
-{email_body_content}
----
-Suggested subject lines:"""
-
-                        response = client.chat.completions.create(
-                            model="mistralai/mistral-7b-instruct", # A good default, or user-selectable later
-                            messages=[
-                                {"role": "system", "content": "You are an expert email marketer. Generate concise, engaging subject lines."},
-                                {"role": "user", "content": prompt}
-                            ],
-                            temperature=0.7,
-                            max_tokens=150
-                        )
-                        suggestions_text = response.choices[0].message.content
-
-                        # Basic parsing for numbered list (can be made more robust)
-                        parsed_suggestions = []
-                        for line in suggestions_text.split('\n'):
-                            line = line.strip()
-                            if line and (line[0].isdigit() and (line[1] == '.' or line[1] == ')')):
-                                # Remove numbering (e.g., "1. ", "1) ")
-                                suggestion = re.sub(r"^\d+[\.\)]\s*", "", line)
-                                parsed_suggestions.append(suggestion.strip())
-                            elif line: # If not numbered list, but still content, add it.
-                                parsed_suggestions.append(line.strip())
-
-                        if parsed_suggestions:
-                           st.session_state.suggested_subjects = parsed_suggestions
-                        else:
-                            st.session_state.subject_suggestion_error = "AI returned no suggestions or format was unexpected."
-                            st.session_state.suggested_subjects = [suggestions_text] # Show raw if parsing failed but got content
-
-                except openai.AuthenticationError:
-                    st.session_state.subject_suggestion_error = "OpenRouter Authentication Error: Invalid API Key or insufficient credits."
-                except openai.RateLimitError:
-                    st.session_state.subject_suggestion_error = "OpenRouter Rate Limit Error: Please try again later."
-                except openai.APIConnectionError:
-                    st.session_state.subject_suggestion_error = "OpenRouter Connection Error: Could not connect to OpenRouter. Check your internet connection."
-                except openai.APIError as e: # Catch other OpenAI specific API errors
-                    st.session_state.subject_suggestion_error = f"OpenRouter API Error: {str(e)}"
-                except Exception as e:
-                    st.session_state.subject_suggestion_error = f"An unexpected error occurred: {str(e)}"
-                finally:
-                    st.session_state.generate_subjects_clicked = False # Reset flag
+                        st.session_state.subject_suggestion_error = "AI returned no suggestions or format was unexpected."
+                        st.session_state.suggested_subjects = [suggestions_text] if suggestions_text else [] # Show raw if parsing failed but got content
+
+            except openai.AuthenticationError:
+                st.session_state.subject_suggestion_error = "AI Authentication Error: Invalid API Key or insufficient credits."
+            except openai.RateLimitError:
+                st.session_state.subject_suggestion_error = "AI Rate Limit Error: Please try again later."
+            except openai.APIConnectionError:
+                st.session_state.subject_suggestion_error = f"AI Connection Error: Could not connect to {st.session_state.config.get('ai_base_url') or DEFAULT_AI_BASE_URL}."
+            except openai.APIError as e: # Catch other OpenAI specific API errors
+                st.session_state.subject_suggestion_error = f"AI API Error: {str(e)}"
+            except Exception as e:
+                st.session_state.subject_suggestion_error = f"An unexpected error occurred: {str(e)}"
+            finally:
+                st.session_state.generate_subjects_clicked = False # Reset flag
 
         # --- Display Suggestions or Errors ---
         if st.session_state.get('subject_suggestion_error'):
@@ -1040,45 +1316,103 @@ Suggested subject lines:"""
                         st.rerun() # Update the main subject input
             st.caption("Click 'Apply' to use a suggestion.")
 
+        # --- AI variants per segment: one request per distinct value of a column, used as template fields ---
+        recipient_columns = [] if st.session_state.recipient_df is None else [
+            column for column in st.session_state.recipient_df.columns if column not in ('Email',) + VARIANT_FIELDS]
+        with st.expander("🧩 AI Variants per Segment"):
+            if not recipient_columns:
+                st.caption("Load recipient data with a column to segment by (e.g. Industry).")
+            else:
+                variant_column = st.selectbox("Segment column", recipient_columns, key="ai_variant_column")
+                variant_values = st.session_state.recipient_df[variant_column].astype("string").str.strip().dropna().unique()
+                st.caption(f"{len(variant_values)} distinct value(s): one request each, whatever the number of recipients. "
+                           "Answers are cached, so regenerating for unchanged values is free.")
+                limit_col1, limit_col2, limit_col3 = st.columns(3)
+                with limit_col1:
+                    st.session_state.config['ai_concurrency'] = st.number_input(
+                        "Concurrent requests", min_value=1, max_value=32,
+                        value=int(st.session_state.config.get('ai_concurrency', DEFAULT_VARIANT_CONCURRENCY)),
+                        key="ai_concurrency_input")
+                with limit_col2:
+                    st.session_state.config['ai_requests_per_minute'] = st.number_input(
+                        "Requests/minute (0 = no limit)", min_value=0,
+                        value=int(st.session_state.config.get('ai_requests_per_minute', 60)),
+                        key="ai_requests_per_minute_input")
+                with limit_col3:
+                    st.session_state.config['ai_tokens_per_minute'] = st.number_input(
+                        "Tokens/minute (0 = no limit)", min_value=0,
+                        value=int(st.session_state.config.get('ai_tokens_per_minute', 0)),
+                        key="ai_tokens_per_minute_input")
+
+                if st.button("✨ Generate Variants", key="generate_ai_variants_button",
+                             disabled=not (ai_configured and email_body_present) or not len(variant_values)):
+                    variant_progress = st.progress(0.0)
+                    try:
+                        variants, variant_errors = generate_variants(
+                            SubjectSuggester.from_config(st.session_state.config, ai_cache()),
+                            st.session_state.email_body, variant_column, variant_values,
+                            concurrency=int(st.session_state.config['ai_concurrency']),
+                            requests_per_minute=st.session_state.config['ai_requests_per_minute'] or None,
+                            tokens_per_minute=st.session_state.config['ai_tokens_per_minute'] or None,
+                            progress=lambda done, total: variant_progress.progress(done / total))
+                        st.session_state.ai_variants = {"column": variant_column, "variants": variants}
+                        if variant_errors:
+                            st.warning(f"No variant for {len(variant_errors)} value(s); their recipients get empty AI fields. "
+                                       f"First error: {next(iter(variant_errors.values()))}")
+                    except Exception as e_variants:
+                        st.error(f"Could not generate variants: {e_variants}")
+
+                ai_variants = st.session_state.get('ai_variants')
+                if ai_variants:
+                    st.dataframe(pd.DataFrame([(value, subject, intro) for value, (subject, intro) in ai_variants["variants"].items()],
+                                              columns=[ai_variants["column"], *VARIANT_FIELDS]),
+                                 use_container_width=True, hide_index=True)
+                    field_syntax = "`{{ AI_Subject }}`, `{{ AI_Intro }}`" if st.session_state.template_syntax == JINJA else "`{AI_Subject}`, `{AI_Intro}`"
+                    st.caption(f"Use {field_syntax} in the subject and body; they're filled from each recipient's "
+                               f"{ai_variants['column']} when previewing and sending.")
+                    if st.button("Clear Variants", key="clear_ai_variants_button"):
+                        st.session_state.ai_variants = None
+                        st.rerun()
+
 
         st.markdown("---")
         st.subheader("Email Preview")
 
         if st.session_state.recipient_df is not None and not st.session_state.recipient_df.empty:
-            preview_data_source = st.selectbox(
-                "Select recipient for preview:",
-                ["First Recipient"] + (list(st.session_state.recipient_df.index[:10]) if len(st.session_state.recipient_df) > 1 else []), # Show more if available
-                format_func=lambda x: "First Recipient" if x == "First Recipient" else f"Recipient at Index {x}"
-            )
-
-            preview_recipient_data = None
-            if preview_data_source == "First Recipient":
-                preview_recipient_data = st.session_state.recipient_df.iloc[0]
-            elif isinstance(preview_data_source, int): # Index from the list
-                 if preview_data_source < len(st.session_state.recipient_df):
-                    preview_recipient_data = st.session_state.recipient_df.iloc[preview_data_source]
-
-            if preview_recipient_data is not None:
-                try:
-                    # Replace placeholders
-                    preview_subject = st.session_state.email_subject
-                    preview_body = st.session_state.email_body
-                    for col_name in preview_recipient_data.index:
-                        placeholder = f"{{{col_name}}}"
-                        # Ensure data is string for replacement, handle NaN/None
-                        replacement_value = str(preview_recipient_data[col_name]) if pd.notna(preview_recipient_data[col_name]) else ""
-                        preview_subject = preview_subject.replace(placeholder, replacement_value)
-                        preview_body = preview_body.replace(placeholder, replacement_value)
-
-                    st.markdown(f"**To:** `{preview_recipient_data.get('Email', 'N/A - Email column missing or empty')}`")
-                    st.markdown(f"**Subject:** {preview_subject}")
-                    st.markdown("**Body:**")
-                    st.markdown(f"<div style='border: 1px solid #ccc; padding: 10px; border-radius: 5px;'>{preview_body.replace('\n', '<br>')}</div>", unsafe_allow_html=True)
-                except Exception as e:
-                    st.error(f"Error generating preview: {e}")
-                    st.write("Preview Data:", preview_recipient_data.to_dict())
-            else:
-                st.info("Could not load selected recipient data for preview.")
+            preview_df = st.session_state.recipient_df
+            preview_pick_col, preview_count_col = st.columns([0.75, 0.25])
+            with preview_pick_col:
+                preview_start = st.selectbox(
+                    "Select recipient for preview:",
+                    range(min(len(preview_df), 50)),
+                    format_func=lambda position: f"Recipient {position + 1}" + (
+                        f" ({preview_df['Email'].iloc[position]})" if 'Email' in preview_df.columns else ""),
+                    key="preview_start_select"
+                )
+            with preview_count_col:
+                preview_count = st.number_input("Side by side", min_value=1, max_value=4, value=1, key="preview_count_input")
+
+            # Only the rows on screen are rendered, and only when the template, images or their data changed
+            if st.session_state.get('preview_renderer') is None:
+                st.session_state.preview_renderer = PreviewRenderer()
+            preview_positions = list(range(preview_start, min(preview_start + int(preview_count), len(preview_df))))
+            preview_rows = apply_variants(preview_df.iloc[preview_positions], st.session_state.get('ai_variants'))
+            try:
+                previews = st.session_state.preview_renderer.render(
+                    st.session_state.template_syntax, st.session_state.email_subject, st.session_state.email_body,
+                    preview_rows, range(len(preview_rows)), st.session_state.get('inline_images'))
+                for preview_col, preview in zip(st.columns(len(previews)), previews):
+                    with preview_col:
+                        st.markdown(f"**To:** `{preview.recipient or 'N/A - Email column missing or empty'}`")
+                        st.markdown(f"**Subject:** {preview.subject}")
+                        st.markdown("**Body:**")
+                        st.markdown(f"<div style='border: 1px solid #ccc; padding: 10px; border-radius: 5px;'>{preview.body_html}</div>", unsafe_allow_html=True)
+                        if st.session_state.config.get('html_text_alternative', True):
+                            with st.expander("Plain-text version"):
+                                st.text(preview.text)
+            except Exception as e:
+                st.error(f"Error generating preview: {e}")
+                st.write("Preview Data:", preview_rows.to_dict('records'))
         else:
             st.info("Load recipient data to see a preview.")
 
@@ -1143,31 +1477,109 @@ Suggested subject lines:"""
         else:
             st.caption("No attachments added yet.")
 
+        st.markdown("---")
+        st.subheader("Inline Images")
+        if 'inline_images' not in st.session_state:
+            st.session_state.inline_images = [] # Same shape as attachments; data is the optimised image
+        st.caption("Images shown inside the body. Reference each one by its file name, e.g. `<img src=\"cid:logo.png\" alt=\"Logo\">`.")
+        optimize_uploads = st.checkbox(
+            "Optimise images on upload", value=True, key='optimize_inline_images_checkbox',
+            help=f"Scales images wider than {DEFAULT_MAX_WIDTH}px down and recompresses PNG/JPEG (needs Pillow). Done once per image, not per email."
+        )
+        uploaded_images = st.file_uploader(
+            "Add Inline Images", type=["png", "jpg", "jpeg", "gif", "webp"], accept_multiple_files=True,
+            key="file_uploader_inline_images_widget"
+        )
+        if uploaded_images:
+            current_image_names = {image['name'] for image in st.session_state.inline_images}
+            for uploaded_file in uploaded_images:
+                if uploaded_file.name not in current_image_names:
+                    image_bytes = uploaded_file.getvalue()
+                    st.session_state.inline_images.append(
+                        {"name": uploaded_file.name, "data": optimize_image(image_bytes) if optimize_uploads else image_bytes}
+                    )
+                    current_image_names.add(uploaded_file.name)
 
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email import encoders
-import mimetypes
-import time # For adding small delays
-from google_auth_oauthlib.flow import Flow # Added for Google OAuth
-from urllib.parse import urlparse, parse_qs # Added for state verification
-from googleapiclient.discovery import build # Added for Sheets API
-from google.auth.transport.requests import Request # For token refresh
-# from google.oauth2.credentials import Credentials # Might need later for building service
-import openai # Added for OpenRouter/OpenAI API calls
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import (
-    Mail, Attachment, FileContent, FileName, FileType, Disposition, ContentId,
-    TrackingSettings, OpenTracking, ClickTracking, From, To, Subject, Content, HtmlContent
-)
-import base64 # For encoding attachments for SendGrid
+        if st.session_state.inline_images:
+            images_to_remove_indices = []
+            for i, image in enumerate(st.session_state.inline_images):
+                col1, col2 = st.columns([0.8, 0.2])
+                with col1:
+                    st.caption(f"- `cid:{content_id(image['name'])}` ({len(image['data'])/1024:.1f} KB)")
+                with col2:
+                    if st.button("Remove", key=f"remove_inline_{image['name']}_{i}"):
+                        images_to_remove_indices.append(i)
+            if images_to_remove_indices:
+                for index in sorted(images_to_remove_indices, reverse=True):
+                    st.session_state.inline_images.pop(index)
+                st.rerun()
+
+        used_cids = referenced_cids(st.session_state.get('email_body'))
+        available_cids = {content_id(image['name']) for image in st.session_state.inline_images}
+        if used_cids - available_cids:
+            st.warning(f"The body references images that haven't been added: {', '.join(sorted(used_cids - available_cids))}")
+        if available_cids - used_cids:
+            st.caption(f"Not referenced in the body (clients may show them as attachments): {', '.join(sorted(available_cids - used_cids))}")
 
-# ... (other parts of the run_sender_app function) ...
 
     # 4. Sending Section
     with st.expander("🚀 Step 4: Send Emails", expanded=True): # Expanded by default
+        st.subheader("🎯 Recipient Segment")
+        segment_library = SegmentLibrary()
+        saved_segments = segment_library.names()
+        segment_col, load_segment_col = st.columns([3, 1])
+        with segment_col:
+            chosen_segment = st.selectbox("Saved segments", [""] + saved_segments, key="saved_segment_select")
+        with load_segment_col:
+            st.write("") # Spacer
+            st.write("") # Spacer
+            if st.button("📂 Use Segment", key="use_segment_button", disabled=not chosen_segment, use_container_width=True):
+                st.session_state.config['segment_expression'] = segment_library.get(chosen_segment)
+                st.session_state.pop('segment_expression_input', None) # Let the text area pick up the new value
+                st.rerun()
+        st.session_state.config['segment_expression'] = st.text_area(
+            "Send only to recipients matching (empty = everyone)",
+            value=st.session_state.config.get('segment_expression', ""),
+            key="segment_expression_input", height=70,
+            placeholder="Region == 'EU' and last_open > 90d",
+            help="Columns (backquote names with spaces), ==, !=, <, >, in (...), and/or/not, "
+                 "contains/startswith/endswith/domain/lower/missing/present(column). "
+                 f"Engagement from SendGrid events: {', '.join(ENGAGEMENT_FIELDS)}; "
+                 "`last_open > 90d` means last opened more than 90 days ago (or never)."
+        )
+        segment_expression = st.session_state.config['segment_expression'].strip()
+        segment_store = get_store(st.session_state)
+        if segment_expression and segment_store is not None:
+            try:
+                segment_started = time.perf_counter()
+                segment_keys = segment_store.segment_keys(
+                    segment_expression, segment_engagement(st.session_state.config.get('events_db') or DEFAULT_EVENTS_DB))
+                st.caption(f"{len(segment_keys)} of {len(segment_store)} recipients match "
+                           f"({(time.perf_counter() - segment_started) * 1000:.0f} ms).")
+            except SegmentError as e_segment:
+                st.error(str(e_segment))
+        if segment_expression:
+            segment_name_col, segment_save_col, segment_delete_col = st.columns([2, 1, 1])
+            with segment_name_col:
+                segment_name = st.text_input("Segment name", key="segment_name_input",
+                                             value=chosen_segment, placeholder="E.g., Lapsed EU readers")
+            with segment_save_col:
+                st.write("") # Spacer
+                st.write("") # Spacer
+                if st.button("💾 Save Segment", key="save_segment_button", disabled=not segment_name.strip(), use_container_width=True):
+                    try:
+                        segment_library.save(segment_name.strip(), segment_expression)
+                        st.success(f"Segment '{segment_name.strip()}' saved.")
+                    except SegmentError as e_segment:
+                        st.error(str(e_segment))
+            with segment_delete_col:
+                st.write("") # Spacer
+                st.write("") # Spacer
+                if st.button("🗑️ Delete Segment", key="delete_segment_button",
+                             disabled=segment_name.strip() not in saved_segments, use_container_width=True):
+                    segment_library.delete(segment_name.strip())
+                    st.rerun()
+
         st.subheader("Ready to Send?")
 
         if 'send_log' not in st.session_state:
@@ -1176,10 +1588,18 @@ import base64 # For encoding attachments for SendGrid
         col1, col2 = st.columns([1,3])
 
         with col1:
+            local_delivery = (not st.session_state.config.get('enable_sendgrid_tracking')
+                              and st.session_state.config.get('delivery_transport') in (SendmailTransport.name, PickupDirectoryTransport.name))
             send_button_disabled = not (
                 st.session_state.config.get('sender_email') and
-                st.session_state.config.get('email_password') and
+                (st.session_state.config.get('email_password') or local_delivery) and
                 (
+                    # Local MTA conditions (no login)
+                    (
+                        local_delivery and
+                        (st.session_state.config.get('delivery_transport') != PickupDirectoryTransport.name
+                         or st.session_state.config.get('pickup_dir'))
+                    ) or
                     # SMTP conditions
                     (
                         not st.session_state.config.get('enable_sendgrid_tracking') and
@@ -1203,7 +1623,13 @@ import base64 # For encoding attachments for SendGrid
             )
 
             if send_button_disabled:
-                if not st.session_state.config.get('enable_sendgrid_tracking'):
+                if local_delivery:
+                    if not st.session_state.config.get('sender_email'):
+                        st.warning("Sender email address (From address) is required.")
+                    if (st.session_state.config.get('delivery_transport') == PickupDirectoryTransport.name
+                            and not st.session_state.config.get('pickup_dir')):
+                        st.warning("Pickup directory is not set.")
+                elif not st.session_state.config.get('enable_sendgrid_tracking'):
                     if not (st.session_state.config.get('sender_email') and
                             st.session_state.config.get('email_password') and
                             st.session_state.config.get('smtp_server') and
@@ -1223,18 +1649,304 @@ import base64 # For encoding attachments for SendGrid
                     st.warning("Email subject or body is empty.")
 
 
+            # Delivery tuning: rendering is spread over all CPU cores, these control the network side
+            st.session_state.config['delivery_workers'] = st.number_input(
+                "Parallel connections",
+                min_value=1, max_value=32,
+                value=int(st.session_state.config.get('delivery_workers', DEFAULT_DELIVERY_WORKERS)),
+                key="delivery_workers_input",
+                help="Number of simultaneous SMTP connections / SendGrid requests."
+            )
+            st.session_state.config['pool_max_connections'] = st.number_input(
+                "Connections per login (whole server)",
+                min_value=1, max_value=64,
+                value=int(st.session_state.config.get('pool_max_connections', DEFAULT_MAX_CONNECTIONS)),
+                key="pool_max_connections_input",
+                help="Connections to one relay login are pooled across all sessions and campaign workers of this server. "
+                     "Concurrent campaigns split them fairly; idle ones are closed after a minute."
+            )
+            with st.expander("Timeouts and stalled connections"):
+                timeout_col1, timeout_col2, timeout_col3 = st.columns(3)
+                with timeout_col1:
+                    st.session_state.config['smtp_connect_timeout'] = st.number_input(
+                        "Connect timeout (s)", min_value=1.0,
+                        value=float(st.session_state.config.get('smtp_connect_timeout', DEFAULT_CONNECT_TIMEOUT)),
+                        key="smtp_connect_timeout_input")
+                with timeout_col2:
+                    st.session_state.config['smtp_command_timeout'] = st.number_input(
+                        "Command timeout (s)", min_value=1.0,
+                        value=float(st.session_state.config.get('smtp_command_timeout', DEFAULT_COMMAND_TIMEOUT)),
+                        key="smtp_command_timeout_input",
+                        help="Longest wait for any reply from the relay.")
+                with timeout_col3:
+                    st.session_state.config['smtp_data_timeout'] = st.number_input(
+                        "Data timeout (s)", min_value=1.0,
+                        value=float(st.session_state.config.get('smtp_data_timeout', DEFAULT_DATA_TIMEOUT)),
+                        key="smtp_data_timeout_input",
+                        help="Longest stall while sending a message's content and waiting for the relay to accept it.")
+                deadline_col, hedge_col, http_col = st.columns(3)
+                with deadline_col:
+                    st.session_state.config['message_deadline'] = st.number_input(
+                        "Per-message deadline (s, 0 = off)", min_value=0.0,
+                        value=float(st.session_state.config.get('message_deadline', 300.0)),
+                        key="message_deadline_input",
+                        help="A watchdog breaks off any send taking longer in total, even if the relay keeps trickling bytes. "
+                             "Messages the relay can't have yet are retried on another connection; others are reported failed.")
+                with hedge_col:
+                    st.session_state.config['hedge_after'] = st.number_input(
+                        "Retry slow sends after (s, 0 = off)", min_value=0.0,
+                        value=float(st.session_state.config.get('hedge_after', 0.0)),
+                        key="hedge_after_input",
+                        help="Breaks off a send that is still waiting on the relay before its data went out, and retries "
+                             "it on another connection. Cuts the slow tail without risking duplicates.")
+                with http_col:
+                    st.session_state.config['http_timeout'] = st.number_input(
+                        "SendGrid request timeout (s)", min_value=1.0,
+                        value=float(st.session_state.config.get('http_timeout', DEFAULT_HTTP_TIMEOUT)),
+                        key="http_timeout_input")
+            pools = [row for row in pool_stats() if row.get("max")]
+            if pools:
+                st.caption("Shared pools: " + "; ".join(
+                    f"{row['kind']} {row['in_use']} busy / {row['idle']} idle of {row['max']}"
+                    + (f", {row['campaigns']} campaign(s)" if row['campaigns'] else "") for row in pools))
+            st.session_state.config['send_rate_limit'] = st.number_input(
+                "Max send rate (emails/second, 0 = unlimited)",
+                min_value=0.0,
+                value=float(st.session_state.config.get('send_rate_limit', 10.0)),
+                key="send_rate_limit_input",
+                help="Keep this at or below your provider's sending limit."
+            )
+
+            spool_choice = st.radio(
+                "Delivery",
+                ["Send now", "Write to spool"],
+                index=1 if st.session_state.config.get('delivery_mode') == "spool" else 0,
+                key="delivery_mode_radio", horizontal=True,
+                help="A spool renders every message to files (for review, archiving or an MTA pickup directory); "
+                     "deliver it later with `python spool.py drain <directory> --config smtp.json`."
+            )
+            st.session_state.config['delivery_mode'] = "spool" if spool_choice == "Write to spool" else "send"
+            if st.session_state.config['delivery_mode'] == "spool":
+                st.session_state.config['spool_format'] = st.selectbox(
+                    "Spool format", SPOOL_FORMATS,
+                    index=SPOOL_FORMATS.index(st.session_state.config.get('spool_format', "maildir")),
+                    key="spool_format_select",
+                    help="maildir: one .eml per message in new/; eml: flat directory of .eml files; mbox: a single file."
+                )
+
+            st.markdown("**Bounces & suppression list**")
+            st.session_state.config['suppression_db'] = st.text_input(
+                "Suppression database", value=st.session_state.config.get('suppression_db', DEFAULT_SUPPRESSION_DB),
+                key="suppression_db_input"
+            )
+            st.session_state.config['skip_suppressed'] = st.checkbox(
+                "Skip suppressed addresses",
+                value=st.session_state.config.get('skip_suppressed', True),
+                key="skip_suppressed_checkbox",
+                help=f"Addresses that hard-bounced (or soft-bounced repeatedly in the last {SOFT_BOUNCE_WINDOW_DAYS} days) "
+                     "in earlier campaigns are not sent to."
+            )
+            bounce_mailbox = st.text_input(
+                "Bounce mailbox (mbox file or Maildir directory)", key="bounce_mailbox_input",
+                help="Delivery status notifications are read from here; for IMAP use `python bounces.py --imap ...`."
+            )
+            if st.button("Process bounces", key="process_bounces_button", disabled=not bounce_mailbox):
+                try:
+                    suppression_store = SuppressionStore(st.session_state.config['suppression_db'])
+                    try:
+                        with st.spinner("Reading bounce reports..."):
+                            bounce_messages = iter_maildir(bounce_mailbox) if os.path.isdir(bounce_mailbox) else iter_mbox(bounce_mailbox)
+                            bounce_stats = BounceProcessor(suppression_store).process(bounce_messages)
+                    finally:
+                        suppression_store.close()
+                    st.success(f"{bounce_stats['messages']} messages, {bounce_stats['reports']} bounce reports: "
+                               f"{bounce_stats['hard']} hard, {bounce_stats['soft']} soft ({bounce_stats['recorded']} new).")
+                except Exception as e_bounces:
+                    st.error(f"Could not process bounces: {e_bounces}")
+            if os.path.exists(st.session_state.config['suppression_db']):
+                try:
+                    suppression_store = SuppressionStore(st.session_state.config['suppression_db'])
+                    try:
+                        suppression_summary = suppression_store.summary()
+                    finally:
+                        suppression_store.close()
+                    st.caption(f"Suppressed: {suppression_summary['hard']} hard-bounced, {suppression_summary['soft_suppressed']} "
+                               f"repeatedly soft-bounced; {suppression_summary['soft_watch']} more with recent soft bounces.")
+                except Exception as e_suppression:
+                    st.caption(f"Could not read the suppression list: {e_suppression}")
+
+            st.markdown("**SendGrid tracking events**")
+            st.session_state.config['events_db'] = st.text_input(
+                "Events database", value=st.session_state.config.get('events_db', DEFAULT_EVENTS_DB),
+                key="events_db_input",
+                help="Written by the webhook receiver: `python sendgrid_events.py serve --public-key <verification key>` "
+                     "(add --suppression-db to suppress SendGrid bounces too)."
+            )
+            if os.path.exists(st.session_state.config['events_db']):
+                try:
+                    event_store = EventStore(st.session_state.config['events_db'])
+                    try:
+                        event_campaigns = event_store.campaigns()
+                        last_campaign_id = st.session_state.get('last_campaign_id')
+                        if event_campaigns:
+                            tracked_campaign = st.selectbox(
+                                "Campaign", event_campaigns,
+                                index=event_campaigns.index(last_campaign_id) if last_campaign_id in event_campaigns else 0,
+                                key="tracked_campaign_select"
+                            )
+                            rollup = event_store.rollup(tracked_campaign) # Precomputed per event type; no scan
+                            st.dataframe(pd.DataFrame(
+                                [{"Event": event, "Total": counts["total"], "Recipients": counts["recipients"],
+                                  "Last": time.strftime("%Y-%m-%d %H:%M", time.localtime(counts["last_at"])) if counts["last_at"] else ""}
+                                 for event, counts in sorted(rollup.items())]
+                            ), hide_index=True)
+                        else:
+                            st.caption("No events received yet.")
+                    finally:
+                        event_store.close()
+                except Exception as e_events:
+                    st.caption(f"Could not read tracking events: {e_events}")
+
+            st.session_state.config['use_campaign_workers'] = st.checkbox(
+                "Send with campaign workers",
+                value=st.session_state.config.get('use_campaign_workers', False),
+                key="use_campaign_workers_checkbox",
+                help="Queue the campaign in shards for `campaign_worker.py` processes (on this or other machines) instead of sending from this browser session."
+            )
+            if st.session_state.config['use_campaign_workers']:
+                st.session_state.config['work_queue_url'] = st.text_input(
+                    "Work queue",
+                    value=st.session_state.config.get('work_queue_url', DEFAULT_WORK_QUEUE_URL),
+                    key="work_queue_url_input"
+                )
+                st.session_state.config['run_background_worker'] = st.checkbox(
+                    "Run a campaign worker inside the app",
+                    value=st.session_state.config.get('run_background_worker', True),
+                    key="run_background_worker_checkbox",
+                    help="Delivers queued and scheduled campaigns from the app's server process, with no browser tab open. "
+                         "Stops with the app; `campaign_worker.py` processes keep going independently."
+                )
+                if st.session_state.config['run_background_worker']:
+                    try:
+                        start_background_worker(st.session_state.config['work_queue_url'])
+                    except Exception as e_worker:
+                        st.error(f"Could not start the in-app campaign worker: {e_worker}")
+                st.session_state.config['schedule_enabled'] = st.checkbox(
+                    "🗓️ Schedule this campaign",
+                    value=st.session_state.config.get('schedule_enabled', False),
+                    key="schedule_enabled_checkbox",
+                    help="Start later, send only inside allowed local hours per recipient timezone, and spread the list over a window."
+                )
+                if st.session_state.config['schedule_enabled']:
+                    schedule_date_col, schedule_time_col, schedule_tz_col = st.columns(3)
+                    with schedule_date_col:
+                        st.session_state.config['schedule_date'] = st.date_input(
+                            "Start date", value=pd.Timestamp(st.session_state.config.get('schedule_date') or pd.Timestamp.now()).date(),
+                            key="schedule_date_input"
+                        ).isoformat()
+                    with schedule_time_col:
+                        st.session_state.config['schedule_time'] = st.time_input(
+                            "Start time", value=pd.Timestamp(st.session_state.config.get('schedule_time') or "09:00").time(),
+                            key="schedule_time_input"
+                        ).strftime("%H:%M")
+                    with schedule_tz_col:
+                        st.session_state.config['schedule_default_tz'] = st.text_input(
+                            "Default timezone", value=st.session_state.config.get('schedule_default_tz', "UTC"),
+                            key="schedule_default_tz_input",
+                            help="IANA name (e.g. Europe/Berlin). The start time is in this zone, and recipients without a known timezone use it."
+                        )
+                    recipient_columns = list(st.session_state.recipient_df.columns) if st.session_state.recipient_df is not None else []
+                    tz_options = ["(none)"] + recipient_columns
+                    saved_tz_column = st.session_state.config.get('schedule_tz_column') or next(
+                        (column for column in recipient_columns if column.lower() in ("timezone", "time zone", "tz")), "(none)")
+                    st.session_state.config['schedule_tz_column'] = st.selectbox(
+                        "Recipient timezone column", tz_options,
+                        index=tz_options.index(saved_tz_column) if saved_tz_column in tz_options else 0,
+                        key="schedule_tz_column_select"
+                    )
+                    schedule_hours = st.slider(
+                        "Allowed local hours", 0, 24,
+                        value=tuple(st.session_state.config.get('schedule_hours', (9, 17))),
+                        key="schedule_hours_slider"
+                    )
+                    st.session_state.config['schedule_hours'] = list(schedule_hours)
+                    weekday_names = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+                    st.session_state.config['schedule_weekdays'] = [weekday_names.index(day) for day in st.multiselect(
+                        "Allowed days", weekday_names,
+                        default=[weekday_names[day] for day in st.session_state.config.get('schedule_weekdays', ALL_DAYS)],
+                        key="schedule_weekdays_select"
+                    )]
+                    st.session_state.config['schedule_spread_hours'] = st.number_input(
+                        "Spread the list over (hours, 0 = as soon as allowed)", min_value=0.0, step=1.0,
+                        value=float(st.session_state.config.get('schedule_spread_hours', 0.0)),
+                        key="schedule_spread_hours_input"
+                    )
+                    if st.session_state.recipient_df is not None and len(st.session_state.recipient_df):
+                        try:
+                            send_times, tz_buckets, unknown_tz = plan_send_times(st.session_state.recipient_df,
+                                                                                 campaign_schedule(st.session_state.config))
+                            plan = schedule_summary(send_times, tz_buckets, unknown_tz)
+                            st.caption(f"First send {time.strftime('%Y-%m-%d %H:%M', time.localtime(plan['first']))}, "
+                                       f"last {time.strftime('%Y-%m-%d %H:%M', time.localtime(plan['last']))} (server time); "
+                                       f"busiest hour {plan['peak_per_hour']} emails; {len(tz_buckets)} timezone(s)"
+                                       + (f", {unknown_tz} recipients with an unknown timezone use the default" if unknown_tz else "") + ".")
+                        except Exception as e_schedule:
+                            st.error(f"Schedule: {e_schedule}")
+
+            st.session_state.config['profile_run'] = st.checkbox(
+                "🔬 Profile this run",
+                value=st.session_state.config.get('profile_run', False),
+                key="profile_run_checkbox",
+                help="Profiles rendering and delivery for the first messages of the campaign and writes .prof, collapsed-stack and allocation reports."
+            )
+            if st.session_state.config['profile_run']:
+                st.session_state.config['profile_max_messages'] = st.number_input(
+                    "Profile first N messages", min_value=10,
+                    value=int(st.session_state.config.get('profile_max_messages', 500)),
+                    key="profile_max_messages_input"
+                )
+                st.session_state.config['profile_max_seconds'] = st.number_input(
+                    "...or at most this many seconds", min_value=1.0,
+                    value=float(st.session_state.config.get('profile_max_seconds', 60.0)),
+                    key="profile_max_seconds_input"
+                )
+                st.session_state.config['profile_memory'] = st.checkbox(
+                    "Include memory allocations (tracemalloc, slower)",
+                    value=st.session_state.config.get('profile_memory', False),
+                    key="profile_memory_checkbox"
+                )
+
             if st.button("🚀 Send All Emails", disabled=send_button_disabled, type="primary"):
                 st.session_state.send_log = ["Starting email sending process..."]
 
                 config = st.session_state.config
-                df = st.session_state.recipient_df
+                df = apply_variants(st.session_state.recipient_df, st.session_state.get('ai_variants')) # AI_Subject / AI_Intro per segment
                 subject_template = st.session_state.email_subject
                 body_template = st.session_state.email_body
+                # Compiles Jinja templates once here; the render processes load them from the bytecode cache
+                template_error = check_templates(st.session_state.template_syntax, subject_template, body_template, df.columns)
+
+                segment_error = None
+                if config.get('segment_expression', "").strip() and 'Email' in df.columns:
+                    try:
+                        segment_keys = get_store(st.session_state).segment_keys(
+                            config['segment_expression'], segment_engagement(config.get('events_db') or DEFAULT_EVENTS_DB))
+                        st.session_state.send_log.append(f"Segment: {len(segment_keys)} of {len(df)} recipients match "
+                                                         f"'{config['segment_expression'].strip()}'.")
+                        df = df.loc[segment_keys]
+                    except SegmentError as e_segment:
+                        segment_error = f"Segment: {e_segment}"
 
                 if 'Email' not in df.columns:
                     st.error("Critical: 'Email' column not found in recipient data.")
                     st.session_state.send_log.append("Error: 'Email' column not found.")
                     # No rerun here, let the log show
+                elif segment_error:
+                    st.error(segment_error)
+                    st.session_state.send_log.append(f"Error: {segment_error}")
+                elif template_error:
+                    st.error(template_error)
+                    st.session_state.send_log.append(f"Error: {template_error}")
                 else:
                     total_emails = len(df)
                     sent_count = 0
@@ -1243,153 +1955,96 @@ import base64 # For encoding attachments for SendGrid
                     progress_bar = st.progress(0)
                     status_text = st.empty()
 
-                    use_sendgrid = config.get('enable_sendgrid_tracking') and config.get('sendgrid_api_key')
-                    sender_email_address = config.get('sender_email') # Used by both methods
-
-                    if use_sendgrid:
-                        st.session_state.send_log.append("Attempting to send emails via SendGrid...")
-                        sg = SendGridAPIClient(api_key=config['sendgrid_api_key'])
-                        from_email_obj = From(sender_email_address) # Consider adding a name field for sender later
-
-                        for i, row in df.iterrows():
-                            recipient_email = row.get('Email')
-                            if not recipient_email or pd.isna(recipient_email) or not is_valid_email(recipient_email):
-                                log_msg = f"Skipping row {i+1}: Invalid or missing email address '{recipient_email}'."
-                                st.session_state.send_log.append(log_msg)
-                                failed_count += 1
-                                progress_bar.progress((i + 1) / total_emails)
-                                status_text.text(f"Progress: {i+1}/{total_emails} (Skipped: {failed_count})")
-                                continue
-
-                            current_subject = subject_template
-                            current_body = body_template
-                            for col_name in df.columns:
-                                placeholder = f"{{{col_name}}}"
-                                replacement_value = str(row.get(col_name, '')) if pd.notna(row.get(col_name)) else ""
-                                current_subject = current_subject.replace(placeholder, replacement_value)
-                                current_body = current_body.replace(placeholder, replacement_value)
-
-                            message = Mail(
-                                from_email=from_email_obj,
-                                to_emails=To(recipient_email),
-                                subject=Subject(current_subject),
-                                html_content=HtmlContent(current_body)
-                            )
-
-                            # Add attachments for SendGrid
-                            if 'attachments' in st.session_state and st.session_state.attachments:
-                                for attachment_data in st.session_state.attachments:
-                                    try:
-                                        encoded_file = base64.b64encode(attachment_data["data"]).decode()
-                                        attachment = Attachment(
-                                            FileContent(encoded_file),
-                                            FileName(attachment_data["name"]),
-                                            FileType(mimetypes.guess_type(attachment_data["name"])[0] or 'application/octet-stream'),
-                                            Disposition('attachment')
-                                            # ContentId can be added if embedding images
-                                        )
-                                        message.attachment = attachment # Appends to internal list
-                                        st.session_state.send_log.append(f"Prepared attachment {attachment_data['name']} for SendGrid email to {recipient_email}")
-                                    except Exception as e_attach_sg:
-                                        st.session_state.send_log.append(f"Error preparing SendGrid attachment {attachment_data.get('name', 'unknown file')} for {recipient_email}: {e_attach_sg}")
-
-                            # Configure tracking settings (relies on SendGrid account settings primarily)
-                            # Can be made more granular if needed by uncommenting and customizing below
-                            tracking_settings = TrackingSettings()
-                            tracking_settings.open_tracking = OpenTracking(enable=True) # Let SendGrid account settings dictate sub_tag
-                            tracking_settings.click_tracking = ClickTracking(enable=True, enable_text=True)
-                            message.tracking_settings = tracking_settings
-
+                    spool = None
+                    if config.get('delivery_mode') == "spool":
+                        spool = Spool(os.path.join(CAMPAIGN_OUTPUT_DIR, time.strftime("spool-%Y%m%d-%H%M%S")),
+                                      config.get('spool_format', "maildir"))
+                        transport_class = SpoolTransport
+                        transport_factory = lambda: SpoolTransport(spool)
+                    else:
+                        transport_class = transport_for(config)
+                        transport_factory = None # Pooled, once the campaign id is known
+                    suppressed = None
+                    suppression_db = config.get('suppression_db') or DEFAULT_SUPPRESSION_DB
+                    if config.get('skip_suppressed', True) and os.path.exists(suppression_db):
+                        suppression_store = SuppressionStore(suppression_db)
+                        try:
+                            suppressed = suppression_store.suppressed(df['Email'])
+                        finally:
+                            suppression_store.close()
+                        if suppressed:
+                            st.session_state.send_log.append(f"{len(suppressed)} recipient(s) are on the suppression list and will be skipped.")
+                    campaign = build_campaign(config, transport_class.name, subject_template, body_template,
+                                              df.columns, st.session_state.get('attachments'),
+                                              template_syntax=st.session_state.template_syntax,
+                                              inline_images=st.session_state.get('inline_images'),
+                                              suppressed=suppressed)
+                    st.session_state.last_campaign_id = campaign["campaign_id"]
+                    if transport_factory is None:
+                        # Connections come from the server-wide pool for this login, shared fairly with other sessions' campaigns
+                        transport_factory = pooled_transport_factory(config, campaign["campaign_id"], transport_class)
+                    if config.get('use_campaign_workers') and spool is None:
+                        # Coordinator mode: shard the campaign onto the work queue for campaign_worker.py processes
+                        queue_url = config.get('work_queue_url') or DEFAULT_WORK_QUEUE_URL
+                        try:
+                            work_queue = open_queue(queue_url)
                             try:
-                                response = sg.send(message)
-                                if 200 <= response.status_code < 300: # Typically 202 Accepted
-                                    log_msg = f"SendGrid: Email to {recipient_email} accepted (Row {i+1}). Status: {response.status_code}"
-                                    sent_count += 1
-                                else:
-                                    log_msg = f"SendGrid: Failed to send to {recipient_email} (Row {i+1}). Status: {response.status_code}. Body: {response.body}"
-                                    failed_count += 1
-                                st.session_state.send_log.append(log_msg)
-                            except Exception as e_send_sg:
-                                log_msg = f"SendGrid: Exception sending to {recipient_email} (Row {i+1}): {e_send_sg}"
-                                st.session_state.send_log.append(log_msg)
-                                failed_count += 1
-
-                            progress_bar.progress((i + 1) / total_emails)
-                            status_text.text(f"Progress: {i+1}/{total_emails} (Sent: {sent_count}, Failed: {failed_count})")
-                            time.sleep(0.05) # Small delay for API politeness with SendGrid too
-
-                        st.session_state.send_log.append("SendGrid sending process finished.")
+                                campaign_id = enqueue_campaign(work_queue, campaign, config, df,
+                                                               rate_limit=config.get('send_rate_limit') or None,
+                                                               schedule=campaign_schedule(config) if config.get('schedule_enabled') else None)
+                            finally:
+                                work_queue.close()
+                            st.session_state.queued_campaign = {"queue_url": queue_url, "campaign_id": campaign_id}
+                            st.session_state.send_log.append(f"Queued campaign {campaign_id} ({total_emails} recipients) on {queue_url}"
+                                                             + (" on a schedule" if config.get('schedule_enabled') else "") + ". "
+                                                             + ("The in-app worker is delivering it; more workers: "
+                                                                if background_worker_running(queue_url) else "Start workers with: ")
+                                                             + f"python campaign_worker.py --queue {queue_url}")
+                            status_text.text(f"Campaign {campaign_id} queued for campaign workers.")
+                        except Exception as e_queue:
+                            st.error(f"Could not queue campaign: {e_queue}")
+                            st.session_state.send_log.append(f"Error: could not queue campaign - {e_queue}")
+                    else:
+                        pipeline = SendPipeline(
+                            campaign,
+                            transport_factory,
+                            delivery_workers=int(config.get('delivery_workers', DEFAULT_DELIVERY_WORKERS)),
+                            rate_limit=(config.get('send_rate_limit') or None) if spool is None else None,
+                            **(delivery_deadlines(config) if spool is None else {}),
+                            profile=profile_settings(
+                                os.path.join(CAMPAIGN_OUTPUT_DIR, time.strftime("%Y%m%d-%H%M%S"), "profile"),
+                                int(config.get('profile_max_messages', 500)),
+                                float(config.get('profile_max_seconds', 60.0)),
+                                bool(config.get('profile_memory'))
+                            ) if config.get('profile_run') else None
+                        )
+                        st.session_state.send_log.append(f"Attempting to send emails via {transport_class.name} "
+                                                         f"({pipeline.render_processes} render processes, {pipeline.delivery_workers} delivery workers)...")
 
-                    else: # Use Custom SMTP
-                        st.session_state.send_log.append("Attempting to send emails via Custom SMTP...")
-                        server = None
+                        done_count = 0
+                        last_progress_update = 0.0
                         try:
-                            if config['smtp_security'] == "SSL":
-                                server = smtplib.SMTP_SSL(config['smtp_server'], config['smtp_port'])
-                            else: # TLS or None
-                                server = smtplib.SMTP(config['smtp_server'], config['smtp_port'])
-                                if config['smtp_security'] == "TLS":
-                                    server.starttls()
-
-                            server.login(sender_email_address, config['email_password'])
-                            st.session_state.send_log.append(f"Logged in to SMTP server {config['smtp_server']}.")
-
-                            for i, row in df.iterrows():
-                                recipient_email = row.get('Email')
-                                if not recipient_email or pd.isna(recipient_email) or not is_valid_email(recipient_email):
-                                    log_msg = f"Skipping row {i+1}: Invalid or missing email address '{recipient_email}'."
-                                    st.session_state.send_log.append(log_msg)
+                            for result in pipeline.run(iter_row_chunks(df)):
+                                done_count += 1
+                                if result.status == "skipped":
+                                    log_msg = f"Skipping row {result.row_number}: {result.detail}"
                                     failed_count += 1
-                                    progress_bar.progress((i + 1) / total_emails)
-                                    status_text.text(f"Progress: {i+1}/{total_emails} (Skipped: {failed_count})")
-                                    continue
-
-                                try:
-                                    msg = MIMEMultipart()
-                                    msg['From'] = sender_email_address
-                                    msg['To'] = recipient_email
-
-                                    current_subject = subject_template
-                                    current_body = body_template
-                                    for col_name in df.columns:
-                                        placeholder = f"{{{col_name}}}"
-                                        replacement_value = str(row.get(col_name, '')) if pd.notna(row.get(col_name)) else ""
-                                        current_subject = current_subject.replace(placeholder, replacement_value)
-                                        current_body = current_body.replace(placeholder, replacement_value)
-
-                                    msg['Subject'] = current_subject
-                                    msg.attach(MIMEText(current_body, 'html'))
-
-                                    if 'attachments' in st.session_state and st.session_state.attachments:
-                                        for attachment_data in st.session_state.attachments:
-                                            try:
-                                                ctype, encoding = mimetypes.guess_type(attachment_data["name"])
-                                                if ctype is None or encoding is not None:
-                                                    ctype = 'application/octet-stream'
-                                                maintype, subtype = ctype.split('/', 1)
-                                                part = MIMEBase(maintype, subtype)
-                                                part.set_payload(attachment_data["data"])
-                                                encoders.encode_base64(part)
-                                                part.add_header('Content-Disposition', f'attachment; filename="{attachment_data["name"]}"')
-                                                msg.attach(part)
-                                            except Exception as e_attach:
-                                                st.session_state.send_log.append(f"Error attaching {attachment_data.get('name', 'N/A')} for SMTP: {e_attach}")
-
-                                    server.sendmail(sender_email_address, recipient_email, msg.as_string())
-                                    log_msg = f"SMTP: Successfully sent email to {recipient_email} (Row {i+1})"
-                                    sent_count +=1
-                                except Exception as e_send:
-                                    log_msg = f"SMTP: Failed to send to {recipient_email} (Row {i+1}): {e_send}"
+                                elif result.status == "sent":
+                                    log_msg = f"{transport_class.name}: Email to {result.recipient} (Row {result.row_number}): {result.detail}"
+                                    sent_count += 1
+                                else:
+                                    log_msg = f"{transport_class.name}: Failed to send to {result.recipient} (Row {result.row_number}): {result.detail}"
                                     failed_count += 1
                                 st.session_state.send_log.append(log_msg)
 
-                                progress_bar.progress((i + 1) / total_emails)
-                                status_text.text(f"Progress: {i+1}/{total_emails} (Sent: {sent_count}, Failed: {failed_count})")
-                                time.sleep(0.1)
+                                # Throttle UI updates; each one is a round trip to the browser
+                                now = time.monotonic()
+                                if now - last_progress_update > 0.1 or done_count == total_emails:
+                                    last_progress_update = now
+                                    progress_bar.progress(min(done_count / total_emails, 1.0))
+                                    status_text.text(f"Progress: {done_count}/{total_emails} (Sent: {sent_count}, Failed: {failed_count})")
 
-                            if server:
-                                server.quit()
-                            st.session_state.send_log.append("SMTP server connection closed.")
+                            st.session_state.send_log.append(f"{transport_class.name} sending process finished.")
 
                         except smtplib.SMTPAuthenticationError:
                             st.error("SMTP Authentication Error. Check email/password and app-specific password settings.")
@@ -1397,23 +2052,63 @@ import base64 # For encoding attachments for SendGrid
                         except smtplib.SMTPConnectError:
                             st.error(f"SMTP Connection Error for {config['smtp_server']}:{config['smtp_port']}.")
                             st.session_state.send_log.append("Error: SMTP Connection Failed.")
-                        except Exception as e_smtp_setup:
-                            st.error(f"An SMTP setup error occurred: {e_smtp_setup}")
-                            st.session_state.send_log.append(f"Error: SMTP problem - {e_smtp_setup}")
-                        finally:
-                            if server:
-                                try: server.quit()
-                                except: pass
-
-                    # Common finalization for both methods
-                    final_summary = f"Email sending process finished. Total: {total_emails}, Sent: {sent_count}, Failed/Skipped: {failed_count}."
-                    st.session_state.send_log.append(final_summary)
-                    status_text.text(final_summary)
+                        except Exception as e_setup:
+                            st.error(f"A {transport_class.name} setup error occurred: {e_setup}")
+                            st.session_state.send_log.append(f"Error: {transport_class.name} problem - {e_setup}")
+
+                        if spool is not None:
+                            spool.close()
+                            st.session_state.send_log.append(
+                                f"Spooled {spool.written} message(s) to {spool.path} ({spool.format}). "
+                                f"Deliver with: python spool.py drain {spool.path} --config smtp.json")
+                        if pipeline.profile_dir:
+                            st.session_state.last_profile_dir = pipeline.profile_dir
+                            st.session_state.send_log.append(f"Profile written to {pipeline.profile_dir} (campaign.prof, campaign.collapsed).")
+                        encoding_report = pipeline.encoding_report()
+                        if encoding_report["baseline_bytes"]:
+                            st.session_state.send_log.append(
+                                f"Body encoding: {encoding_report['encoding']}; {encoding_report['body_bytes']:,} body bytes on the wire, "
+                                f"{encoding_report['saved_bytes']:,} fewer than the default encoding "
+                                f"({encoding_report['saved_bytes'] / encoding_report['baseline_bytes']:.0%})."
+                            )
+
+                        # Common finalization for both methods
+                        final_summary = f"Email sending process finished. Total: {total_emails}, Sent: {sent_count}, Failed/Skipped: {failed_count}."
+                        st.session_state.send_log.append(final_summary)
+                        status_text.text(final_summary)
                         st.balloons() # Fun little success indicator
                         # No st.rerun() here, we want the log to persist.
 
         with col2:
             st.subheader("Sending Progress & Log")
+            if st.session_state.get('queued_campaign'):
+                queued = st.session_state.queued_campaign
+                try:
+                    work_queue = open_queue(queued["queue_url"])
+                    try:
+                        shard_counts = work_queue.progress(queued["campaign_id"])
+                        delivery_counts = work_queue.ledger.summary(queued["campaign_id"])
+                        next_due = work_queue.next_due(queued["campaign_id"])
+                    finally:
+                        work_queue.close()
+                    st.caption(f"Campaign {queued['campaign_id']} - shards: "
+                               + ", ".join(f"{status} {count}" for status, count in sorted(shard_counts.items()))
+                               + " | recipients: "
+                               + (", ".join(f"{status} {count}" for status, count in sorted(delivery_counts.items())) or "none reported yet")
+                               + (f" | next scheduled shard at {time.strftime('%Y-%m-%d %H:%M', time.localtime(next_due))}" if next_due else ""))
+                except Exception as e_status:
+                    st.caption(f"Could not read campaign status: {e_status}")
+                refresh_col, cancel_col = st.columns(2)
+                with refresh_col:
+                    st.button("🔄 Refresh campaign status", key="refresh_queued_campaign_button")
+                with cancel_col:
+                    if st.button("⛔ Cancel unsent shards", key="cancel_queued_campaign_button"):
+                        work_queue = open_queue(queued["queue_url"])
+                        try:
+                            cancelled = work_queue.cancel(queued["campaign_id"])
+                        finally:
+                            work_queue.close()
+                        st.session_state.send_log.append(f"Cancelled {cancelled} shard(s) of campaign {queued['campaign_id']} not yet claimed by a worker.")
             log_display = st.text_area(
                 "Log:",
                 value="\n".join(st.session_state.send_log),
@@ -1422,6 +2117,28 @@ import base64 # For encoding attachments for SendGrid
                 disabled=True
             )
 
+            if st.session_state.get('last_profile_dir'):
+                with st.expander("🔬 Last Run Profile", expanded=False):
+                    profile_dir = st.session_state.last_profile_dir
+                    st.caption(f"Reports in `{profile_dir}`: open `campaign.prof` with snakeviz or `python -m pstats`, "
+                               "feed `campaign.collapsed` to flamegraph.pl or speedscope.")
+                    hot_functions = top_functions(profile_dir)
+                    if hot_functions:
+                        st.dataframe(pd.DataFrame(hot_functions), use_container_width=True)
+                    allocations_path = os.path.join(profile_dir, "top_allocations.txt")
+                    if os.path.exists(allocations_path):
+                        with open(allocations_path, encoding="utf-8") as f:
+                            st.text(f.read())
+
+            with st.expander("📈 Pipeline Metrics", expanded=False):
+                metric_rows = metrics.REGISTRY.summary()
+                if metric_rows:
+                    st.dataframe(pd.DataFrame(metric_rows), use_container_width=True)
+                else:
+                    st.caption("No messages processed yet.")
+                if st.session_state.get('metrics_endpoint'):
+                    st.caption(f"Prometheus endpoint: {st.session_state.metrics_endpoint}")
+
 def show_landing_page():
     st.header("Welcome to the Mass Email Sender Deluxe!")
     # Using a more generic and appealing image if possible, or keeping the current one.
@@ -0,0 +1,288 @@
+"""Bounce processing: delivery status notifications -> suppression store.
+
+    python bounces.py --mbox /var/mail/bounces
+    python bounces.py --maildir ~/Maildir/.Bounces
+    python bounces.py --imap localhost --imap-port 143 --no-ssl --user bounces --folder INBOX
+
+Mailboxes are streamed one message at a time: an mbox is scanned line by
+line, a Maildir with os.scandir, an IMAP folder (any server, e.g. a local
+Dovecot) is fetched in batches by UID. Only the headers of each message are
+parsed up front; for a multipart/report, the delivery-status section is cut
+out of the raw bytes by its boundary (and decoded, if it's base64 or
+quoted-printable) and parsed on its own, skipping the returned original
+message (the full MIME parse is the fallback). Each RFC 3464 report (or RFC
+6533 global report) yields one Bounce per failed recipient, and bounces go
+to the store in batched transactions, so memory stays flat however many DSNs
+the mailbox holds.
+
+Classification: a permanent failure (5.x.x) that is about the address - bad
+mailbox or domain (5.1.x), disabled mailbox (5.2.1), unroutable (5.4.4), or
+a generic 5.x.x whose diagnostic says the user is unknown - is hard. Other
+permanent failures (mailbox full, message too big, policy/spam blocks) and
+transient ones (4.x.x) are soft. Delay notices (Action: delayed) aren't
+bounces: the MTA is still retrying and may well deliver the message.
+"""
+import argparse
+import base64
+import binascii
+import email
+import email.utils
+import hashlib
+import imaplib
+import os
+import quopri
+import re
+from collections import namedtuple
+from email import errors
+from email.parser import BytesParser
+from email.policy import compat32
+
+from metrics import BOUNCES
+from suppression import DEFAULT_SUPPRESSION_DB, HARD, SOFT, SuppressionStore
+
+Bounce = namedtuple("Bounce", "message_id email kind status diagnostic arrived")
+
+DEFAULT_BATCH_SIZE = 500
+IMAP_FETCH_BATCH = 100
+
+_HARD_STATUSES = ("5.1.", "5.2.1", "5.4.4")
+_UNKNOWN_USER_RE = re.compile(
+    r"user unknown|unknown user|no such (user|mailbox|recipient)|does not exist|invalid (recipient|mailbox|address)"
+    r"|mailbox (unavailable|not found)|recipient address rejected", re.IGNORECASE)
+_STATUS_RE = re.compile(r"\b([245])\.(\d{1,3})\.(\d{1,3})\b")
+_QUOTED_FROM_RE = re.compile(rb"^>(>*From )")
+_STATUS_TYPES = ("message/delivery-status", "message/global-delivery-status", "text/delivery-status")
+_STATUS_SECTION_RE = re.compile(rb"^content-type:[ \t]*(?:message|text)/(?:global-)?delivery-status", re.IGNORECASE | re.MULTILINE)
+_ENCODED_SECTION_RE = re.compile(rb"^content-transfer-encoding:[ \t]*(base64|quoted-printable)", re.IGNORECASE | re.MULTILINE)
+_BLANK_LINE_RE = re.compile(rb"\r?\n\r?\n")
+
+_header_parser = BytesParser(policy=compat32)
+
+
+def classify(action, status, diagnostic=""):
+    """HARD, SOFT, or None for recipients that weren't bounced (delivered, relayed, expanded, still being retried)."""
+    action = (action or "").strip().lower()
+    if action != "failed":
+        return None
+    if status.startswith("4."):
+        return SOFT
+    if status.startswith(_HARD_STATUSES):
+        return HARD
+    if status in ("", "5.0.0") or not status.startswith("5."):
+        # No specific code; the diagnostic text is all there is to go on
+        return HARD if _UNKNOWN_USER_RE.search(diagnostic or "") else SOFT
+    return SOFT
+
+
+def _address(field):
+    # "rfc822; user@example.com" (the address type is optional in practice)
+    value = (field or "").split(";", 1)[-1].strip()
+    return email.utils.parseaddr(value)[1] or value.strip("<>")
+
+
+def _timestamp(value):
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp() if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _split_blocks(text):
+    return [email.message_from_string(block) for block in re.split(r"\r?\n\s*\r?\n", text or "") if block.strip()]
+
+
+def _decode(body, encoding):
+    # body: bytes in a base64 or quoted-printable transfer encoding
+    if encoding.lower() == "base64":
+        try:
+            return base64.b64decode(body) # Line breaks and other stray characters are skipped
+        except binascii.Error:
+            return b""
+    return quopri.decodestring(body)
+
+
+def _block_text(block):
+    # A parsed block back to its source text; as_string() would put a blank line before any body, even
+    # where the source had none (an encoded line that isn't a header just starts the body)
+    body = block.get_payload()
+    text = "".join(f"{name}: {value}\n" for name, value in block.raw_items())
+    if not isinstance(body, str) or not body:
+        return text
+    separated = not any(isinstance(defect, errors.MissingHeaderBodySeparatorDefect) for defect in block.defects)
+    return text + ("\n" if separated and text else "") + body
+
+
+def _status_blocks(part):
+    payload = part.get_payload()
+    encoding = (part.get("Content-Transfer-Encoding") or "").strip().lower()
+    encoded = encoding in ("base64", "quoted-printable")
+    if not isinstance(payload, list):
+        # text/delivery-status (mislabeled by some generators): split the blocks by hand
+        return _split_blocks((part.get_payload(decode=True) or b"").decode("utf-8", "replace") if encoded else payload)
+    if part.get_content_type() == "message/delivery-status" and not encoded:
+        return payload # The email package parses message/delivery-status into header blocks
+    # Parsed without decoding first, or (global-delivery-status) as one enclosed message: back to text
+    text = "\n".join(_block_text(block) for block in payload)
+    if encoded:
+        text = _decode(text.encode("ascii", "replace"), encoding).decode("utf-8", "replace")
+    return _split_blocks(text)
+
+
+def delivery_status_text(raw, boundary):
+    """The delivery-status section of a raw multipart/report, or None if it can't be cut out directly."""
+    for section in raw.split(b"--" + boundary.encode("ascii", "replace"))[1:]:
+        head_and_body = _BLANK_LINE_RE.split(section, 1)
+        if len(head_and_body) == 2 and _STATUS_SECTION_RE.search(head_and_body[0]):
+            encoded = _ENCODED_SECTION_RE.search(head_and_body[0])
+            body = _decode(head_and_body[1], encoded.group(1).decode()) if encoded else head_and_body[1]
+            return body.decode("utf-8", "replace")
+    return None
+
+
+def parse_dsn(message, message_id=None):
+    """Bounces reported by one message; empty if it isn't a delivery status notification."""
+    if message.get_content_type() != "multipart/report":
+        return []
+    blocks = next((_status_blocks(part) for part in message.walk()
+                   if part.get_content_type() in _STATUS_TYPES), None)
+    return bounces_from_blocks(blocks, message, message_id)
+
+
+def bounces_from_blocks(blocks, message, message_id=None):
+    """Bounces from the header blocks of a delivery-status part; message supplies Message-ID and Date."""
+    if not blocks:
+        return []
+    message_id = message_id or message.get("Message-ID", "").strip()
+    arrived = _timestamp(blocks[0].get("Arrival-Date")) or _timestamp(message.get("Date"))
+    bounces = []
+    for block in blocks[1:]: # The first block describes the whole report
+        recipient = _address(block.get("Final-Recipient") or block.get("Original-Recipient"))
+        if not recipient:
+            continue
+        diagnostic = " ".join((block.get("Diagnostic-Code") or "").split(";", 1)[-1].split())
+        status_match = _STATUS_RE.search(block.get("Status") or "") or _STATUS_RE.search(diagnostic)
+        status = ".".join(status_match.groups()) if status_match else ""
+        kind = classify(block.get("Action"), status, diagnostic)
+        if kind is not None:
+            bounces.append(Bounce(message_id, recipient, kind, status, diagnostic[:500], arrived))
+    return bounces
+
+
+def iter_mbox(path):
+    """Raw messages from an mbox file, read line by line (mailbox.mbox would index the whole file first)."""
+    with open(path, "rb") as f:
+        lines = []
+        previous_blank = True
+        for line in f:
+            if previous_blank and line.startswith(b"From "):
+                if lines:
+                    yield b"".join(lines)
+                lines = []
+            else:
+                lines.append(_QUOTED_FROM_RE.sub(rb"\1", line) if line.startswith(b">") else line)
+            previous_blank = line in (b"\n", b"\r\n")
+        if lines:
+            yield b"".join(lines)
+
+
+def iter_maildir(path):
+    for sub_dir in ("new", "cur"):
+        directory = os.path.join(path, sub_dir)
+        if not os.path.isdir(directory):
+            continue
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.startswith("."):
+                    with open(entry.path, "rb") as f:
+                        yield f.read()
+
+
+def iter_imap(host, user, password, folder="INBOX", port=None, use_ssl=True, batch_size=IMAP_FETCH_BATCH):
+    """Raw messages from an IMAP folder, fetched in UID batches without marking them seen."""
+    imap = imaplib.IMAP4_SSL(host, port or 993) if use_ssl else imaplib.IMAP4(host, port or 143)
+    try:
+        imap.login(user, password)
+        imap.select(folder, readonly=True)
+        _, data = imap.uid("SEARCH", None, "ALL")
+        uids = data[0].split()
+        for start in range(0, len(uids), batch_size):
+            _, fetched = imap.uid("FETCH", b",".join(uids[start:start + batch_size]), "(BODY.PEEK[])")
+            for item in fetched:
+                if isinstance(item, tuple):
+                    yield item[1]
+    finally:
+        try: imap.logout()
+        except Exception: pass
+
+
+class BounceProcessor:
+    def __init__(self, store, batch_size=DEFAULT_BATCH_SIZE):
+        self.store = store
+        self.batch_size = batch_size
+
+    def process(self, raw_messages):
+        """Feeds the DSNs among raw_messages (an iterable of bytes) to the store; returns counts."""
+        stats = {"messages": 0, "reports": 0, HARD: 0, SOFT: 0, "recorded": 0}
+        batch = []
+        for raw in raw_messages:
+            stats["messages"] += 1
+            headers = _header_parser.parsebytes(raw, headersonly=True)
+            if headers.get_content_type() != "multipart/report":
+                continue # Auto-replies, out-of-office notes and the like; not worth a full parse
+            message_id = headers.get("Message-ID", "").strip() or hashlib.sha1(raw).hexdigest()
+            boundary = headers.get_param("boundary")
+            status_text = delivery_status_text(raw, boundary) if boundary else None
+            if status_text is not None:
+                bounces = bounces_from_blocks(_split_blocks(status_text), headers, message_id)
+            else:
+                bounces = parse_dsn(email.message_from_bytes(raw, policy=compat32), message_id)
+            if bounces:
+                stats["reports"] += 1
+            for bounce in bounces:
+                stats[bounce.kind] += 1
+                BOUNCES.labels(bounce.kind).inc()
+            batch.extend(bounces)
+            if len(batch) >= self.batch_size:
+                stats["recorded"] += self.store.record_bounces(batch)
+                batch = []
+        if batch:
+            stats["recorded"] += self.store.record_bounces(batch)
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Feed bounce reports (RFC 3464 DSNs) into the suppression store.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--mbox")
+    source.add_argument("--maildir")
+    source.add_argument("--imap", metavar="HOST")
+    parser.add_argument("--imap-port", type=int)
+    parser.add_argument("--no-ssl", action="store_true", help="Plain IMAP (e.g. a local test server)")
+    parser.add_argument("--user")
+    parser.add_argument("--folder", default="INBOX")
+    parser.add_argument("--db", default=DEFAULT_SUPPRESSION_DB, help="Suppression database")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    if args.mbox:
+        messages = iter_mbox(args.mbox)
+    elif args.maildir:
+        messages = iter_maildir(args.maildir)
+    else:
+        password = os.environ.get("IMAP_PASSWORD")
+        if password is None:
+            import getpass
+            password = getpass.getpass("IMAP password: ")
+        messages = iter_imap(args.imap, args.user, password, args.folder, args.imap_port, not args.no_ssl)
+
+    store = SuppressionStore(args.db)
+    try:
+        stats = BounceProcessor(store, args.batch_size).process(messages)
+        print(f"{stats['messages']} messages, {stats['reports']} bounce reports: {stats[HARD]} hard, {stats[SOFT]} soft, "
+              f"{stats['recorded']} new. Suppression list: {store.summary()}")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""Distributed campaign workers.
+
+The app (coordinator) splits a campaign into shards and puts them on a shared
+work queue with enqueue_campaign(). Worker processes on any node that can
+reach the queue claim shards, deliver them with the regular SendPipeline and
+record every recipient's outcome in the delivery ledger.
+
+Run a worker with:
+    python campaign_worker.py --queue sqlite:///campaigns.db
+
+Note that the campaign's sender configuration (including credentials) is
+stored with the campaign so workers can connect to the relay; keep the queue
+database private.
+"""
+import argparse
+import logging
+import os
+import socket
+import threading
+
+import metrics
+from scheduler import plan_send_times, scheduled_shards
+from send_pipeline import SendPipeline, iter_row_chunks
+from transports import delivery_deadlines, pooled_transport_factory
+from work_queue import DEFAULT_LEASE_SECONDS, SharedRateLimiter, new_campaign_id, open_queue
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SHARD_SIZE = 1000
+RESULT_BATCH_SIZE = 200
+FAILED_SHARD_BACKOFF = 30.0 # Seconds before a failed shard can be claimed again; doubles per attempt
+MAX_FAILED_SHARD_BACKOFF = 900.0
+
+
+def enqueue_campaign(work_queue, campaign, config, df, shard_size=DEFAULT_SHARD_SIZE, rate_limit=None, schedule=None):
+    """Splits the recipients into shards on the work queue. Returns the campaign id.
+
+    With a scheduler.Schedule, shards are cut per send slot and only become claimable at their slot.
+    """
+    campaign_id = campaign.get("campaign_id") or new_campaign_id()
+    # Workers rebuild transports from config; the AI keys are never needed for delivery
+    delivery_config = {k: v for k, v in config.items() if k not in ('openrouter_api_key', 'ai_api_key')}
+    if schedule is None:
+        work_queue.add_campaign(campaign_id, campaign, delivery_config, rate_limit,
+                                iter_row_chunks(df, shard_size))
+    else:
+        send_times, _, _ = plan_send_times(df, schedule)
+        work_queue.add_scheduled_campaign(campaign_id, campaign, delivery_config, rate_limit,
+                                          scheduled_shards(df, send_times, shard_size=shard_size))
+    return campaign_id
+
+
+class CampaignWorker:
+    def __init__(self, work_queue, worker_id=None, lease_seconds=DEFAULT_LEASE_SECONDS,
+                 delivery_workers=None, render_processes=None):
+        self.work_queue = work_queue
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.delivery_workers = delivery_workers
+        self.render_processes = render_processes
+        self.campaigns = {} # campaign id -> CampaignRecord, fetched once per worker
+        self.stop_event = threading.Event()
+
+    def _heartbeat(self, shard, pipeline, done):
+        # Renew the lease at a third of its length; if it was lost, stop sending this shard
+        while not done.wait(self.lease_seconds / 3):
+            if not self.work_queue.renew(shard.id, self.worker_id, self.lease_seconds):
+                pipeline.stop()
+                return
+
+    def process_shard(self, shard):
+        record = self.campaigns.get(shard.campaign_id)
+        if record is None:
+            record = self.campaigns[shard.campaign_id] = self.work_queue.get_campaign(shard.campaign_id)
+
+        ledger = self.work_queue.ledger
+        rows = shard.rows
+        if shard.attempts > 1:
+            # A previous worker died part-way through; don't resend what it already delivered
+            already_sent = ledger.sent_keys(shard.campaign_id, [row[0] for row in rows])
+            rows = [row for row in rows if row[0] not in already_sent]
+
+        config = record.config
+        pipeline_kwargs = {
+            "render_processes": self.render_processes,
+            "rate_limiter": SharedRateLimiter(self.work_queue, shard.campaign_id, record.rate_limit),
+            **delivery_deadlines(config),
+        }
+        if self.delivery_workers:
+            pipeline_kwargs["delivery_workers"] = self.delivery_workers
+        elif config.get('delivery_workers'):
+            pipeline_kwargs["delivery_workers"] = int(config['delivery_workers'])
+        # Pooled per relay login: shards of concurrent campaigns share the connections fairly
+        pipeline = SendPipeline(record.campaign, pooled_transport_factory(config, shard.campaign_id), **pipeline_kwargs)
+
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(shard, pipeline, done), daemon=True)
+        heartbeat.start()
+        batch = []
+        try:
+            for result in pipeline.run([rows[i:i + 100] for i in range(0, len(rows), 100)]):
+                batch.append(result)
+                if len(batch) >= RESULT_BATCH_SIZE:
+                    ledger.record(shard.campaign_id, self.worker_id, batch)
+                    batch = []
+        except Exception:
+            # Fatal for this shard (e.g. relay login failed): hand it back, out of reach for a while so a
+            # misconfigured campaign doesn't fail on every worker in turn; after MAX_SHARD_ATTEMPTS it's parked
+            if batch:
+                ledger.record(shard.campaign_id, self.worker_id, batch)
+            backoff = min(MAX_FAILED_SHARD_BACKOFF, FAILED_SHARD_BACKOFF * 2 ** (shard.attempts - 1))
+            self.work_queue.release(shard.id, self.worker_id, retry_after=backoff)
+            raise
+        finally:
+            done.set()
+            heartbeat.join()
+
+        if batch:
+            ledger.record(shard.campaign_id, self.worker_id, batch)
+        if pipeline.stop_event.is_set() and not self.work_queue.renew(shard.id, self.worker_id, self.lease_seconds):
+            return False # Lease lost; the shard belongs to another worker now
+        return self.work_queue.complete(shard.id, self.worker_id)
+
+    def run(self, once=False, idle_sleep=2.0):
+        while not self.stop_event.is_set():
+            shard = self.work_queue.claim(self.worker_id, self.lease_seconds)
+            if shard is None:
+                if once:
+                    return
+                self.stop_event.wait(idle_sleep)
+                continue
+            try:
+                self.process_shard(shard)
+            except Exception:
+                # The shard was handed back with a backoff; keep serving the other campaigns
+                log.exception("Worker %s: shard %s of campaign %s failed", self.worker_id, shard.seq, shard.campaign_id)
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deliver queued campaign shards.")
+    parser.add_argument("--queue", default="sqlite:///campaigns.db", help="Work queue URL (sqlite:///path)")
+    parser.add_argument("--worker-id", default=None)
+    parser.add_argument("--lease", type=float, default=DEFAULT_LEASE_SECONDS, help="Shard lease length in seconds")
+    parser.add_argument("--connections", type=int, default=None, help="Parallel relay connections in this worker")
+    parser.add_argument("--render-processes", type=int, default=None)
+    parser.add_argument("--once", action="store_true", help="Exit when the queue is empty instead of polling")
+    parser.add_argument("--metrics-port", type=int, default=0, help="Serve Prometheus metrics on this port (0 = off)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if args.metrics_port:
+        metrics.start_metrics_server(args.metrics_port, host="0.0.0.0")
+
+    work_queue = open_queue(args.queue)
+    worker = CampaignWorker(work_queue, args.worker_id, args.lease, args.connections, args.render_processes)
+    print(f"Worker {worker.worker_id} polling {args.queue}")
+    try:
+        worker.run(once=args.once)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        work_queue.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Content-Transfer-Encoding policy for SMTP message bodies.
+
+MIMEText(body, 'html') base64-encodes any non-ASCII body, which costs about a
+third more bytes on the wire plus the encoding work for every message. When
+the relay advertises 8BITMIME the body can go out as raw UTF-8 instead
+(8bit), and quoted-printable is usually much smaller than base64 for mostly
+ASCII HTML even without it.
+
+The choice is made once per template (choose_body_encoding) by encoding the
+template both ways and keeping the smaller; per message only the cheap checks
+that keep 8bit legal (line length) are repeated.
+"""
+import math
+from collections import namedtuple
+from email import quoprimime
+from email.charset import BASE64, QP, Charset
+from email.mime.text import MIMEText
+
+# RFC 5321 line limit without CRLF; 8bit (and 7bit) bodies may not exceed it
+MAX_LINE_OCTETS = 998
+
+EncodingPlan = namedtuple("EncodingPlan", "encoding template_bytes estimates")
+
+_BODY_ENCODINGS = {"8bit": None, "quoted-printable": QP, "base64": BASE64}
+
+
+def relay_capabilities(features):
+    """Normalises smtplib's esmtp_features (or any iterable of EHLO keywords) to a set of lower-case names."""
+    return {name.lower() for name in (features or ())}
+
+
+def base64_size(octets):
+    encoded = 4 * math.ceil(octets / 3)
+    return encoded + 2 * math.ceil(encoded / 76) # CRLF after every 76 characters
+
+
+def quoted_printable_size(data):
+    return len(quoprimime.body_encode(data.decode("latin-1"))) if data else 0
+
+
+def fits_8bit(data):
+    return all(len(line) <= MAX_LINE_OCTETS for line in data.splitlines())
+
+
+def choose_body_encoding(template, capabilities):
+    """Picks the smallest legal transfer encoding for a body template.
+
+    8bit needs 8BITMIME from the relay and lines within the SMTP limit; without
+    it, quoted-printable or base64, whichever is smaller.
+    """
+    data = template.encode("utf-8")
+    estimates = {}
+    if "8bitmime" in capabilities and fits_8bit(data):
+        estimates["8bit"] = len(data) # First, so it wins ties: no encoding work at all
+    estimates["quoted-printable"] = quoted_printable_size(data)
+    estimates["base64"] = base64_size(len(data))
+    encoding = min(estimates, key=estimates.get)
+    return EncodingPlan(encoding, len(data), estimates)
+
+
+def plan_campaign_encoding(campaign, capabilities):
+    """Returns a copy of the campaign with its body encoding decided for this relay."""
+    plan = choose_body_encoding(campaign["body_template"], capabilities)
+    planned = dict(campaign, body_encoding=plan.encoding, encoding_estimates=plan.estimates,
+                   relay_capabilities=capabilities)
+    if campaign.get("text_template") is not None:
+        planned["text_encoding"] = choose_body_encoding(campaign["text_template"], capabilities).encoding
+    return planned
+
+
+def text_part(text, subtype, encoding):
+    """MIMEText with the given transfer encoding ('8bit' becomes 7bit for pure ASCII text)."""
+    if encoding == "8bit" and not fits_8bit(text.encode("utf-8")):
+        encoding = "quoted-printable" # A substituted value made a line too long for 8bit
+    charset = Charset("utf-8")
+    charset.body_encoding = _BODY_ENCODINGS[encoding]
+    return MIMEText(text, subtype, charset)
+
+
+def default_part_size(text):
+    """Wire size of the body as MIMEText(text, subtype) would have encoded it; the savings baseline."""
+    data = text.encode("utf-8")
+    return len(data) if text.isascii() else base64_size(len(data))
+
+
+def encoded_part_size(part):
+    payload = part.get_payload()
+    if part["Content-Transfer-Encoding"] in ("8bit", "7bit"):
+        return len(payload.encode("utf-8", "surrogateescape"))
+    return len(payload)
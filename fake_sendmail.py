@@ -0,0 +1,72 @@
+"""Stand-in for a sendmail binary, for trying the Sendmail transport without an MTA.
+
+    python fake_sendmail.py -bs                  SMTP on stdin/stdout (smtp_stub's handler)
+    python fake_sendmail.py -t -oi -f sender     one message on stdin, recipients from its headers
+
+Every accepted message is written to $FAKE_SENDMAIL_DIR (default
+./fake_sendmail_out) as an .eml file, and its envelope is appended to
+envelopes.log there. Point the app's sendmail command at it:
+
+    sendmail_command = "python fake_sendmail.py"
+
+FAKE_SENDMAIL_FAIL=1 makes -t runs exit with status 75 (EX_TEMPFAIL).
+"""
+import email
+import email.utils
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+from smtp_stub import DEFAULT_EXTENSIONS, StubHandler, StubState
+
+OUTPUT_DIR = os.environ.get("FAKE_SENDMAIL_DIR", "fake_sendmail_out")
+
+
+def store(mode, mail_from, recipients, data):
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    file_name = f"{time.time_ns()}-{os.getpid()}.eml"
+    with open(os.path.join(OUTPUT_DIR, file_name), "wb") as f:
+        f.write(data)
+    with open(os.path.join(OUTPUT_DIR, "envelopes.log"), "a", encoding="utf-8") as log:
+        log.write(f"{mode}\t{os.getpid()}\t{mail_from}\t{','.join(recipients)}\t{file_name}\n")
+
+
+class _StdioConnection:
+    # The two socket methods StubHandler uses, over fds 0 and 1 (a socket or plain pipes)
+    def recv(self, size):
+        return os.read(0, size)
+
+    def sendall(self, data):
+        while data:
+            data = data[os.write(1, data):]
+
+
+class _SendmailHandler(StubHandler):
+    def finish_message(self, data):
+        store("bs", self.mail_from, self.rcpts, data)
+        super().finish_message(data)
+
+
+def main(argv):
+    if "-bs" in argv:
+        state = StubState([ext for ext in DEFAULT_EXTENSIONS if not ext.startswith("AUTH")])
+        _SendmailHandler(_StdioConnection(), ("stdio", os.getpid()), SimpleNamespace(state=state))
+        return 0
+    if "-t" not in argv:
+        print("fake_sendmail: only -bs and -t are supported", file=sys.stderr)
+        return 64 # EX_USAGE
+    if os.environ.get("FAKE_SENDMAIL_FAIL"):
+        print("fake_sendmail: simulated temporary failure", file=sys.stderr)
+        return 75 # EX_TEMPFAIL
+    data = sys.stdin.buffer.read()
+    message = email.message_from_bytes(data)
+    recipients = [address for _, address in email.utils.getaddresses(
+        message.get_all("To", []) + message.get_all("Cc", []) + message.get_all("Bcc", []))]
+    sender = argv[argv.index("-f") + 1] if "-f" in argv[:-1] else ""
+    store("t", sender, recipients, data)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
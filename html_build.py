@@ -0,0 +1,165 @@
+"""Build step for the HTML body template, run once per campaign.
+
+* CSS inlining: <style> rules are copied into style="" attributes, since many
+  mail clients ignore <style> blocks. Uses premailer if installed (its lxml
+  parser keeps the table structure around template tags), else css_inline;
+  without either the HTML is left as is.
+* Minification: comments are dropped, whitespace runs collapse to one space
+  and whitespace around block-level tags goes entirely (<pre>, <textarea>,
+  <style> and <script> are left alone).
+* Plain-text alternative: derived from the HTML and sent as the text/plain
+  part of a multipart/alternative.
+
+Template syntax ({Column} placeholders, Jinja tags) is swapped for inert
+tokens before processing and restored afterwards, so inliners and parsers
+never see (or rearrange) it. Jinja statements become HTML comments, which
+may legally sit anywhere, including between table rows.
+"""
+import re
+from collections import namedtuple
+from html.parser import HTMLParser
+
+from templating import JINJA
+
+BuiltTemplate = namedtuple("BuiltTemplate", "html text inliner")
+
+_TOKEN = "TPLTOKEN{}Z"
+_TOKEN_RE = re.compile(r"(?:<!--|&lt;!--)TPLTOKEN(\d+)Z(?:-->|--&gt;)|TPLTOKEN(\d+)Z")
+_JINJA_TAG_RE = re.compile(r"\{\{.*?\}\}|\{%.*?%\}|\{#.*?#\}", re.DOTALL)
+
+_RAW_BLOCK_RE = re.compile(r"(<(pre|textarea|style|script)\b.*?</\2\s*>)", re.IGNORECASE | re.DOTALL)
+_COMMENT_RE = re.compile(r"<!--(?!\[if|<!\[endif|TPLTOKEN).*?-->", re.DOTALL) # Keeps Outlook conditionals
+_WHITESPACE_RE = re.compile(r"\s+")
+_STATEMENT_LINE_RE = re.compile(r"^((?:<!--TPLTOKEN\d+Z-->[ \t]*)+)\n+", re.MULTILINE)
+# Whitespace next to these tags never renders; next to inline tags (<a>, <b>, <span>...) it does
+_BLOCK_TAG_SPACE_RE = re.compile(
+    r"\s*(</?(?:html|head|body|meta|link|title|p|div|center|section|header|footer|article|table|thead|tbody|tfoot"
+    r"|tr|td|th|ul|ol|li|h[1-6]|blockquote|hr|br)\b[^>]*>)\s*", re.IGNORECASE)
+
+
+def protect(source, syntax, columns):
+    """Replaces template syntax with inert tokens; returns (text, tokens)."""
+    tokens = []
+
+    def swap(match):
+        tokens.append(match.group(0))
+        token = _TOKEN.format(len(tokens) - 1)
+        return f"<!--{token}-->" if match.group(0).startswith(("{%", "{#")) else token
+
+    if syntax == JINJA:
+        pattern = _JINJA_TAG_RE
+    else:
+        names = sorted((re.escape(f"{{{col_name}}}") for col_name in columns), key=len, reverse=True)
+        if not names:
+            return source, tokens
+        pattern = re.compile("|".join(names))
+    return pattern.sub(swap, source), tokens
+
+
+def restore(text, tokens):
+    return _TOKEN_RE.sub(lambda match: tokens[int(match.group(1) or match.group(2))], text)
+
+
+def inline_css(source):
+    """Returns (html, name of the inliner used or None)."""
+    try:
+        from premailer import transform
+        return transform(source, keep_style_tags=False, remove_classes=False, disable_validation=True), "premailer"
+    except ImportError:
+        pass
+    try:
+        import css_inline
+        return css_inline.inline(source), "css_inline"
+    except ImportError:
+        return source, None
+
+
+def minify_html(source):
+    raw_blocks = []
+
+    def stash(match):
+        raw_blocks.append(match.group(1))
+        return f"\x00{len(raw_blocks) - 1}\x00"
+
+    text = _RAW_BLOCK_RE.sub(stash, source)
+    text = _COMMENT_RE.sub("", text)
+    text = _WHITESPACE_RE.sub(" ", text)
+    text = _BLOCK_TAG_SPACE_RE.sub(r"\1", text).strip()
+    return re.sub("\x00(\\d+)\x00", lambda match: raw_blocks[int(match.group(1))], text)
+
+
+class _TextExtractor(HTMLParser):
+    BLOCK_TAGS = {"p", "div", "section", "article", "header", "footer", "table", "tr", "ul", "ol",
+                  "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "pre", "hr"}
+    SKIP_TAGS = {"style", "script", "head", "title"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.out = []
+        self.skip = 0
+        self.links = []
+        self.pre = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip += 1
+        elif tag == "br":
+            self.out.append("\n")
+        elif tag in self.BLOCK_TAGS:
+            self.out.append("\n\n")
+            self.pre += tag == "pre"
+        elif tag == "li":
+            self.out.append("\n- ")
+        elif tag in ("td", "th"):
+            self.out.append(" ")
+        elif tag == "img":
+            alt = dict(attrs).get("alt")
+            if alt:
+                self.out.append(f"[{alt}]")
+        elif tag == "a":
+            self.links.append(dict(attrs).get("href"))
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip = max(0, self.skip - 1)
+        elif tag in self.BLOCK_TAGS:
+            self.out.append("\n\n")
+            self.pre -= tag == "pre"
+        elif tag == "a" and self.links:
+            href = self.links.pop()
+            if href and not href.startswith(("#", "mailto:")):
+                self.out.append(f" ({href})")
+
+    def handle_data(self, data):
+        if self.skip:
+            return
+        self.out.append(data if self.pre else re.sub(r"\s+", " ", data))
+
+    def handle_comment(self, data):
+        if data.startswith("TPLTOKEN"): # Protected template statement; keep it in the text version
+            self.out.append(f"<!--{data}-->")
+
+    def text(self):
+        lines = [line.strip() for line in "".join(self.out).splitlines()]
+        text = re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip() + "\n"
+        # A line holding only template statements joins the next one, as Jinja's trim_blocks would
+        return _STATEMENT_LINE_RE.sub(r"\1", text)
+
+
+def html_to_text(source):
+    parser = _TextExtractor()
+    parser.feed(source)
+    parser.close()
+    return parser.text()
+
+
+def build_body(body_template, syntax, columns, inline=True, minify=True, text=True):
+    """Runs the enabled steps over the body template; returns a BuiltTemplate (text is None if disabled)."""
+    protected, tokens = protect(body_template, syntax, columns)
+    inliner = None
+    if inline and "<style" in protected.lower():
+        protected, inliner = inline_css(protected)
+    plain = html_to_text(protected) if text else None
+    if minify:
+        protected = minify_html(protected)
+    return BuiltTemplate(restore(protected, tokens), restore(plain, tokens) if plain is not None else None, inliner)
@@ -0,0 +1,89 @@
+"""Inline (CID) images for the HTML body.
+
+The body references an image as <img src="cid:logo.png">; the image travels
+in the message as a part with that Content-ID, next to the body inside a
+multipart/related. Images are optimised once when they are added
+(optimize_image, needs Pillow) and base64-encoded once per campaign
+(prepare_inline_images); the render processes only wrap the encoded text in
+a MIME part, and every message reuses the same serialized bytes.
+"""
+import base64
+import io
+import mimetypes
+import re
+from collections import namedtuple
+from email.mime.base import MIMEBase
+
+# encoded is the base64 text with MIME line breaks (76 characters per line)
+InlineImage = namedtuple("InlineImage", "cid name content_type size encoded")
+
+DEFAULT_MAX_WIDTH = 1200 # Pixels; wider images are scaled down (mail clients display ~600-800 px)
+JPEG_QUALITY = 85
+
+_CID_RE = re.compile(r"""cid:([^"'\s)>]+)""", re.IGNORECASE)
+_UNSAFE_CID_CHARS = re.compile(r"[^A-Za-z0-9._-]")
+
+
+def content_id(name):
+    """The cid a file is referenced by: its name with characters that need quoting replaced."""
+    return _UNSAFE_CID_CHARS.sub("_", name)
+
+
+def referenced_cids(html):
+    return set(_CID_RE.findall(html or ""))
+
+
+def optimize_image(data, max_width=DEFAULT_MAX_WIDTH):
+    """Scales down and recompresses a PNG or JPEG; returns the data unchanged if that doesn't help or Pillow is missing."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return data
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except Exception:
+        return data
+    image_format = image.format
+    if image_format not in ("PNG", "JPEG"): # GIFs may be animated; others are rare in mail
+        return data
+    resized = image.width > max_width
+    if resized:
+        image = image.resize((max_width, max(1, round(image.height * max_width / image.width))), Image.LANCZOS)
+    out = io.BytesIO()
+    if image_format == "JPEG":
+        image.save(out, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    else:
+        image.save(out, "PNG", optimize=True)
+    optimized = out.getvalue()
+    return optimized if resized or len(optimized) < len(data) else data
+
+
+def prepare_inline_images(images):
+    """[{"name", "data"}] -> InlineImages, base64-encoded once for every message of the campaign."""
+    prepared = []
+    for image_data in images or ():
+        content_type = mimetypes.guess_type(image_data["name"])[0] or "application/octet-stream"
+        prepared.append(InlineImage(content_id(image_data["name"]), image_data["name"], content_type,
+                                    len(image_data["data"]), base64.encodebytes(image_data["data"]).decode("ascii")))
+    return prepared
+
+
+def mime_image_part(image):
+    maintype, subtype = image.content_type.split("/", 1)
+    part = MIMEBase(maintype, subtype)
+    part.set_payload(image.encoded) # Already base64; nothing is encoded per process
+    part["Content-Transfer-Encoding"] = "base64"
+    part["Content-ID"] = f"<{image.cid}>"
+    part.add_header("Content-Disposition", "inline", filename=image.name)
+    return part
+
+
+
+def with_data_uris(html, images):
+    """The HTML with cid: references replaced by data: URIs, for previewing it outside a mail client."""
+    for image_data in images or ():
+        content_type = mimetypes.guess_type(image_data["name"])[0] or "application/octet-stream"
+        data_uri = f"data:{content_type};base64,{base64.b64encode(image_data['data']).decode('ascii')}"
+        html = html.replace(f"cid:{content_id(image_data['name'])}", data_uri)
+    return html
@@ -0,0 +1,93 @@
+"""Delivery ledger: the per-recipient outcome of every campaign.
+
+Delivery workers report their results here in batches. The ledger is keyed by
+(campaign, row key), so a shard that is retried after its worker died simply
+overwrites the earlier rows instead of double counting them.
+"""
+import sqlite3
+import threading
+import time
+
+
+def row_key_value(key):
+    # numpy scalars (from DataFrame indexes) are not sqlite-compatible
+    if hasattr(key, "item"):
+        key = key.item()
+    return key if isinstance(key, (int, str)) else str(key)
+
+
+class DeliveryLedger:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS deliveries (
+                campaign_id TEXT NOT NULL,
+                row_key     NOT NULL,
+                row_number  INTEGER,
+                recipient   TEXT,
+                status      TEXT NOT NULL,
+                detail      TEXT,
+                worker_id   TEXT,
+                updated     REAL,
+                PRIMARY KEY (campaign_id, row_key)
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS deliveries_status ON deliveries (campaign_id, status)")
+        self.conn.commit()
+
+    def record(self, campaign_id, worker_id, results):
+        now = time.time()
+        rows = [(campaign_id, row_key_value(r.row_key), r.row_number, r.recipient, r.status, r.detail, worker_id, now)
+                for r in results]
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO deliveries VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def sent_keys(self, campaign_id, keys):
+        keys = [row_key_value(k) for k in keys]
+        found = set()
+        with self.lock:
+            for start in range(0, len(keys), 500): # Stay under SQLite's host parameter limit
+                batch = keys[start:start + 500]
+                found.update(k for (k,) in self.conn.execute(
+                    f"SELECT row_key FROM deliveries WHERE campaign_id = ? AND status = 'sent' "
+                    f"AND row_key IN ({','.join('?' * len(batch))})", [campaign_id, *batch]))
+        return found
+
+    def summary(self, campaign_id):
+        with self.lock:
+            return dict(self.conn.execute(
+                "SELECT status, COUNT(*) FROM deliveries WHERE campaign_id = ? GROUP BY status", (campaign_id,)))
+
+    def close(self):
+        self.conn.close()
+
+
+class MemoryLedger:
+    """In-process stand-in for DeliveryLedger (tests, single-process runs)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = {}
+
+    def record(self, campaign_id, worker_id, results):
+        with self.lock:
+            for r in results:
+                self.rows[(campaign_id, row_key_value(r.row_key))] = (r.row_number, r.recipient, r.status, r.detail, worker_id)
+
+    def sent_keys(self, campaign_id, keys):
+        with self.lock:
+            return {row_key_value(k) for k in keys
+                    if self.rows.get((campaign_id, row_key_value(k)), (None, None, None))[2] == "sent"}
+
+    def summary(self, campaign_id):
+        counts = {}
+        with self.lock:
+            for (cid, _), row in self.rows.items():
+                if cid == campaign_id:
+                    counts[row[2]] = counts.get(row[2], 0) + 1
+        return counts
+
+    def close(self):
+        pass
@@ -0,0 +1,331 @@
+"""Saved contact lists, keyed by email, with a change log.
+
+Lists used to be CSV files rewritten in full on every save. Here each list is
+a set of rows in SQLite keyed by normalized email (the primary key is the
+on-disk index), so saving, merging an import or editing a few rows writes
+only the rows that actually changed. Every write is one transaction (WAL), so
+a crash leaves the list as it was before or after the write, never half-way.
+
+Each write is also logged per row (before and after images) under a batch
+number, along with the list's columns before and after it:
+
+    undo(name)                 reverts the latest batch (itself logged, so undo can be synced)
+    changes_since(name, seq)   rows changed after a given point, for incremental sync
+
+Only the last CHANGE_LOG_BATCHES batches per list are kept.
+
+Rows keep their place in the list; new rows are appended. Rows without a
+usable email address can't be keyed and are skipped (counted in the returned
+stats). Lists saved as CSV by earlier versions are imported on first use and
+the CSV is renamed to <name>.csv.imported.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+from suppression import normalize_address
+
+DEFAULT_LIST_DIR = "contact_lists"
+LIST_DB_NAME = "lists.db"
+CHANGE_LOG_BATCHES = 20
+
+UPSERT = "upsert"       # Update matching rows, add new ones
+ADD_NEW = "add_new"     # Only add rows whose email isn't in the list yet
+REPLACE = "replace"     # The list becomes exactly the given rows
+MERGE_MODES = (UPSERT, ADD_NEW, REPLACE)
+
+
+def _json_default(value):
+    if hasattr(value, "item"): # numpy scalars left in object columns
+        return value.item()
+    return str(value)
+
+
+# Sorted keys, so a row that didn't change encodes to the same text whatever the column order
+_encode = json.JSONEncoder(sort_keys=True, separators=(",", ":"), default=_json_default).encode
+
+
+class ContactListStore:
+    def __init__(self, list_dir=DEFAULT_LIST_DIR):
+        self.list_dir = list_dir
+        os.makedirs(list_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(list_dir, LIST_DB_NAME), check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS lists (
+                name        TEXT PRIMARY KEY,
+                columns     TEXT NOT NULL,
+                next_pos    INTEGER NOT NULL DEFAULT 0,
+                updated     REAL
+            );
+            CREATE TABLE IF NOT EXISTS list_rows (
+                list        TEXT NOT NULL,
+                email_key   TEXT NOT NULL,
+                position    INTEGER NOT NULL,
+                data        TEXT NOT NULL,
+                PRIMARY KEY (list, email_key)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS list_rows_position ON list_rows (list, position);
+            CREATE TABLE IF NOT EXISTS list_changes (
+                seq         INTEGER PRIMARY KEY AUTOINCREMENT,
+                list        TEXT NOT NULL,
+                batch       INTEGER NOT NULL,
+                email_key   TEXT NOT NULL,
+                position    INTEGER,
+                before      TEXT,
+                after       TEXT,
+                undo_of     INTEGER,
+                undone      INTEGER NOT NULL DEFAULT 0,
+                at          REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS list_changes_batch ON list_changes (list, batch);
+            CREATE TABLE IF NOT EXISTS list_batches (
+                list            TEXT NOT NULL,
+                batch           INTEGER NOT NULL,
+                columns_before  TEXT,
+                columns_after   TEXT,
+                PRIMARY KEY (list, batch)
+            );
+        """)
+        self.conn.commit()
+
+    # --- Reading ---
+
+    def names(self):
+        """Saved lists: in the store, plus CSV lists not imported yet."""
+        with self.lock:
+            stored = {name for (name,) in self.conn.execute("SELECT name FROM lists")}
+        csv_names = {os.path.splitext(f)[0] for f in os.listdir(self.list_dir) if f.endswith(".csv")}
+        return sorted(stored | csv_names)
+
+    def _columns(self, name):
+        row = self.conn.execute("SELECT columns FROM lists WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load(self, name):
+        """The list as a DataFrame, rows in the order they were added."""
+        legacy = self._import_csv(name)
+        if legacy is not None:
+            return legacy
+        with self.lock:
+            columns = self._columns(name)
+            if columns is None:
+                raise KeyError(name)
+            rows = [json.loads(data) for (data,) in self.conn.execute(
+                "SELECT data FROM list_rows WHERE list = ? ORDER BY position", (name,))]
+        return pd.DataFrame.from_records(rows, columns=columns)
+
+    def count(self, name):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM list_rows WHERE list = ?", (name,)).fetchone()[0]
+
+    def changes_since(self, name, seq=0):
+        """[(seq, email, before row or None, after row or None)] logged after seq, oldest first."""
+        with self.lock:
+            return [(change_seq, email_key, json.loads(before) if before else None, json.loads(after) if after else None)
+                    for change_seq, email_key, before, after in self.conn.execute(
+                        "SELECT seq, email_key, before, after FROM list_changes WHERE list = ? AND seq > ? ORDER BY seq",
+                        (name, seq))]
+
+    def last_change(self, name):
+        """(batch, rows changed, time) of the batch undo() would revert, or None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT batch, COUNT(*), MAX(at) FROM list_changes WHERE list = ? AND batch = "
+                "(SELECT MAX(batch) FROM list_changes WHERE list = ? AND undo_of IS NULL AND undone = 0)",
+                (name, name)).fetchone()
+        return row if row[0] is not None else None
+
+    # --- Writing ---
+
+    def merge(self, name, df, mode=UPSERT, keep_blanks=True):
+        """Writes df into a list, keyed by its Email column; creates the list if needed.
+
+        mode is UPSERT, ADD_NEW or REPLACE. With keep_blanks, empty cells in df
+        don't overwrite existing values (an import that lacks a column's value
+        doesn't erase it). Returns {"added", "updated", "removed", "unchanged", "skipped"}.
+        """
+        if mode not in MERGE_MODES:
+            raise ValueError(f"Unknown merge mode '{mode}' (expected one of {', '.join(MERGE_MODES)})")
+        if 'Email' not in df.columns:
+            raise ValueError("The list needs an 'Email' column to be merged by email")
+        legacy = self._import_csv(name)
+        if legacy is None:
+            return self._merge(name, df, mode, keep_blanks)
+        if mode != REPLACE:
+            raise ValueError(f"The saved list '{name}' has no 'Email' column, so rows can't be matched; save it again instead")
+        stats = self._merge(name, df, mode, keep_blanks)
+        csv_path = os.path.join(self.list_dir, name + ".csv")
+        os.replace(csv_path, csv_path + ".imported")
+        return stats
+
+    def _merge(self, name, df, mode, keep_blanks):
+        columns = [str(column) for column in df.columns]
+        # Dates as ISO text, missing cells as None and numpy scalars as Python values, column-wise
+        df = df.copy()
+        for column in df.columns:
+            if pd.api.types.is_datetime64_any_dtype(df[column]) or pd.api.types.is_timedelta64_dtype(df[column]):
+                df[column] = df[column].map(lambda value: value.isoformat(), na_action="ignore")
+        df = df.astype(object).where(df.notna(), None)
+        keys = df['Email'].map(lambda email: normalize_address(email) if isinstance(email, str) else "")
+        incoming = {}
+        skipped = 0
+        for key, values in zip(keys, df.itertuples(index=False, name=None)):
+            row = dict(zip(columns, values))
+            if "@" not in key:
+                skipped += 1
+                continue
+            if key in incoming and keep_blanks: # Duplicate email within the import: later cells win, blanks don't
+                incoming[key].update({column: value for column, value in row.items() if value is not None})
+            else:
+                incoming[key] = row
+        stats = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0, "skipped": skipped}
+        now = time.time()
+
+        with self.lock, self.conn:
+            list_columns = self._columns(name)
+            if list_columns is None:
+                list_columns = []
+                self.conn.execute("INSERT INTO lists VALUES (?, ?, 0, ?)", (name, "[]", now))
+            columns_before = list_columns
+            list_columns = (columns if mode == REPLACE else
+                            list_columns + [column for column in columns if column not in list_columns])
+            next_pos = self.conn.execute("SELECT next_pos FROM lists WHERE name = ?", (name,)).fetchone()[0]
+            batch = self._next_batch(name)
+
+            existing = {}
+            if mode == REPLACE: # Every row is compared anyway; one scan beats keyed lookups
+                existing = {key: (position, data) for key, position, data in self.conn.execute(
+                    "SELECT email_key, position, data FROM list_rows WHERE list = ?", (name,))}
+            else:
+                keys = list(incoming)
+                for start in range(0, len(keys), 500): # Stay under SQLite's host parameter limit
+                    chunk = keys[start:start + 500]
+                    existing.update((key, (position, data)) for key, position, data in self.conn.execute(
+                        f"SELECT email_key, position, data FROM list_rows WHERE list = ? "
+                        f"AND email_key IN ({','.join('?' * len(chunk))})", [name, *chunk]))
+
+            writes, changes = [], []
+            for key, row in incoming.items():
+                if key not in existing:
+                    data = _encode(row)
+                    writes.append((name, key, next_pos, data))
+                    changes.append((name, batch, key, next_pos, None, data, now))
+                    next_pos += 1
+                    stats["added"] += 1
+                    continue
+                position, before = existing[key]
+                if mode == ADD_NEW:
+                    stats["unchanged"] += 1
+                    continue
+                merged = json.loads(before) if mode == UPSERT else {}
+                merged.update({column: value for column, value in row.items() if value is not None or not keep_blanks})
+                if mode == REPLACE and keep_blanks: # Blank cells keep the old value, columns not in df are dropped
+                    old = json.loads(before)
+                    merged.update({column: old.get(column) for column, value in row.items()
+                                   if value is None and old.get(column) is not None})
+                data = _encode(merged)
+                if data == before:
+                    stats["unchanged"] += 1
+                    continue
+                writes.append((name, key, position, data))
+                changes.append((name, batch, key, position, before, data, now))
+                stats["updated"] += 1
+
+            if mode == REPLACE:
+                removed = [(key, position, data) for key, (position, data) in existing.items() if key not in incoming]
+                self.conn.executemany("DELETE FROM list_rows WHERE list = ? AND email_key = ?",
+                                      [(name, key) for key, _, _ in removed])
+                changes.extend((name, batch, key, position, data, None, now) for key, position, data in removed)
+                stats["removed"] = len(removed)
+
+            self.conn.executemany("INSERT OR REPLACE INTO list_rows VALUES (?, ?, ?, ?)", writes)
+            self._log(name, changes, columns_before, list_columns)
+            self.conn.execute("UPDATE lists SET columns = ?, next_pos = ?, updated = ? WHERE name = ?",
+                              (json.dumps(list_columns), next_pos, now, name))
+        return stats
+
+    def save(self, name, df, keep_blanks=False):
+        """Makes the list exactly df (the old full overwrite), writing only the differences."""
+        return self.merge(name, df, REPLACE, keep_blanks=keep_blanks)
+
+    def undo(self, name):
+        """Reverts the latest change batch of a list; returns the number of rows restored (0 if nothing to undo)."""
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT MAX(batch) FROM list_changes WHERE list = ? AND undo_of IS NULL AND undone = 0",
+                                    (name,)).fetchone()
+            if row[0] is None:
+                return 0
+            undone_batch = row[0]
+            batch = self._next_batch(name)
+            reverted = self.conn.execute(
+                "SELECT email_key, position, before, after FROM list_changes WHERE list = ? AND batch = ? ORDER BY seq DESC",
+                (name, undone_batch)).fetchall()
+            for email_key, position, before, _ in reverted:
+                if before is None:
+                    self.conn.execute("DELETE FROM list_rows WHERE list = ? AND email_key = ?", (name, email_key))
+                else:
+                    self.conn.execute("INSERT OR REPLACE INTO list_rows VALUES (?, ?, ?, ?)", (name, email_key, position, before))
+            self.conn.executemany(
+                "INSERT INTO list_changes (list, batch, email_key, position, before, after, undo_of, at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(name, batch, email_key, position, after, before, undone_batch, now)
+                 for email_key, position, before, after in reverted])
+            self.conn.execute("UPDATE list_changes SET undone = 1 WHERE list = ? AND batch = ?", (name, undone_batch))
+            columns = self.conn.execute("SELECT columns_before FROM list_batches WHERE list = ? AND batch = ?",
+                                        (name, undone_batch)).fetchone()
+            if columns is not None and columns[0] is not None: # Batches logged before columns were are left as they are
+                current = self.conn.execute("SELECT columns FROM lists WHERE name = ?", (name,)).fetchone()[0]
+                self.conn.execute("INSERT INTO list_batches VALUES (?, ?, ?, ?)", (name, batch, current, columns[0]))
+                self.conn.execute("UPDATE lists SET columns = ? WHERE name = ?", (columns[0], name))
+            self.conn.execute("UPDATE lists SET updated = ? WHERE name = ?", (now, name))
+        return len(reverted)
+
+    def delete(self, name):
+        with self.lock, self.conn:
+            for table, column in (("list_rows", "list"), ("list_changes", "list"), ("list_batches", "list"), ("lists", "name")):
+                self.conn.execute(f"DELETE FROM {table} WHERE {column} = ?", (name,))
+        csv_path = os.path.join(self.list_dir, name + ".csv")
+        if os.path.exists(csv_path):
+            os.remove(csv_path)
+
+    def _next_batch(self, name):
+        return (self.conn.execute("SELECT MAX(batch) FROM list_changes WHERE list = ?", (name,)).fetchone()[0] or 0) + 1
+
+    def _log(self, name, changes, columns_before, columns_after):
+        if not changes:
+            return
+        batch = changes[-1][1]
+        self.conn.executemany(
+            "INSERT INTO list_changes (list, batch, email_key, position, before, after, at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            changes)
+        self.conn.execute("INSERT OR REPLACE INTO list_batches VALUES (?, ?, ?, ?)",
+                          (name, batch, json.dumps(columns_before), json.dumps(columns_after)))
+        # Keep the log small: only the latest batches are undoable
+        for table in ("list_changes", "list_batches"):
+            self.conn.execute(f"DELETE FROM {table} WHERE list = ? AND batch <= ?", (name, batch - CHANGE_LOG_BATCHES))
+
+    def _import_csv(self, name):
+        # Lists saved as CSV by earlier versions move into the store the first time they're used.
+        # Returns the CSV's rows if it can't be keyed (no Email column); it then stays a plain CSV.
+        csv_path = os.path.join(self.list_dir, name + ".csv")
+        if not os.path.exists(csv_path):
+            return None
+        with self.lock:
+            if self._columns(name) is not None:
+                return None
+        df = pd.read_csv(csv_path)
+        if 'Email' not in df.columns:
+            return df
+        self._merge(name, df, REPLACE, keep_blanks=False)
+        os.replace(csv_path, csv_path + ".imported")
+        return None
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,307 @@
+"""Send pipeline instrumentation with a Prometheus text endpoint.
+
+Metrics are module-level objects so every stage (render processes, delivery
+workers, the app) records into the same registry. Histograms use fixed,
+pre-allocated buckets and labelled children are created once and cached, so
+recording a sample does not allocate.
+
+Render processes can't write into the app's registry directly; they record
+into their own copies and ship bucket deltas back with each rendered chunk
+(see Registry.take_deltas / merge_deltas; counters and histograms only).
+"""
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds; covers sub-millisecond renders up to slow relay replies
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Bytes; message bodies from a short note to a heavy newsletter
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def _escape(value):
+    # The text format's escapes for label values
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(labelnames, values):
+    if not labelnames:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=(), registry=None):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        if not self.labelnames:
+            return [((), self.labels())]
+        return list(self.children.items())
+
+
+class _Value:
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1.0):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1.0):
+        self.inc(-amount)
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def take_delta(self):
+        with self.lock:
+            delta, self.value = self.value, 0.0
+        return delta
+
+    def merge_delta(self, delta):
+        self.inc(delta)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1.0):
+        self.labels().inc(amount)
+
+    def render(self):
+        return [f"{self.name}{_label_text(self.labelnames, values)} {child.value}" for values, child in self._samples()]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1.0):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1.0):
+        self.labels().inc(-amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def render(self):
+        return [f"{self.name}{_label_text(self.labelnames, values)} {child.value}" for values, child in self._samples()]
+
+
+class _HistogramValue:
+    __slots__ = ("bounds", "counts", "sum", "lock")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # Last slot is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def take_delta(self):
+        """Returns (counts, sum) since the last call and resets them."""
+        with self.lock:
+            delta = (self.counts, self.sum)
+            self.counts = [0] * (len(self.bounds) + 1)
+            self.sum = 0.0
+        return delta
+
+    def merge_delta(self, delta):
+        counts, total = delta
+        with self.lock:
+            for i, count in enumerate(counts):
+                self.counts[i] += count
+            self.sum += total
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th sample; good enough for a dashboard
+        total = self.count
+        if not total:
+            return None
+        rank = q * total
+        running = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            running += count
+            if running >= rank:
+                return bound
+        return float("inf")
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None, unit="seconds"):
+        self.bounds = tuple(buckets)
+        self.unit = unit
+        super().__init__(name, help_text, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.bounds)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def render(self):
+        lines = []
+        for values, child in self._samples():
+            running = 0
+            for bound, count in zip(self.bounds + (float("inf"),), child.counts):
+                running += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_label_text(self.labelnames + ('le',), values + (le,))} {running}")
+            lines.append(f"{self.name}_sum{_label_text(self.labelnames, values)} {child.sum}")
+            lines.append(f"{self.name}_count{_label_text(self.labelnames, values)} {running}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def get(self, name):
+        return next(metric for metric in self.metrics if metric.name == name)
+
+    def take_deltas(self, metrics):
+        """Picklable (name, label values, delta) for each child of the given counters/histograms; resets them."""
+        deltas = []
+        for metric in metrics:
+            for values, child in list(metric.children.items()):
+                delta = child.take_delta()
+                if (any(delta[0]) if metric.kind == "histogram" else delta):
+                    deltas.append((metric.name, values, delta))
+        return deltas
+
+    def merge_deltas(self, deltas):
+        for name, values, delta in deltas:
+            self.get(name).labels(*values).merge_delta(delta)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Rows for the in-app metrics table."""
+        rows = []
+        for metric in self.metrics:
+            for values, child in metric._samples():
+                label = metric.name + _label_text(metric.labelnames, values)
+                if metric.kind == "histogram":
+                    count = child.count
+                    if not count:
+                        continue
+                    if metric.unit == "seconds":
+                        rows.append({"metric": label, "count": count,
+                                     "mean_ms": round(child.sum / count * 1000, 2),
+                                     "p50_ms_le": child.quantile(0.5) * 1000,
+                                     "p95_ms_le": child.quantile(0.95) * 1000})
+                    else:
+                        rows.append({"metric": label, "count": count, "value": child.sum,
+                                     "mean": round(child.sum / count, 1)})
+                else:
+                    rows.append({"metric": label, "value": child.value})
+        return rows
+
+
+REGISTRY = Registry()
+
+# --- Send pipeline metrics ---
+
+RENDER_SECONDS = Histogram("mailer_render_seconds", "Template substitution time per message.")
+MIME_BUILD_SECONDS = Histogram("mailer_mime_build_seconds", "Message construction and serialization time per message.")
+BODY_BYTES = Histogram("mailer_body_bytes", "Encoded body size per message, by transfer encoding.", ("encoding",),
+                       buckets=BYTE_BUCKETS, unit="bytes")
+BODY_BASELINE_BYTES = Histogram("mailer_body_baseline_bytes", "Body size per message as MIMEText's default encoding (base64 for non-ASCII) would have sent it.",
+                                buckets=BYTE_BUCKETS, unit="bytes")
+DELIVERY_SECONDS = Histogram("mailer_delivery_seconds", "Relay round trip per message (SMTP transaction or HTTP request).", ("transport",))
+DELIVERY_TIMEOUTS = Counter("mailer_delivery_timeouts_total", "Sends broken off by the delivery watchdog, by reason (timeout/hedge) and outcome (requeued/failed).",
+                            ("transport", "reason", "outcome"))
+DELIVERY_RETRIES = Counter("mailer_delivery_retries_total", "Deliveries retried after a dropped connection.", ("transport",))
+RESPONSES = Counter("mailer_responses_total", "Relay responses by SMTP reply code or HTTP status.", ("transport", "code"))
+MESSAGES = Counter("mailer_messages_total", "Messages processed by outcome.", ("status",))
+BOUNCES = Counter("mailer_bounces_total", "Bounced recipients read from delivery status notifications, by kind (hard/soft).", ("kind",))
+TRACKING_EVENTS = Counter("mailer_tracking_events_total", "SendGrid webhook events stored, by event type.", ("event",))
+TLS_HANDSHAKE_SECONDS = Histogram("mailer_tls_handshake_seconds", "TLS handshake time for relay connections.", ("mode",))
+TLS_HANDSHAKES = Counter("mailer_tls_handshakes_total", "TLS handshakes by mode (full or resumed session).", ("mode",))
+RENDER_CACHE = Counter("mailer_render_cache_total", "Render cache lookups in the render processes, by result (hit/miss).", ("result",))
+QUEUE_DEPTH = Gauge("mailer_payload_queue_depth", "Rendered messages waiting for a delivery worker.")
+WORKERS_BUSY = Gauge("mailer_delivery_workers_busy", "Delivery workers currently talking to the relay.")
+WORKERS_TOTAL = Gauge("mailer_delivery_workers", "Delivery workers in running pipelines.")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrapes every few seconds would flood the console
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """Serves /metrics from a daemon thread. Safe to call on every Streamlit rerun."""
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, name="metrics-http", daemon=True).start()
+        return _server.server_address
+
+# Metrics recorded inside the render processes and shipped back per chunk
+RENDER_METRICS = (RENDER_SECONDS, MIME_BUILD_SECONDS, BODY_BYTES, BODY_BASELINE_BYTES, RENDER_CACHE)
@@ -0,0 +1,107 @@
+"""Email preview rendering for the app.
+
+Streamlit reruns the whole script on every widget interaction, so the preview
+used to substitute the template for its row and base64-encode every inline
+image on each keystroke anywhere on the page. PreviewRenderer keeps, per
+session:
+
+    the compiled template   rebuilt only when the template hash (syntax,
+                            subject, body, columns, images) changes
+    rendered previews       LRU keyed by (template hash, row key, digest of the
+                            row's referenced values), so edits to that row
+                            still show up
+    image data URIs         encoded once per image
+
+A rerun that changes nothing relevant renders nothing; multi-recipient
+previews render only the rows on screen.
+"""
+import base64
+import hashlib
+import mimetypes
+from collections import OrderedDict, namedtuple
+
+import pandas as pd
+
+from html_build import html_to_text
+from inline_images import content_id
+from rendering import referenced_columns, render_fields
+from templating import JINJA, JinjaRenderer
+
+Preview = namedtuple("Preview", "row_key recipient subject body_html text")
+
+DEFAULT_PREVIEW_ENTRIES = 64
+
+
+def _image_stamp(images):
+    # bytes cache their hash, so this is cheap after the first rerun
+    return tuple((image["name"], len(image["data"]), hash(image["data"])) for image in images or ())
+
+
+def template_digest(syntax, subject_template, body_template, columns, images=None):
+    key = repr((syntax, subject_template, body_template, tuple(columns), _image_stamp(images)))
+    return hashlib.sha1(key.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+class PreviewRenderer:
+    def __init__(self, max_entries=DEFAULT_PREVIEW_ENTRIES):
+        self.max_entries = max_entries
+        self.digest = None
+        self.jinja = None
+        self.referenced = ()
+        self.entries = OrderedDict() # (template digest, row key, values digest) -> Preview
+        self.data_uris = {} # image stamp -> data: URI
+        self.renders = 0 # Rows actually rendered (not served from the cache)
+
+    def _compile(self, syntax, subject_template, body_template, columns, images):
+        digest = template_digest(syntax, subject_template, body_template, columns, images)
+        if digest == self.digest:
+            return digest
+        if syntax == JINJA:
+            self.jinja = JinjaRenderer(subject_template, body_template, columns)
+            self.referenced = self.jinja.referenced
+        else:
+            self.jinja = None
+            self.referenced = referenced_columns(columns, subject_template, body_template)
+        self.digest = digest
+        return digest
+
+    def _with_data_uris(self, html, images):
+        for image in images or ():
+            if f"cid:{content_id(image['name'])}" not in html:
+                continue
+            stamp = _image_stamp([image])[0]
+            data_uri = self.data_uris.get(stamp)
+            if data_uri is None:
+                content_type = mimetypes.guess_type(image["name"])[0] or "application/octet-stream"
+                data_uri = self.data_uris[stamp] = f"data:{content_type};base64,{base64.b64encode(image['data']).decode('ascii')}"
+            html = html.replace(f"cid:{content_id(image['name'])}", data_uri)
+        return html
+
+    def render(self, syntax, subject_template, body_template, df, positions, images=None):
+        """One Preview per row position in df, from the cache where nothing relevant changed."""
+        columns = list(df.columns)
+        digest = self._compile(syntax, subject_template, body_template, columns, images)
+        previews = []
+        for position in positions:
+            row_key = df.index[position]
+            values = list(df.iloc[position].values)
+            recipient = values[columns.index('Email')] if 'Email' in columns else None
+            values_digest = hashlib.sha1(repr([values[i] for i in self.referenced]).encode("utf-8", "surrogatepass")).hexdigest()
+            key = (digest, row_key, values_digest)
+            preview = self.entries.get(key)
+            if preview is None:
+                if self.jinja is not None:
+                    subject, body, _ = self.jinja.render(columns, values)
+                else:
+                    subject, body = render_fields([columns[i] for i in self.referenced],
+                                                  [values[i] for i in self.referenced], subject_template, body_template)
+                self.renders += 1
+                preview = Preview(row_key, recipient if pd.notna(recipient) else None, subject,
+                                  self._with_data_uris(body, images).replace('\n', '<br>'), html_to_text(body))
+                self.entries[key] = preview
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            else:
+                self.entries.move_to_end(key)
+            previews.append(preview)
+        return previews
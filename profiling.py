@@ -0,0 +1,212 @@
+"""On-demand profiling of a campaign run.
+
+When a run is profiled, each stage profiles itself for the first N messages or
+T seconds, whichever comes first:
+
+* delivery threads run under cProfile (one profiler per thread),
+* render processes run cProfile for their own share of the messages,
+* a stack sampler in every process records collapsed stacks for flamegraphs,
+* tracemalloc (optional) records the top allocation sites.
+
+Each process writes its own files into the output directory. RunProfiler.finish()
+merges them into:
+
+    campaign.prof          pstats file (snakeviz, `python -m pstats`)
+    campaign.collapsed     collapsed stacks (flamegraph.pl, speedscope)
+    top_allocations.txt    tracemalloc report, if memory profiling was on
+"""
+import cProfile
+import glob
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+DEFAULT_SAMPLE_INTERVAL = 0.005
+TOP_ALLOCATIONS = 25
+
+
+def profile_settings(output_dir, max_messages=500, max_seconds=60.0, memory=False):
+    # Plain dict so it can travel to the render processes inside the campaign
+    return {"dir": output_dir, "max_messages": max_messages, "max_seconds": max_seconds, "memory": memory}
+
+
+class StackSampler(threading.Thread):
+    """Samples the stacks of all other threads in this process every `interval` seconds."""
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self.stop_event = threading.Event()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(names))] += 1
+
+    def stop(self):
+        self.stop_event.set()
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def write_top_allocations(snapshot, path, title):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"{title}\n")
+        for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+            f.write(f"{stat}\n")
+
+
+class ProfileWindow:
+    """Profiling state for one process: cProfile per thread, a stack sampler and tracemalloc."""
+
+    def __init__(self, settings, prefix):
+        self.settings = settings
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.started = time.monotonic()
+        self.active = True
+        self.profiles = []
+        self.sampler = StackSampler()
+        self.sampler.start()
+        if settings["memory"] and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.memory_snapshot = None
+
+    def profile_thread(self):
+        profile = cProfile.Profile()
+        with self.lock:
+            if not self.active:
+                return None
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows one active cProfile per interpreter, and it already sees every thread
+            return None
+        with self.lock:
+            self.profiles.append(profile)
+        return profile
+
+    def tick(self, profile=None, count=1):
+        """Counts processed messages; closes the window once the budget is used up."""
+        with self.lock:
+            self.messages += count
+            expired = (self.messages >= self.settings["max_messages"]
+                       or time.monotonic() - self.started >= self.settings["max_seconds"])
+            closing = expired and self.active
+            if closing:
+                self.active = False
+        if profile is not None and not self.active:
+            profile.disable()
+        if closing:
+            self._close()
+        return self.active
+
+    def _close(self):
+        self.sampler.stop()
+        if self.settings["memory"] and tracemalloc.is_tracing():
+            self.memory_snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+    def write(self):
+        os.makedirs(self.settings["dir"], exist_ok=True)
+        base = os.path.join(self.settings["dir"], self.prefix)
+        stats = None
+        for profile in self.profiles:
+            # Stats() snapshots (and disables) each profile
+            if profile.getstats():
+                stats = pstats.Stats(profile) if stats is None else stats.add(profile)
+        if stats is not None:
+            stats.dump_stats(base + ".prof")
+        self.sampler.write(base + ".collapsed")
+        if self.memory_snapshot is not None:
+            write_top_allocations(self.memory_snapshot, base + ".alloc.txt",
+                                  f"Top allocations in {self.prefix} ({self.messages} messages)")
+
+
+def start_render_profiling(settings):
+    """Profiles this render process; the report is written when the pool shuts the process down."""
+    from multiprocessing.util import Finalize
+
+    window = ProfileWindow(settings, f"render-{os.getpid()}")
+    profile = window.profile_thread()
+
+    def finish():
+        if window.active:
+            window.active = False
+            window._close()
+        window.write()
+
+    # Pool workers exit without running atexit hooks, but multiprocessing finalizers do run
+    Finalize(None, finish, exitpriority=10)
+    return window, profile
+
+
+class RunProfiler(ProfileWindow):
+    """Main-process profiler used by SendPipeline; also merges the render processes' output."""
+
+    def __init__(self, settings):
+        super().__init__(settings, f"deliver-{os.getpid()}")
+
+    def finish(self):
+        if self.active:
+            self.active = False
+            self._close()
+        self.write()
+        return merge_reports(self.settings["dir"])
+
+
+def merge_reports(output_dir):
+    prof_files = sorted(glob.glob(os.path.join(output_dir, "*-*.prof")))
+    if prof_files:
+        stats = pstats.Stats(*prof_files)
+        stats.dump_stats(os.path.join(output_dir, "campaign.prof"))
+
+    stacks = Counter()
+    for path in glob.glob(os.path.join(output_dir, "*-*.collapsed")):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                stack, _, count = line.rstrip("\n").rpartition(" ")
+                if stack:
+                    stacks[stack] += int(count)
+    with open(os.path.join(output_dir, "campaign.collapsed"), "w", encoding="utf-8") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+
+    alloc_files = sorted(glob.glob(os.path.join(output_dir, "*-*.alloc.txt")))
+    if alloc_files:
+        with open(os.path.join(output_dir, "top_allocations.txt"), "w", encoding="utf-8") as out:
+            for path in alloc_files:
+                with open(path, encoding="utf-8") as f:
+                    out.write(f.read() + "\n")
+    return output_dir
+
+
+def top_functions(output_dir, limit=15):
+    """(function, cumulative seconds, calls) rows from campaign.prof for the in-app summary."""
+    path = os.path.join(output_dir, "campaign.prof")
+    if not os.path.exists(path):
+        return []
+    stats = pstats.Stats(path)
+    rows = []
+    for (filename, line, name), (_, calls, _, cumulative, _) in stats.stats.items():
+        rows.append({"function": f"{name} ({os.path.basename(filename)}:{line})",
+                     "cumulative_s": round(cumulative, 4), "calls": calls})
+    rows.sort(key=lambda row: row["cumulative_s"], reverse=True)
+    return rows[:limit]
@@ -0,0 +1,176 @@
+"""Canonical recipient store used by the recipient grid.
+
+The Streamlit grid only ever receives one page of rows. Filtering, sorting and
+the summary counts are computed here, on the server, and cached against a
+version number that is bumped whenever rows are edited. Segments (segments.py)
+are cached the same way, along with the column conversions they need.
+"""
+import time
+
+import pandas as pd
+
+from segments import SegmentContext, compile_segment
+
+# Same pattern as app.is_valid_email, applied column-wise
+EMAIL_PATTERN = r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$"
+
+PAGE_SIZES = (50, 100, 250, 500)
+ANY_COLUMN = "(any column)"
+
+
+class RecipientStore:
+    def __init__(self, df: pd.DataFrame):
+        # Row keys are the DataFrame index, so they have to be unique
+        if not df.index.is_unique:
+            df = df.reset_index(drop=True)
+        self.df = df
+        self.version = 0
+        self._stats = None       # (version, stats dict)
+        self._views = {}         # (filter/sort spec) -> row keys, valid for self.version only
+        self._segments = {}      # (expression, engagement?, minute) -> row keys, valid for self.version only
+        self._derived = {}       # Column conversions for segments, valid for self.version only
+        self._engagement = None  # Engagement frame the derived engagement columns were aligned from
+
+    def __len__(self):
+        return len(self.df)
+
+    def _touch(self):
+        self.version += 1
+        self._stats = None
+        self._views = {}
+        self._segments = {}
+        self._derived = {}
+
+    # --- Cached aggregates ---
+
+    def email_stats(self) -> dict:
+        if self._stats is not None and self._stats[0] == self.version:
+            return self._stats[1]
+        if 'Email' not in self.df.columns:
+            stats = {"valid": 0, "invalid": 0, "empty": 0, "has_email_column": False}
+        else:
+            emails = self.df['Email']
+            stripped = emails.astype(str).str.strip()
+            empty = emails.isna() | (stripped == "")
+            valid = ~empty & stripped.str.match(EMAIL_PATTERN)
+            stats = {
+                "valid": int(valid.sum()),
+                "invalid": int((~empty & ~valid).sum()),
+                "empty": int(empty.sum()),
+                "has_email_column": True,
+            }
+        self._stats = (self.version, stats)
+        return stats
+
+    # --- Server-side filter/sort ---
+
+    def view_keys(self, filter_text: str = "", filter_column: str = ANY_COLUMN,
+                  sort_by: str = None, ascending: bool = True) -> pd.Index:
+        spec = (filter_text.strip().lower(), filter_column, sort_by, ascending)
+        cached = self._views.get(spec)
+        if cached is not None:
+            return cached
+
+        view = self.df
+        needle = spec[0]
+        if needle:
+            if filter_column in view.columns:
+                mask = view[filter_column].astype(str).str.lower().str.contains(needle, regex=False, na=False)
+            else:
+                mask = pd.Series(False, index=view.index)
+                for col in view.columns:
+                    mask |= view[col].astype(str).str.lower().str.contains(needle, regex=False, na=False)
+            view = view[mask]
+        if sort_by in view.columns:
+            view = view.sort_values(sort_by, ascending=ascending, kind="stable", na_position="last")
+
+        keys = view.index
+        self._views[spec] = keys
+        return keys
+
+    def segment_keys(self, expression: str, engagement: pd.DataFrame = None, now: float = None) -> pd.Index:
+        """Row keys matching a segment expression; raises segments.SegmentError."""
+        compiled = compile_segment(expression.strip(), tuple(self.df.columns))
+        if not compiled.engagement_fields:
+            engagement = None
+        elif engagement is not self._engagement:
+            # New engagement data: drop what was aligned from the old one
+            self._derived = {k: v for k, v in self._derived.items() if k[0] not in ("engagement", "engagement_rows")}
+            self._segments = {k: v for k, v in self._segments.items() if not k[1]}
+            self._engagement = engagement
+        now = time.time() if now is None else now
+        # Ages (last_open > 90d) move with the clock; those views are reused within the minute
+        spec = (compiled.expression, engagement is not None, int(now // 60) if compiled.uses_clock else None)
+        cached = self._segments.get(spec)
+        if cached is not None:
+            return cached
+        mask = compiled.mask(SegmentContext(self.df, engagement, self._derived, now))
+        keys = self.df.index[mask.to_numpy()]
+        self._segments[spec] = keys
+        return keys
+
+    def page(self, page: int, page_size: int, **view_spec):
+        """Returns (rows for the requested page, number of rows matching the view)."""
+        keys = self.view_keys(**view_spec)
+        start = max(page, 0) * page_size
+        return self.df.loc[keys[start:start + page_size]], len(keys)
+
+    # --- Writes by row key ---
+
+    def apply_page_edits(self, original: pd.DataFrame, edited: pd.DataFrame) -> int:
+        """Writes the differences between a page and its edited copy back to the store.
+
+        Rows whose key is missing from `edited` are deleted, rows with unknown keys are
+        appended, and only changed cells of the remaining rows are written.
+        Returns the number of rows touched.
+        """
+        touched = 0
+
+        removed = original.index.difference(edited.index)
+        if len(removed):
+            self.df = self.df.drop(index=removed)
+            touched += len(removed)
+
+        kept = edited.index.intersection(original.index)
+        if len(kept):
+            before = original.loc[kept, edited.columns.intersection(original.columns)]
+            after = edited.loc[kept, before.columns]
+            changed = ~((before == after) | (before.isna() & after.isna()))
+            changed_rows = changed.any(axis=1)
+            if changed_rows.any():
+                rows = changed_rows[changed_rows].index
+                for col in changed.columns[changed.loc[rows].any(axis=0)]:
+                    self.df.loc[rows, col] = after.loc[rows, col]
+                touched += len(rows)
+
+        added = edited.loc[edited.index.difference(original.index)]
+        added = added.dropna(how="all")
+        if len(added):
+            next_key = (self.df.index.max() + 1) if len(self.df) and pd.api.types.is_integer_dtype(self.df.index) else len(self.df)
+            added = added.copy()
+            added.index = pd.RangeIndex(next_key, next_key + len(added))
+            self.df = pd.concat([self.df, added])
+            touched += len(added)
+
+        if touched:
+            self._touch()
+        return touched
+
+
+def get_store(session_state):
+    """Returns the store for session_state.recipient_df, rebuilding it only when the DataFrame is replaced."""
+    df = session_state.get('recipient_df')
+    if df is None:
+        session_state.recipient_store = None
+        return None
+    store = session_state.get('recipient_store')
+    if store is None or store.df is not df:
+        store = RecipientStore(df)
+        session_state.recipient_store = store
+        session_state.recipient_df = store.df
+    return store
+
+
+def sync_session(session_state, store):
+    # Edits may replace store.df (row deletes/appends); keep recipient_df pointing at it
+    session_state.recipient_df = store.df
@@ -0,0 +1,352 @@
+"""Message rendering for the send pipeline.
+
+Everything in here runs inside the render process pool: placeholder
+substitution, MIME/SendGrid message construction and serialization. The
+campaign (templates, attachments, sender) is handed to each process once via
+the pool initializer, so chunks only carry row values.
+
+Rendered subject/body pairs (and the encoded SMTP body part) are memoized per
+process in an LRU keyed by the values of the columns the templates actually
+reference, so a template that only uses {Name} or {Region} renders once per
+distinct value instead of once per row.
+
+SMTP messages are assembled from pre-serialized pieces: everything but the
+To/Subject headers and the body part is the same for the whole campaign
+(fixed MIME boundary), so it is serialized once per process (SmtpFrame).
+With inline images the body part sits in a multipart/related next to them:
+
+    multipart/mixed
+      multipart/related          (only with inline images)
+        text/html or multipart/alternative
+        image/* (Content-ID)...
+      attachments...
+"""
+import base64
+import mimetypes
+import re
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+from email import encoders
+from email.message import Message
+from email.policy import compat32
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import pandas as pd
+
+from dkim_signing import DkimSigner
+from encoding_policy import choose_body_encoding, default_part_size, encoded_part_size, text_part
+from inline_images import mime_image_part
+from metrics import BODY_BASELINE_BYTES, BODY_BYTES, MIME_BUILD_SECONDS, REGISTRY, RENDER_CACHE, RENDER_METRICS, RENDER_SECONDS
+from profiling import start_render_profiling
+from recipient_store import EMAIL_PATTERN
+from templating import DEFAULT_BYTECODE_CACHE_DIR, JINJA, JinjaRenderer
+
+# payload is the serialized message (bytes for SMTP, a request body dict for SendGrid)
+RenderedMessage = namedtuple("RenderedMessage", "row_key row_number recipient payload error")
+
+# Serialized SMTP body part with its transfer encoding, wire size and MIMEText-default size (for the encoding report)
+BodyPart = namedtuple("BodyPart", "data encoding wire_size baseline_size")
+# Campaign-constant bytes around the per-message headers and body part
+SmtpFrame = namedtuple("SmtpFrame", "lead opening tail")
+
+WIRE_POLICY = compat32.clone(linesep="\r\n")
+
+DEFAULT_RENDER_CACHE_ENTRIES = 2048
+DEFAULT_RENDER_CACHE_BYTES = 32 * 1024 * 1024 # Per render process
+
+_campaign = None        # Set once per render process by init_render_worker
+_prebuilt_parts = None  # Attachments encoded once per process (an SmtpFrame for SMTP), reused for every message
+_profile = None         # (ProfileWindow, cProfile.Profile) while this process is being profiled
+_dkim_signer = None     # Key parsed once per process
+_render_cache = None    # RenderCache, or None when every row renders differently
+_jinja = None           # JinjaRenderer when the campaign uses the Jinja syntax
+
+
+def is_valid_email(email) -> bool:
+    if not email or not isinstance(email, str):
+        return False
+    return bool(re.match(EMAIL_PATTERN, email))
+
+
+class RenderCache:
+    """LRU of rendered output, bounded by entry count and (approximate) bytes held."""
+
+    def __init__(self, max_entries=DEFAULT_RENDER_CACHE_ENTRIES, max_bytes=DEFAULT_RENDER_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # key -> (value, size)
+        self.size = 0
+
+    def get(self, key):
+        item = self.entries.get(key)
+        if item is None:
+            RENDER_CACHE.labels("miss").inc()
+            return None
+        self.entries.move_to_end(key)
+        RENDER_CACHE.labels("hit").inc()
+        return item[0]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (value, size)
+        self.size += size
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+
+
+def referenced_columns(columns, *templates):
+    """Indices of the columns whose {placeholder} appears in any of the templates."""
+    return [i for i, col_name in enumerate(columns) if any(f"{{{col_name}}}" in template for template in templates)]
+
+
+def init_render_worker(campaign):
+    global _campaign, _prebuilt_parts, _profile, _dkim_signer, _render_cache, _jinja
+    _campaign = dict(campaign)
+    if campaign.get("profile"):
+        _profile = start_render_profiling(campaign["profile"])
+    # A forked process inherits the parent's metric values; don't ship them back
+    REGISTRY.take_deltas(RENDER_METRICS)
+    columns = campaign["columns"]
+    if campaign.get("template_syntax") == JINJA:
+        _jinja = JinjaRenderer(campaign["subject_template"], campaign["body_template"], columns,
+                               campaign.get("template_cache_dir") or DEFAULT_BYTECODE_CACHE_DIR,
+                               campaign.get("text_template"))
+        referenced = _jinja.referenced
+    else:
+        _jinja = None
+        referenced = referenced_columns(columns, campaign["subject_template"], campaign["body_template"],
+                                        campaign.get("text_template") or "")
+    _campaign["referenced"] = referenced
+    # Keyed on the recipient's own address nothing would ever be reused
+    cache_entries = campaign.get("render_cache_entries", DEFAULT_RENDER_CACHE_ENTRIES)
+    _render_cache = RenderCache(cache_entries) if cache_entries and columns.index('Email') not in referenced else None
+    if campaign["transport"] == "sendgrid":
+        _prebuilt_parts = (_sendgrid_attachments(campaign["attachments"])
+                           + _sendgrid_inline_images(campaign.get("inline_images") or ()))
+    else:
+        _prebuilt_parts = smtp_frame(campaign, _mime_attachments(campaign["attachments"], campaign.get("relay_capabilities")),
+                                     [mime_image_part(image) for image in campaign.get("inline_images") or ()])
+        _dkim_signer = DkimSigner(campaign["dkim"]) if campaign.get("dkim") else None
+
+
+def precompile_templates(campaign):
+    """Compiles Jinja templates in the calling process, so the render processes load them from the bytecode cache."""
+    if campaign.get("template_syntax") == JINJA:
+        JinjaRenderer(campaign["subject_template"], campaign["body_template"], campaign["columns"],
+                      campaign.get("template_cache_dir") or DEFAULT_BYTECODE_CACHE_DIR, campaign.get("text_template"))
+
+
+def _mime_attachments(attachments, capabilities=None):
+    parts = []
+    for attachment_data in attachments:
+        ctype, encoding = mimetypes.guess_type(attachment_data["name"])
+        if ctype is None or encoding is not None:
+            ctype = 'application/octet-stream'
+        maintype, subtype = ctype.split('/', 1)
+        text = _attachment_text(attachment_data["data"]) if maintype == "text" and capabilities is not None else None
+        if text is not None:
+            # Text attachments (CSV, plain text) get the same size-based choice as the body
+            part = text_part(text, subtype, choose_body_encoding(text, capabilities).encoding)
+        else:
+            part = MIMEBase(maintype, subtype)
+            part.set_payload(attachment_data["data"])
+            encoders.encode_base64(part)
+        part.add_header('Content-Disposition', f'attachment; filename="{attachment_data["name"]}"')
+        parts.append(part)
+    return parts
+
+
+def _sendgrid_attachments(attachments):
+    from sendgrid.helpers.mail import Attachment, Disposition, FileContent, FileName, FileType
+
+    parts = []
+    for attachment_data in attachments:
+        parts.append(Attachment(
+            FileContent(base64.b64encode(attachment_data["data"]).decode()),
+            FileName(attachment_data["name"]),
+            FileType(mimetypes.guess_type(attachment_data["name"])[0] or 'application/octet-stream'),
+            Disposition('attachment')
+        ))
+    return parts
+
+
+def _sendgrid_inline_images(images):
+    from sendgrid.helpers.mail import Attachment, ContentId, Disposition, FileContent, FileName, FileType
+
+    return [Attachment(FileContent("".join(image.encoded.split())), FileName(image.name), FileType(image.content_type),
+                       Disposition('inline'), ContentId(image.cid))
+            for image in images]
+
+
+def render_fields(columns, values, *templates):
+    """{Column} substitution; returns the rendered templates in the order given."""
+    rendered = list(templates)
+    for col_name, value in zip(columns, values):
+        placeholder = f"{{{col_name}}}"
+        replacement_value = str(value) if pd.notna(value) else ""
+        rendered = [template.replace(placeholder, replacement_value) for template in rendered]
+    return rendered
+
+
+def _attachment_text(data):
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+
+
+def _multipart_bytes(delimiter, parts):
+    return b"".join(b"\r\n" + delimiter + b"\r\n" + part.as_bytes(policy=WIRE_POLICY) for part in parts)
+
+
+def smtp_frame(campaign, attachment_parts, inline_parts=()):
+    """The bytes MIMEMultipart would write around To/Subject and the body part, serialized once."""
+    boundary = campaign.get("mime_boundary") or "===============" + uuid.uuid4().hex + "=="
+    lead = Message()
+    lead['Content-Type'] = f'multipart/mixed; boundary="{boundary}"'
+    lead['MIME-Version'] = '1.0'
+    lead['From'] = campaign["sender"]
+    lead.set_payload("") # Headers only; a multipart lead without parts would get an empty body written
+    delimiter = f"--{boundary}".encode()
+    # Wire line endings up front, so the SMTP client has nothing left to convert
+    opening = delimiter + b"\r\n"
+    tail = _multipart_bytes(delimiter, attachment_parts) + b"\r\n" + delimiter + b"--\r\n"
+    if inline_parts:
+        related = Message()
+        root_type = "text/html" if campaign.get("text_template") is None else "multipart/alternative"
+        related['Content-Type'] = f'multipart/related; boundary="{boundary}.rel"; type="{root_type}"'
+        related['MIME-Version'] = '1.0'
+        related.set_payload("")
+        related_delimiter = f"--{boundary}.rel".encode()
+        opening += related.as_bytes(policy=WIRE_POLICY) + related_delimiter + b"\r\n"
+        tail = (_multipart_bytes(related_delimiter, inline_parts) + b"\r\n" + related_delimiter + b"--\r\n"
+                + tail)
+    return SmtpFrame(lead.as_bytes(policy=WIRE_POLICY)[:-2], # Without the blank line that ends the headers
+                     opening, tail)
+
+
+def _encoded_text_part(text, subtype, encoding):
+    # Encodings are decided once per campaign from the relay's EHLO (see encoding_policy)
+    return text_part(text, subtype, encoding) if encoding else MIMEText(text, subtype)
+
+
+def smtp_body_part(campaign, body, text=None):
+    """The serialized body: text/html, or multipart/alternative (text/plain + text/html) with a text version."""
+    html_part = _encoded_text_part(body, 'html', campaign.get("body_encoding"))
+    if text is None:
+        return BodyPart(html_part.as_bytes(policy=WIRE_POLICY), html_part["Content-Transfer-Encoding"],
+                        encoded_part_size(html_part), default_part_size(body))
+    plain_part = _encoded_text_part(text, 'plain', campaign.get("text_encoding"))
+    alternative = MIMEMultipart('alternative')
+    alternative.attach(plain_part)
+    alternative.attach(html_part)
+    if campaign.get("mime_boundary"):
+        alternative.set_boundary(campaign["mime_boundary"] + ".alt") # Fixed, like the outer boundary
+    return BodyPart(alternative.as_bytes(policy=WIRE_POLICY), html_part["Content-Transfer-Encoding"],
+                    encoded_part_size(html_part) + encoded_part_size(plain_part),
+                    default_part_size(body) + default_part_size(text))
+
+
+def build_smtp_payload(campaign, recipient_email, subject, body, frame, body_part=None, text=None):
+    if body_part is None:
+        body_part = smtp_body_part(campaign, body, text)
+    BODY_BYTES.labels(body_part.encoding).observe(body_part.wire_size)
+    BODY_BASELINE_BYTES.observe(body_part.baseline_size)
+    headers = Message()
+    headers['To'] = recipient_email
+    headers['Subject'] = subject
+    payload = b"".join((frame.lead, headers.as_bytes(policy=WIRE_POLICY), frame.opening, body_part.data, frame.tail))
+    return _dkim_signer.sign(payload) if _dkim_signer is not None else payload
+
+
+def build_sendgrid_payload(campaign, recipient_email, subject, body, attachment_parts, body_part=None, text=None):
+    from sendgrid.helpers.mail import (
+        ClickTracking, CustomArg, From, HtmlContent, Mail, OpenTracking, PlainTextContent, Subject, To, TrackingSettings
+    )
+
+    message = Mail(
+        from_email=From(campaign["sender"]),
+        to_emails=To(recipient_email),
+        subject=Subject(subject),
+        plain_text_content=PlainTextContent(text) if text is not None else None,
+        html_content=HtmlContent(body)
+    )
+    for attachment in attachment_parts:
+        message.attachment = attachment # Appends to internal list
+    if campaign.get("tracking", True):
+        tracking_settings = TrackingSettings()
+        tracking_settings.open_tracking = OpenTracking(enable=True)
+        tracking_settings.click_tracking = ClickTracking(enable=True, enable_text=True)
+        message.tracking_settings = tracking_settings
+    if campaign.get("campaign_id"):
+        # Echoed back in every webhook event, so sendgrid_events.py can roll events up per campaign
+        message.custom_arg = CustomArg("campaign_id", campaign["campaign_id"])
+    return message.get()
+
+
+def render_chunk(rows):
+    """Renders a chunk of (row_key, row_number, values) tuples.
+
+    Returns (RenderedMessages, metric deltas) - the deltas are merged into the
+    parent process's histograms by the pipeline.
+    """
+    global _profile
+    campaign = _campaign
+    render_hist = RENDER_SECONDS.labels()
+    build_hist = MIME_BUILD_SECONDS.labels()
+    columns = campaign["columns"]
+    email_index = columns.index('Email')
+    smtp = campaign["transport"] != "sendgrid"
+    build_payload = build_smtp_payload if smtp else build_sendgrid_payload
+    # Only referenced columns are substituted; the others can't change the output
+    referenced = campaign["referenced"]
+    referenced_names = [columns[i] for i in referenced]
+    text_template = campaign.get("text_template")
+    suppressed = campaign.get("suppressed")
+
+    rendered = []
+    for row_key, row_number, values in rows:
+        recipient_email = values[email_index]
+        if not recipient_email or pd.isna(recipient_email) or not is_valid_email(recipient_email):
+            rendered.append(RenderedMessage(row_key, row_number, recipient_email, None,
+                                            f"Invalid or missing email address '{recipient_email}'."))
+            continue
+        if suppressed and recipient_email.strip().lower() in suppressed:
+            rendered.append(RenderedMessage(row_key, row_number, recipient_email, None,
+                                            f"Suppressed: {suppressed[recipient_email.strip().lower()]}"))
+            continue
+        try:
+            started = time.perf_counter()
+            field_values = [values[i] for i in referenced]
+            key = tuple(str(value) if pd.notna(value) else "" for value in field_values)
+            cached = _render_cache.get(key) if _render_cache is not None else None
+            if cached is None:
+                if _jinja is not None:
+                    subject, body, text = _jinja.render(referenced_names, field_values)
+                elif text_template is not None:
+                    subject, body, text = render_fields(referenced_names, field_values, campaign["subject_template"],
+                                                        campaign["body_template"], text_template)
+                else:
+                    subject, body = render_fields(referenced_names, field_values,
+                                                  campaign["subject_template"], campaign["body_template"])
+                    text = None
+                body_part = smtp_body_part(campaign, body, text) if smtp else None
+                cached = (subject, body, text, body_part)
+                if _render_cache is not None:
+                    _render_cache.put(key, cached, 3 * (len(subject) + len(body) + len(text or "")))
+            subject, body, text, body_part = cached
+            rendered_at = time.perf_counter()
+            payload = build_payload(campaign, recipient_email, subject, body, _prebuilt_parts, body_part, text)
+            render_hist.observe(rendered_at - started)
+            build_hist.observe(time.perf_counter() - rendered_at)
+            rendered.append(RenderedMessage(row_key, row_number, recipient_email, payload, None))
+        except Exception as e_render:
+            rendered.append(RenderedMessage(row_key, row_number, recipient_email, None, f"Render error: {e_render}"))
+    if _profile is not None and not _profile[0].tick(_profile[1], len(rows)):
+        _profile = None
+    return rendered, REGISTRY.take_deltas(RENDER_METRICS)
@@ -0,0 +1,322 @@
+"""Server-wide pools of relay connections and API clients.
+
+Streamlit runs every browser session's script in the same server process, so
+anything kept in module state here is shared by all operators (and by the
+in-app campaign worker). Without it each session opened its own SMTP
+connections and built its own SendGrid, OpenAI and Google Sheets clients on
+every run and threw them away.
+
+    ResourcePool     exclusive checkout (SMTP connections, sendmail -bs
+                     processes, Sheets services - none of them thread-safe);
+                     at most max_size open, idle ones closed after idle_timeout
+    FairShare        the pool's slot scheduler: while campaigns wait, each gets
+                     at most capacity / active campaigns slots, so a big job
+                     can't starve a small one; alone, a campaign may use them all
+    shared_client()  one thread-safe client per key (OpenAI, SendGrid), closed
+                     when unused for CLIENT_IDLE_SECONDS
+
+Pools and clients are keyed by a credential fingerprint (a hash, so the
+registry never holds secrets as keys): sessions using the same relay login or
+API key share them, different logins never do. A daemon thread reaps idle
+resources.
+"""
+import hashlib
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+from metrics import Gauge
+
+DEFAULT_MAX_CONNECTIONS = 8 # Per credential; relays commonly cap concurrent connections per login around here
+DEFAULT_IDLE_TIMEOUT = 60.0 # Relays drop idle SMTP connections after a few minutes; close ours well before
+CLIENT_IDLE_SECONDS = 900.0
+REAP_INTERVAL = 15.0
+
+POOL_CONNECTIONS = Gauge("mailer_pool_connections", "Pooled relay connections and clients, by kind and state (idle/in_use).",
+                         ("kind", "state"))
+
+
+def credential_fingerprint(*parts):
+    """Stable short hash of connection settings and secrets."""
+    digest = hashlib.sha256("\0".join("" if part is None else str(part) for part in parts).encode())
+    return digest.hexdigest()[:24]
+
+
+class FairShare:
+    """Counting semaphore that shares its slots fairly between owners (campaigns)."""
+
+    def __init__(self, capacity):
+        self.capacity = max(1, int(capacity))
+        self.holding = Counter()
+        self.waiting = Counter()
+        self.condition = threading.Condition()
+
+    def _may_take(self, owner):
+        if sum(self.holding.values()) >= self.capacity:
+            return False
+        owners = set(self.holding) | set(self.waiting)
+        share = max(1, self.capacity // len(owners))
+        if self.holding[owner] < share:
+            return True
+        # Over its share: only if nobody under theirs is waiting (work-conserving)
+        return not any(self.holding[other] < share for other in self.waiting if other != owner)
+
+    def acquire(self, owner, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            self.waiting[owner] += 1
+            try:
+                while not self._may_take(owner):
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting[owner] -= 1
+                if not self.waiting[owner]:
+                    del self.waiting[owner]
+            self.holding[owner] += 1
+            return True
+
+    def release(self, owner):
+        with self.condition:
+            self.holding[owner] -= 1
+            if not self.holding[owner]:
+                del self.holding[owner]
+            self.condition.notify_all()
+
+    def owners(self):
+        with self.condition:
+            return sorted(set(self.holding) | set(self.waiting))
+
+
+class ResourcePool:
+    """Idle resources for one key, checked out exclusively under a FairShare slot."""
+
+    def __init__(self, kind, factory, close, max_size=DEFAULT_MAX_CONNECTIONS, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.kind = kind
+        self.factory = factory
+        self.close_resource = close
+        self.idle_timeout = idle_timeout
+        self.fair_share = FairShare(max_size)
+        self.idle = deque() # (resource, returned at); newest on the right
+        self.in_use = 0
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+    def checkout(self, owner="default"):
+        self.fair_share.acquire(owner)
+        with self.lock:
+            resource = self.idle.pop()[0] if self.idle else None # LIFO: the warmest first, so extras age out
+            self.in_use += 1
+            self.last_used = time.monotonic()
+        if resource is None:
+            try:
+                resource = self.factory()
+            except BaseException:
+                self._returned(owner)
+                raise
+        return resource
+
+    def checkin(self, resource, owner="default", broken=False):
+        if broken:
+            self._close(resource)
+        else:
+            with self.lock:
+                self.idle.append((resource, time.monotonic()))
+        self._returned(owner)
+
+    def _returned(self, owner):
+        with self.lock:
+            self.in_use -= 1
+            self.last_used = time.monotonic()
+        self.fair_share.release(owner)
+
+    @contextmanager
+    def resource(self, owner="default"):
+        resource = self.checkout(owner)
+        try:
+            yield resource
+        except BaseException:
+            self.checkin(resource, owner, broken=True)
+            raise
+        self.checkin(resource, owner)
+
+    def _close(self, resource):
+        try:
+            self.close_resource(resource)
+        except Exception:
+            pass
+
+    def evict_idle(self, now=None, max_idle=None):
+        """Closes resources idle longer than max_idle (default idle_timeout); returns how many."""
+        cutoff = (now or time.monotonic()) - (self.idle_timeout if max_idle is None else max_idle)
+        expired = []
+        with self.lock:
+            while self.idle and self.idle[0][1] <= cutoff:
+                expired.append(self.idle.popleft()[0])
+        for resource in expired:
+            self._close(resource)
+        return len(expired)
+
+    def stats(self):
+        with self.lock:
+            return {"kind": self.kind, "idle": len(self.idle), "in_use": self.in_use,
+                    "max": self.fair_share.capacity, "campaigns": len(self.fair_share.owners())}
+
+    def close(self):
+        self.evict_idle(max_idle=-1)
+
+
+# --- Registry ---
+
+_lock = threading.Lock()
+_pools = {} # (kind, fingerprint) -> ResourcePool
+_clients = {} # (kind, fingerprint) -> [client, close, last used]
+_reaper = None
+
+
+def _ensure_reaper():
+    global _reaper
+    if _reaper is None or not _reaper.is_alive():
+        _reaper = threading.Thread(target=_reap_forever, name="resource-pool-reaper", daemon=True)
+        _reaper.start()
+
+
+def _reap_forever():
+    while True:
+        time.sleep(REAP_INTERVAL)
+        reap()
+
+
+def reap(now=None):
+    """Closes idle pooled resources and unused clients; drops pools nobody has used for a while."""
+    now = now or time.monotonic()
+    with _lock:
+        pools = list(_pools.items())
+        stale_clients = [(key, entry) for key, entry in _clients.items() if now - entry[2] > CLIENT_IDLE_SECONDS]
+        for key, _ in stale_clients:
+            del _clients[key]
+    for key, pool in pools:
+        pool.evict_idle(now)
+        stats = pool.stats()
+        if not stats["idle"] and not stats["in_use"] and now - pool.last_used > CLIENT_IDLE_SECONDS:
+            with _lock:
+                if _pools.get(key) is pool:
+                    del _pools[key]
+    for _, (client, close, _) in stale_clients:
+        if close is not None:
+            try: close(client)
+            except Exception: pass
+    _update_gauges()
+
+
+def _update_gauges():
+    totals = Counter()
+    with _lock:
+        pools = list(_pools.values())
+        clients = Counter(kind for kind, _ in _clients)
+    for pool in pools:
+        stats = pool.stats()
+        totals[(pool.kind, "idle")] += stats["idle"]
+        totals[(pool.kind, "in_use")] += stats["in_use"]
+    for kind, count in clients.items():
+        totals[(kind, "shared")] += count
+    for (kind, state), count in totals.items():
+        POOL_CONNECTIONS.labels(kind, state).set(count)
+
+
+def get_pool(kind, fingerprint, factory, close, max_size=None, idle_timeout=None):
+    """The server-wide pool for this kind and credential, created on first use.
+
+    A later caller's max_size / idle_timeout replace the pool's (the latest config wins).
+    """
+    key = (kind, fingerprint)
+    with _lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ResourcePool(kind, factory, close, max_size or DEFAULT_MAX_CONNECTIONS,
+                                              idle_timeout or DEFAULT_IDLE_TIMEOUT)
+        else:
+            if max_size:
+                with pool.fair_share.condition:
+                    pool.fair_share.capacity = max(1, int(max_size))
+                    pool.fair_share.condition.notify_all()
+            if idle_timeout:
+                pool.idle_timeout = idle_timeout
+        _ensure_reaper()
+    return pool
+
+
+def shared_client(kind, fingerprint, factory, close=None):
+    """One client per kind and credential for the whole server (the client must be thread-safe)."""
+    key = (kind, fingerprint)
+    with _lock:
+        entry = _clients.get(key)
+        if entry is None:
+            entry = _clients[key] = [factory(), close, 0.0]
+        entry[2] = time.monotonic()
+        _ensure_reaper()
+        return entry[0]
+
+
+def pool_stats():
+    """One dict per pool plus the shared clients' counts, for the UI."""
+    with _lock:
+        pools = list(_pools.values())
+        clients = Counter(kind for kind, _ in _clients)
+    rows = [pool.stats() for pool in pools]
+    rows += [{"kind": kind, "idle": 0, "in_use": 0, "max": None, "campaigns": None, "shared": count}
+             for kind, count in sorted(clients.items())]
+    return rows
+
+
+def close_all():
+    with _lock:
+        pools = list(_pools.values())
+        clients = list(_clients.values())
+        _pools.clear()
+        _clients.clear()
+    for pool in pools:
+        pool.close()
+    for client, close, _ in clients:
+        if close is not None:
+            try: close(client)
+            except Exception: pass
+
+
+# --- API clients ---
+
+def openai_client(api_key, base_url):
+    """Shared openai.OpenAI client (it keeps an HTTP connection pool of its own)."""
+    import openai
+    return shared_client("openai", credential_fingerprint(base_url, api_key),
+                         lambda: openai.OpenAI(base_url=base_url, api_key=api_key), close=lambda client: client.close())
+
+
+def sendgrid_client(api_key, timeout=None):
+    from sendgrid import SendGridAPIClient
+
+    def create():
+        client = SendGridAPIClient(api_key=api_key)
+        client.client.timeout = timeout # python_http_client hands it to every request it builds
+        return client
+
+    return shared_client("sendgrid", credential_fingerprint(api_key, timeout), create)
+
+
+@contextmanager
+def sheets_service(credentials):
+    """A Google Sheets API service for these OAuth credentials, checked out of a pool.
+
+    Building the service parses the API's discovery document; its httplib2
+    transport isn't thread-safe, so sessions check one out instead of sharing it.
+    """
+    from googleapiclient.discovery import build
+    fingerprint = credential_fingerprint(getattr(credentials, "client_id", None),
+                                         getattr(credentials, "refresh_token", None) or getattr(credentials, "token", None))
+    pool = get_pool("google_sheets", fingerprint, lambda: build('sheets', 'v4', credentials=credentials),
+                    lambda service: service.close(), max_size=4, idle_timeout=CLIENT_IDLE_SECONDS)
+    with pool.resource() as service:
+        yield service
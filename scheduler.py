@@ -0,0 +1,199 @@
+"""Scheduled, time-windowed campaigns.
+
+A scheduled campaign is queued on the work queue like any other, but each
+shard gets a not_before time and stays unclaimable until then. The campaign
+workers (campaign_worker.py, or the one the app runs in a background thread)
+are the persistent service: the schedule lives in the queue database, so it
+survives the browser tab, the app and the workers themselves being
+restarted.
+
+Send times are planned per recipient timezone:
+
+    start_at     nothing goes out earlier
+    window       allowed local hours and weekdays, e.g. 9-17 Monday to Friday
+    spread       seconds over which to spread the list (0 = as soon as allowed)
+
+Recipients are bucketed by their timezone column (IANA names such as
+Europe/Berlin; unknown or missing -> the default timezone). For each bucket the
+allowed intervals in UTC are computed once, and the bucket's recipients are
+spread evenly over the allowed time inside [start_at, start_at + spread] with
+numpy - the loops run over timezones and days, not recipients. Send times are
+rounded down to slots and recipients sharing a slot become shards, so the
+workers get a steady trickle of small shards instead of the whole list at
+once and the relay sees a smoothed load.
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, time as dt_time, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+SendWindow = namedtuple("SendWindow", "start_hour end_hour weekdays") # Local hours [start, end), weekdays 0 = Monday
+Schedule = namedtuple("Schedule", "start_at window spread tz_column default_tz")
+
+ALL_DAYS = (0, 1, 2, 3, 4, 5, 6)
+DEFAULT_WINDOW = SendWindow(9, 17, ALL_DAYS)
+DEFAULT_SLOT_SECONDS = 300
+DEFAULT_SHARD_SIZE = 1000
+LOOKAHEAD_DAYS = 8 # A window that allows at least one day a week always has an interval within this
+WORKER_RESTART_BACKOFF = 5.0 # Seconds before the background worker restarts after an error; doubles up to the max
+MAX_WORKER_RESTART_BACKOFF = 300.0
+
+
+def _zone(name, default_tz):
+    try:
+        return ZoneInfo(str(name)), True
+    except (ZoneInfoNotFoundError, ValueError):
+        return ZoneInfo(default_tz), False
+
+
+def allowed_intervals(zone, window, start, end):
+    """UTC (start, end) epoch pairs of the window's local hours overlapping [start, end]."""
+    intervals = []
+    day = datetime.fromtimestamp(start, zone).date() - timedelta(days=1) # The previous day's window may run past midnight
+    last_day = datetime.fromtimestamp(end, zone).date()
+    while day <= last_day:
+        if day.weekday() in window.weekdays:
+            # Aware datetime + timedelta is wall-clock arithmetic, so DST days still open and close on the hour
+            midnight = datetime.combine(day, dt_time(0), zone)
+            end_hour = window.end_hour if window.end_hour > window.start_hour else window.end_hour + 24 # Overnight
+            opens = midnight + timedelta(hours=window.start_hour)
+            closes = midnight + timedelta(hours=end_hour)
+            lo, hi = max(opens.timestamp(), start), min(closes.timestamp(), end)
+            if hi > lo:
+                intervals.append((lo, hi))
+        day += timedelta(days=1)
+    return intervals
+
+
+def _spread_times(intervals, count, spread):
+    # count send times spread evenly over the intervals' total length (all at the first instant if not spreading)
+    starts = np.array([lo for lo, _ in intervals])
+    lengths = np.array([hi - lo for lo, hi in intervals])
+    if not spread or count == 0:
+        return np.full(count, starts[0])
+    ends = np.cumsum(lengths)
+    offsets = (np.arange(count) + 0.5) * (ends[-1] / count)
+    index = np.minimum(np.searchsorted(ends, offsets, side="right"), len(intervals) - 1)
+    return starts[index] + offsets - (ends[index] - lengths[index])
+
+
+def plan_send_times(df, schedule):
+    """(send time per row as an epoch-seconds array, {timezone: recipients}, rows with an unknown timezone)."""
+    start = schedule.start_at
+    end = start + (schedule.spread or 0)
+    if schedule.tz_column and schedule.tz_column in df.columns:
+        codes, zone_names = pd.factorize(df[schedule.tz_column].astype("string").str.strip())
+    else:
+        codes, zone_names = np.zeros(len(df), dtype=np.int64), pd.Index([schedule.default_tz])
+    codes = np.where(codes < 0, len(zone_names), codes) # Missing -> the default timezone's bucket
+    zone_names = list(zone_names) + [schedule.default_tz]
+
+    send_times = np.empty(len(df))
+    buckets, unknown = {}, 0
+    counts = np.bincount(codes, minlength=len(zone_names))
+    order = np.argsort(codes, kind="stable")
+    position = 0
+    for code, count in enumerate(counts):
+        if not count:
+            continue
+        rows = order[position:position + count]
+        position += count
+        zone, known = _zone(zone_names[code], schedule.default_tz)
+        if not known:
+            unknown += int(count)
+        intervals = allowed_intervals(zone, schedule.window, start, end) if end > start else []
+        if not intervals:
+            # Nothing allowed inside the spread: use the next allowed interval, up to the spread's length
+            upcoming = allowed_intervals(zone, schedule.window, start, start + LOOKAHEAD_DAYS * 86400)
+            if not upcoming:
+                raise ValueError("The send window doesn't allow any time (check the hours and weekdays)")
+            lo, hi = upcoming[0]
+            intervals = [(lo, min(hi, lo + schedule.spread) if schedule.spread else hi)]
+        send_times[rows] = _spread_times(intervals, count, schedule.spread)
+        buckets[zone.key] = buckets.get(zone.key, 0) + int(count)
+    return send_times, buckets, unknown
+
+
+def scheduled_shards(df, send_times, slot_seconds=DEFAULT_SLOT_SECONDS, shard_size=DEFAULT_SHARD_SIZE):
+    """Yields (not_before, rows) in send order; rows are (row_key, row_number, values) like iter_row_chunks."""
+    slots = np.floor(send_times / slot_seconds) * slot_seconds
+    order = np.lexsort((np.arange(len(df)), slots))
+    chunk, chunk_slot = [], None
+    for position, row in zip(order, df.iloc[order].itertuples(index=True, name=None)):
+        slot = float(slots[position])
+        if chunk and (slot != chunk_slot or len(chunk) >= shard_size):
+            yield chunk_slot, chunk
+            chunk = []
+        chunk_slot = slot
+        chunk.append((row[0], int(position) + 1, row[1:]))
+    if chunk:
+        yield chunk_slot, chunk
+
+
+def schedule_summary(send_times, buckets, unknown):
+    """Numbers for the UI: first and last send, peak per hour, buckets."""
+    if not len(send_times):
+        return {"first": None, "last": None, "peak_per_hour": 0, "timezones": buckets, "unknown_timezones": unknown}
+    hours = np.floor(send_times / 3600)
+    return {"first": float(send_times.min()), "last": float(send_times.max()),
+            "peak_per_hour": int(np.unique(hours, return_counts=True)[1].max()),
+            "timezones": buckets, "unknown_timezones": unknown}
+
+
+# --- In-process worker for the app ---
+
+_background_workers = {} # queue URL -> (CampaignWorker, thread)
+_background_lock = threading.Lock()
+
+
+def start_background_worker(queue_url, idle_sleep=5.0):
+    """Runs one campaign worker in a daemon thread of this process (once per queue URL); returns it.
+
+    For Streamlit: the thread lives in the server process, so scheduled shards
+    keep going out with no browser tab open. Separate campaign_worker.py
+    processes can claim from the same queue alongside it.
+    """
+    from campaign_worker import CampaignWorker
+    from work_queue import open_queue
+
+    with _background_lock:
+        running = _background_workers.get(queue_url)
+        if running is not None and running[1].is_alive():
+            return running[0]
+        worker = CampaignWorker(open_queue(queue_url), worker_id=f"app-{int(time.time())}")
+
+        def run():
+            # Shard failures are handled inside worker.run(); this catches the rest (e.g. the queue database
+            # being locked or unreachable) so the thread restarts instead of waiting for a Streamlit rerun
+            backoff = WORKER_RESTART_BACKOFF
+            try:
+                while not worker.stop_event.is_set():
+                    started = time.monotonic()
+                    try:
+                        worker.run(idle_sleep=idle_sleep)
+                    except Exception:
+                        if time.monotonic() - started > MAX_WORKER_RESTART_BACKOFF:
+                            backoff = WORKER_RESTART_BACKOFF # Ran fine for a while; a fresh failure
+                        log.exception("Background campaign worker failed; restarting in %.0f s", backoff)
+                        worker.stop_event.wait(backoff)
+                        backoff = min(MAX_WORKER_RESTART_BACKOFF, backoff * 2)
+            finally:
+                worker.work_queue.close()
+
+        thread = threading.Thread(target=run, name="campaign-scheduler", daemon=True)
+        thread.start()
+        _background_workers[queue_url] = (worker, thread)
+        return worker
+
+
+def background_worker_running(queue_url):
+    with _background_lock:
+        running = _background_workers.get(queue_url)
+        return running is not None and running[1].is_alive()
@@ -0,0 +1,476 @@
+"""Recipient segments: filter expressions compiled to vectorized pandas operations.
+
+    Region == 'EU' and last_open > 90d
+    Plan in ('pro', 'team') and not contains(Company, 'test')
+    `Signup Date` >= '2025-01-01' or domain(Email) == 'example.com'
+    opens >= 3 and last_click < 30d
+
+Names are recipient columns (case-insensitive; backquote names with spaces)
+or engagement fields from the SendGrid event store (sendgrid_events.py):
+
+    last_open, last_click, last_delivered, last_bounce    latest event time
+    opens, clicks, bounces                                event counts
+
+A time field compared with a duration (30m, 12h, 90d, 2w) compares its age:
+`last_open > 90d` is "last opened more than 90 days ago", and recipients who
+never opened count as infinitely long ago. Compared with a date string it
+compares the time itself. Functions: contains(col, text) (case-insensitive),
+startswith, endswith, domain(col), lower(col), missing(col), present(col).
+
+An expression is parsed once (Python's ast, so the usual operators and
+precedence apply) into a tree of closures; evaluating it runs one pandas
+operation per node over whole columns, never a Python loop over rows. Column
+coercions (numbers, dates, normalized emails) and engagement columns aligned
+to the recipients are cached by RecipientStore per data version, so refining
+a segment on a large list only repeats the comparisons.
+"""
+import ast
+import json
+import os
+import re
+import time
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+DURATION_UNITS = {"m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+# Engagement field -> (event type, "last_at" or "count")
+ENGAGEMENT_FIELDS = {
+    "last_open": ("open", "last_at"),
+    "last_click": ("click", "last_at"),
+    "last_delivered": ("delivered", "last_at"),
+    "last_bounce": ("bounce", "last_at"),
+    "opens": ("open", "count"),
+    "clicks": ("click", "count"),
+    "bounces": ("bounce", "count"),
+}
+DEFAULT_SEGMENTS_FILE = os.path.join("contact_lists", "segments.json")
+_EPOCH = pd.Timestamp(0, tz="UTC")
+
+_TOKEN_RE = re.compile(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")|`([^`]+)`|\b(\d+(?:\.\d+)?)([mhdw])\b""")
+_PLACEHOLDER_RE = re.compile(r"\b__(?:col|dur)\d+\b")
+_COMPARISONS = {
+    ast.Eq: lambda a, b: a == b, ast.NotEq: lambda a, b: a != b,
+    ast.Lt: lambda a, b: a < b, ast.LtE: lambda a, b: a <= b,
+    ast.Gt: lambda a, b: a > b, ast.GtE: lambda a, b: a >= b,
+}
+
+
+class SegmentError(ValueError):
+    pass
+
+
+class Duration(float):
+    """Seconds, written as 90d etc. in an expression."""
+
+
+class _Field:
+    # A column reference, resolved against the data at evaluation time
+    def __init__(self, name, engagement=None):
+        self.name = name
+        self.engagement = engagement # (event, "last_at"/"count") for engagement fields
+
+    @property
+    def is_time(self):
+        return self.engagement is not None and self.engagement[1] == "last_at"
+
+
+class SegmentContext:
+    """The data an expression runs against: recipient frame, engagement rows, and a cache of derived columns."""
+
+    def __init__(self, df, engagement=None, cache=None, now=None):
+        self.df = df
+        self.engagement = engagement # DataFrame indexed by normalized email: one column per engagement field
+        self.cache = {} if cache is None else cache
+        self.now = time.time() if now is None else now
+
+    def _cached(self, key, build):
+        value = self.cache.get(key)
+        if value is None:
+            value = self.cache[key] = build()
+        return value
+
+    def column(self, field):
+        if field.engagement is not None:
+            return self._cached(("engagement", field.name), lambda: self._engagement_column(field))
+        return self.df[field.name]
+
+    def numeric(self, field):
+        if field.engagement is not None:
+            return self.column(field)
+        values = self.df[field.name]
+        if pd.api.types.is_numeric_dtype(values.dtype) and not pd.api.types.is_bool_dtype(values.dtype):
+            return values
+        return self._cached(("numeric", field.name), lambda: self._by_unique(field, lambda u: pd.to_numeric(u, errors="coerce")))
+
+    def text(self, field):
+        # Equality and membership compare the raw column; only non-text columns are converted
+        values = self.column(field)
+        if pd.api.types.is_string_dtype(values.dtype) or values.dtype == object:
+            return values
+        return self._cached(("text", field.name), lambda: values.astype("string"))
+
+    def lower(self, field):
+        return self._cached(("lower", field.name), lambda: self.text(field).str.lower())
+
+    def timestamps(self, field):
+        # Epoch seconds (NaN where missing or unparseable)
+        if field.engagement is not None:
+            return self.column(field)
+        def parse(uniques):
+            parsed = pd.to_datetime(pd.Series(uniques), errors="coerce", utc=True, format="mixed")
+            return ((parsed - _EPOCH) / pd.Timedelta(seconds=1)).to_numpy(dtype="float64", na_value=np.nan)
+        return self._cached(("time", field.name), lambda: self._by_unique(field, parse))
+
+    def _by_unique(self, field, convert):
+        # Parsing is per value, and list columns repeat values a lot: convert each distinct value once
+        codes, uniques = pd.factorize(self.df[field.name])
+        converted = np.append(np.asarray(convert(uniques), dtype="float64"), np.nan) # codes of -1 (missing) -> NaN
+        return pd.Series(converted[codes], index=self.df.index)
+
+    def _engagement_column(self, field):
+        kind = field.engagement[1]
+        if self.engagement is None or field.name not in self.engagement.columns or 'Email' not in self.df.columns:
+            values = np.full(len(self.df), np.nan if kind == "last_at" else 0.0)
+            return pd.Series(values, index=self.df.index)
+        # Row of each recipient in the engagement frame (-1: no events), looked up once for all fields
+        positions = self._cached(("engagement_rows",), lambda: self.engagement.index.get_indexer(self.lower(_Field('Email'))))
+        values = np.append(self.engagement[field.name].to_numpy(dtype="float64"), np.nan)[positions]
+        aligned = pd.Series(values, index=self.df.index)
+        return aligned if kind == "last_at" else aligned.fillna(0.0)
+
+
+def _preprocess(expression):
+    # Durations and `quoted names` aren't Python; swap them for placeholder names before parsing.
+    # originals maps each placeholder back to the text it replaced, for error messages.
+    names, durations, originals = {}, {}, {}
+
+    def replace(match):
+        string, quoted, amount, unit = match.groups()
+        if string is not None:
+            return string
+        if quoted is not None:
+            placeholder = f"__col{len(names)}"
+            names[placeholder] = quoted
+        else:
+            placeholder = f"__dur{len(durations)}"
+            durations[placeholder] = Duration(float(amount) * DURATION_UNITS[unit])
+        originals[placeholder] = match.group(0)
+        return placeholder
+
+    return _TOKEN_RE.sub(replace, expression), names, durations, originals
+
+
+class CompiledSegment:
+    def __init__(self, expression, evaluate, fields, uses_clock):
+        self.expression = expression
+        self._evaluate = evaluate
+        self.fields = fields # Names referenced
+        self.uses_clock = uses_clock # Compares ages, so the result changes with time
+
+    @property
+    def engagement_fields(self):
+        return sorted(name for name in self.fields if name in ENGAGEMENT_FIELDS)
+
+    def mask(self, context):
+        result = self._evaluate(context)
+        if not isinstance(result, pd.Series):
+            return pd.Series(bool(result), index=context.df.index)
+        if not pd.api.types.is_bool_dtype(result.dtype):
+            raise SegmentError("The expression doesn't evaluate to true/false for each recipient")
+        return result.fillna(False).astype(bool)
+
+
+@lru_cache(maxsize=128)
+def compile_segment(expression, columns):
+    """Compiles an expression against a tuple of column names; raises SegmentError."""
+    source, quoted, durations, originals = _preprocess(expression)
+    try:
+        tree = ast.parse(source.strip() or "True", mode="eval")
+    except SyntaxError as e_syntax:
+        raise SegmentError(f"Invalid segment expression: {e_syntax.msg}") from None
+    by_lower = {str(column).lower(): column for column in columns}
+    fields = set()
+    clock = []
+
+    def shown(node):
+        # The node as the user wrote it, not with placeholders
+        return _PLACEHOLDER_RE.sub(lambda match: originals.get(match.group(0), match.group(0)), ast.unparse(node))
+
+    def resolve(name):
+        name = quoted.get(name, name)
+        if name in columns:
+            column = name
+        elif name.lower() in by_lower:
+            column = by_lower[name.lower()]
+        elif name.lower() in ENGAGEMENT_FIELDS:
+            fields.add(name.lower())
+            return _Field(name.lower(), ENGAGEMENT_FIELDS[name.lower()])
+        else:
+            raise SegmentError(f"Unknown column '{name}'. Columns: {', '.join(map(str, columns))}; "
+                               f"engagement: {', '.join(ENGAGEMENT_FIELDS)}")
+        fields.add(column)
+        return _Field(column)
+
+    def constant(node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (str, int, float, bool, type(None))):
+            return node.value
+        if isinstance(node, ast.Name) and node.id in durations:
+            return durations[node.id]
+        if isinstance(node, ast.Name) and node.id.lower() in ("true", "false", "none", "null"):
+            return {"true": True, "false": False}.get(node.id.lower())
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            value = constant(node.operand)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return -value
+        if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+            return tuple(constant(element) for element in node.elts)
+        raise _NotConstant
+
+    def operand(node):
+        # A value for a comparison: a constant, a field, or a function result (a Series builder)
+        try:
+            return constant(node)
+        except _NotConstant:
+            pass
+        if isinstance(node, ast.Name):
+            return resolve(node.id)
+        if isinstance(node, ast.Call):
+            return call(node)
+        raise SegmentError(f"Unsupported expression: {shown(node)}")
+
+    def call(node):
+        if not isinstance(node.func, ast.Name) or node.keywords:
+            raise SegmentError(f"Unsupported call: {shown(node)}")
+        name = node.func.id.lower()
+        args = node.args
+        if not args or not isinstance(args[0], ast.Name) or args[0].id in durations:
+            raise SegmentError(f"{name}() takes a column first")
+        field = resolve(args[0].id)
+        if name in ("contains", "startswith", "endswith"):
+            if len(args) != 2 or not isinstance(constant(args[1]), str):
+                raise SegmentError(f"{name}() takes a column and a text, e.g. {name}(Company, 'acme')")
+            needle = constant(args[1]).lower()
+            if name == "contains":
+                return _Series(lambda ctx: ctx.lower(field).str.contains(needle, regex=False))
+            return _Series(lambda ctx: getattr(ctx.lower(field).str, name)(needle))
+        if len(args) != 1:
+            raise SegmentError(f"{name}() takes one column")
+        if name == "domain":
+            return _Series(lambda ctx: ctx._cached(("domain", field.name),
+                                                   lambda: ctx.lower(field).str.extract(r"@([^@]*)$", expand=False)), text=True)
+        if name == "lower":
+            return _Series(lambda ctx: ctx.lower(field), text=True)
+        if name in ("missing", "present"):
+            def blank(ctx):
+                values = ctx.column(field)
+                empty = values.isna()
+                if not pd.api.types.is_numeric_dtype(values.dtype):
+                    empty |= ctx.lower(field).fillna("") == ""
+                return empty if name == "missing" else ~empty
+            return _Series(blank)
+        raise SegmentError(f"Unknown function {name}(); use contains, startswith, endswith, domain, lower, missing or present")
+
+    def compare(left, op, right):
+        if isinstance(op, (ast.In, ast.NotIn)):
+            if not isinstance(right, tuple):
+                raise SegmentError("'in' needs a list, e.g. Region in ('EU', 'UK')")
+            values = right
+            def member(ctx):
+                if all(isinstance(v, str) for v in values):
+                    result = series_text(ctx, left).isin(values)
+                else:
+                    result = series_numeric(ctx, left).isin([v for v in values if isinstance(v, (int, float))])
+                return ~result if isinstance(op, ast.NotIn) else result
+            return member
+        if type(op) not in _COMPARISONS:
+            raise SegmentError(f"Unsupported comparison: {type(op).__name__}")
+        apply = _COMPARISONS[type(op)]
+        if not isinstance(left, (_Field, _Series)) and isinstance(right, (_Field, _Series)):
+            left, right = right, left
+            apply = _COMPARISONS[_FLIPPED.get(type(op), type(op))]
+        if not isinstance(left, (_Field, _Series)):
+            result = apply(left, right)
+            return lambda ctx: result
+        if isinstance(right, (_Field, _Series)):
+            return lambda ctx: apply(series_value(ctx, left), series_value(ctx, right))
+        if isinstance(right, Duration):
+            if not (isinstance(left, _Field) and (left.is_time or left.engagement is None)):
+                raise SegmentError("Durations (like 90d) compare with time fields such as last_open")
+            clock.append(right)
+            # Age in seconds; no such event -> infinitely old (a missing date in a column matches nothing)
+            missing_age = np.inf if left.engagement is not None else np.nan
+            return lambda ctx: apply((ctx.now - ctx.timestamps(left)).fillna(missing_age), float(right))
+        if right is None:
+            if not isinstance(op, (ast.Eq, ast.NotEq)):
+                raise SegmentError("Only == and != compare with none")
+            return lambda ctx: series_value(ctx, left).isna() if isinstance(op, ast.Eq) else series_value(ctx, left).notna()
+        if isinstance(right, str) and isinstance(left, _Field) and left.is_time:
+            try:
+                stamp = pd.Timestamp(right, tz="UTC").timestamp()
+            except ValueError:
+                raise SegmentError(f"'{right}' isn't a date") from None
+            return lambda ctx: apply(ctx.timestamps(left), stamp)
+        if isinstance(right, str):
+            if isinstance(op, (ast.Eq, ast.NotEq)):
+                return lambda ctx: apply(series_text(ctx, left), right)
+            # Ordering against a text: dates if the column holds dates, else text order
+            def ordered(ctx):
+                try:
+                    stamp = pd.Timestamp(right, tz="UTC").timestamp()
+                except ValueError:
+                    return apply(series_text(ctx, left), right)
+                return apply(ctx.timestamps(left), stamp) if isinstance(left, _Field) else apply(series_text(ctx, left), right)
+            return ordered
+        if isinstance(right, bool):
+            return lambda ctx: apply(series_value(ctx, left).astype("boolean"), right)
+        if isinstance(right, (int, float)):
+            return lambda ctx: apply(series_numeric(ctx, left), right)
+        raise SegmentError(f"Can't compare with {right!r}")
+
+    def build(node):
+        if isinstance(node, ast.BoolOp):
+            parts = [build(value) for value in node.values]
+            combine = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            def boolean(ctx):
+                result = _as_mask(ctx, parts[0](ctx))
+                for part in parts[1:]:
+                    result = combine(result, _as_mask(ctx, part(ctx)))
+                return result
+            return boolean
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            inner = build(node.operand)
+            return lambda ctx: ~_as_mask(ctx, inner(ctx))
+        if isinstance(node, ast.Compare):
+            operands = [operand(node.left)] + [operand(comparator) for comparator in node.comparators]
+            # a < b < c is a < b and b < c
+            steps = [compare(operands[i], op, operands[i + 1]) for i, op in enumerate(node.ops)]
+            if len(steps) == 1:
+                return steps[0]
+            def chained(ctx):
+                result = _as_mask(ctx, steps[0](ctx))
+                for step in steps[1:]:
+                    result = result & _as_mask(ctx, step(ctx))
+                return result
+            return chained
+        if isinstance(node, ast.Call):
+            value = call(node)
+            if value.text:
+                raise SegmentError(f"{shown(node)} is not a condition; compare it, e.g. == 'x'")
+            return value.build
+        try:
+            value = constant(node)
+        except _NotConstant:
+            raise SegmentError(f"Unsupported expression: {shown(node)}") from None
+        if not isinstance(value, bool):
+            raise SegmentError(f"{shown(node)} is not a condition")
+        return lambda ctx: value
+
+    evaluate = build(tree.body)
+    return CompiledSegment(expression, evaluate, frozenset(fields), bool(clock))
+
+
+_FLIPPED = {ast.Lt: ast.Gt, ast.Gt: ast.Lt, ast.LtE: ast.GtE, ast.GtE: ast.LtE}
+
+
+class _NotConstant(Exception):
+    pass
+
+
+class _Series:
+    # A function call evaluated over whole columns
+    def __init__(self, build, text=False):
+        self.build = build
+        self.text = text
+
+
+def series_value(ctx, value):
+    return value.build(ctx) if isinstance(value, _Series) else ctx.column(value)
+
+
+def series_text(ctx, value):
+    if isinstance(value, _Series):
+        return value.build(ctx)
+    return ctx.text(value)
+
+
+def series_numeric(ctx, value):
+    if isinstance(value, _Series):
+        return pd.to_numeric(value.build(ctx), errors="coerce")
+    return ctx.numeric(value)
+
+
+def _as_mask(ctx, value):
+    if isinstance(value, pd.Series):
+        return value.fillna(False).astype(bool)
+    return pd.Series(bool(value), index=ctx.df.index)
+
+
+def engagement_frame(rows):
+    """Engagement rows from EventStore.engagement() -> DataFrame indexed by email, one column per field."""
+    frame = pd.DataFrame(rows, columns=["email", "event", "count", "last_at"])
+    columns = {}
+    for field, (event, kind) in ENGAGEMENT_FIELDS.items():
+        selected = frame[frame["event"] == event]
+        columns[field] = pd.Series(selected[kind].to_numpy(dtype="float64"), index=selected["email"].to_numpy())
+    return pd.DataFrame(columns)
+
+
+def load_engagement(events_db):
+    """Engagement from a SendGrid event store, or None if there isn't one yet."""
+    if not events_db or not os.path.exists(events_db):
+        return None
+    from sendgrid_events import EventStore
+
+    store = EventStore(events_db)
+    try:
+        rows = store.engagement({event for event, _ in ENGAGEMENT_FIELDS.values()})
+    finally:
+        store.close()
+    return engagement_frame(rows)
+
+
+class SegmentLibrary:
+    """Saved segments (name -> expression) in a JSON file next to the saved contact lists."""
+
+    def __init__(self, path=DEFAULT_SEGMENTS_FILE):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def names(self):
+        return sorted(self.load())
+
+    def get(self, name):
+        return self.load()[name]["expression"]
+
+    def _write(self, segments):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(segments, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def save(self, name, expression):
+        _preprocess_check(expression)
+        segments = self.load()
+        segments[name] = {"expression": expression, "saved": time.time()}
+        self._write(segments)
+
+    def delete(self, name):
+        segments = self.load()
+        if segments.pop(name, None) is not None:
+            self._write(segments)
+
+
+def _preprocess_check(expression):
+    # Syntax only: a saved segment may be used with lists that have other columns
+    try:
+        ast.parse(_preprocess(expression)[0].strip() or "True", mode="eval")
+    except SyntaxError as e_syntax:
+        raise SegmentError(f"Invalid segment expression: {e_syntax.msg}") from None
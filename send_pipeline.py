@@ -0,0 +1,421 @@
+"""Pipelined campaign sending.
+
+    rows --> render process pool --> bounded payload queue --> delivery threads --> results
+
+Rendering and MIME serialization are CPU-bound, so they run in a process pool
+in chunks. Delivery is network-bound, so a few threads (one connection each)
+drain the payload queue. The queue is bounded and the feeder only keeps a
+fixed number of chunks in flight, so memory stays flat however large the
+campaign is.
+
+Delivery connections are opened before rendering starts (warm_up): the first
+one alone, so the others can resume its TLS session in parallel.
+
+With message_timeout or hedge_after set, a watchdog thread breaks off sends
+that overrun them (transport.abort()). A message whose data hadn't been
+committed to the relay yet goes back on the queue for the next free
+connection (at most MAX_REQUEUES times); one that may already have been
+delivered is reported failed rather than risk sending it twice.
+"""
+import math
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from dkim_signing import DEFAULT_SIGNED_HEADERS, dkim_settings
+from encoding_policy import plan_campaign_encoding
+from html_build import build_body
+from inline_images import prepare_inline_images
+from metrics import (
+    BODY_BASELINE_BYTES, BODY_BYTES, DELIVERY_SECONDS, DELIVERY_TIMEOUTS, MESSAGES, QUEUE_DEPTH, REGISTRY, WORKERS_BUSY,
+    WORKERS_TOTAL
+)
+from profiling import RunProfiler
+from rendering import init_render_worker, precompile_templates, render_chunk
+from templating import DEFAULT_BYTECODE_CACHE_DIR, PLACEHOLDERS
+from transports import DeliveryTimeout
+from work_queue import new_campaign_id
+
+DeliveryResult = namedtuple("DeliveryResult", "row_key row_number recipient status detail")
+
+DEFAULT_CHUNK_SIZE = 100
+DEFAULT_DELIVERY_WORKERS = 4
+MAX_REQUEUES = 2 # Per message, after the watchdog broke off its send
+
+_DONE = object() # Queue sentinel
+
+
+def _committed(transport):
+    committed = getattr(transport, "committed", None)
+    return True if committed is None else committed() # Unknown: it may have been delivered
+
+
+def _open_transport(transport):
+    try:
+        transport.open()
+    except Exception as e_open:
+        return e_open
+    return None
+
+
+def build_campaign(config, transport_name, subject_template, body_template, columns, attachments,
+                   template_syntax=PLACEHOLDERS, inline_images=None, suppressed=None):
+    # Everything the render processes need; pickled once per process, not per chunk
+    campaign = {
+        # Ties ledger rows, queue shards and SendGrid webhook events (custom arg) to this send
+        "campaign_id": new_campaign_id(),
+        "transport": "sendgrid" if transport_name == "SendGrid" else "smtp",
+        "sender": config.get('sender_email'),
+        "subject_template": subject_template,
+        "body_template": body_template,
+        "text_template": None,
+        "template_syntax": template_syntax,
+        "template_cache_dir": DEFAULT_BYTECODE_CACHE_DIR,
+        "columns": list(columns),
+        "attachments": list(attachments or []),
+        "inline_images": prepare_inline_images(inline_images), # base64 once here, not in every render process
+        "tracking": True,
+        "suppressed": dict(suppressed or {}), # Normalized address -> reason; only this campaign's recipients
+        # One boundary for the whole campaign, so bodies that don't vary per recipient are byte-identical
+        "mime_boundary": "===============" + uuid.uuid4().hex + "==",
+    }
+    # Template build step (CSS inlining, minification, plain-text version): once here, not per message
+    built = build_body(body_template, template_syntax, columns, inline=config.get('html_inline_css', True),
+                       minify=config.get('html_minify', True), text=config.get('html_text_alternative', True))
+    campaign.update(body_template=built.html, text_template=built.text, css_inliner=built.inliner)
+    if config.get('dkim_enabled') and campaign["transport"] == "smtp": # SendGrid signs with its own domain setup
+        headers = [name.strip() for name in (config.get('dkim_headers') or "").split(",") if name.strip()]
+        campaign["dkim"] = dkim_settings(config['dkim_domain'], config['dkim_selector'], config['dkim_key_path'],
+                                         headers or DEFAULT_SIGNED_HEADERS)
+    return campaign
+
+
+def iter_row_chunks(df, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields lists of (row_key, row_number, values) without materialising the whole frame."""
+    chunk = []
+    for position, row in enumerate(df.itertuples(index=True, name=None)):
+        chunk.append((row[0], position + 1, row[1:]))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class RateLimiter:
+    """Token bucket shared by all delivery workers. rate is messages per second (None = unlimited).
+
+    acquire(amount) takes several tokens at once (e.g. an AI request's estimated LLM tokens).
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate or 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        if not self.rate:
+            return
+        amount = min(amount, self.capacity) # More than a full bucket would never be granted
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class SendPipeline:
+    def __init__(self, campaign, transport_factory, delivery_workers=DEFAULT_DELIVERY_WORKERS,
+                 render_processes=None, rate_limit=None, queue_size=None, rate_limiter=None, profile=None,
+                 message_timeout=None, hedge_after=None):
+        self.campaign = campaign
+        self.transport_factory = transport_factory
+        self.delivery_workers = max(1, delivery_workers)
+        self.render_processes = render_processes or os.cpu_count() or 1
+        # Distributed workers pass a limiter shared through the work queue instead
+        self.rate_limiter = rate_limiter or RateLimiter(rate_limit)
+        # Backpressure: at most this many rendered payloads wait for a delivery worker
+        self.payload_queue = queue.Queue(maxsize=queue_size or self.delivery_workers * DEFAULT_CHUNK_SIZE)
+        self.results = queue.Queue()
+        self.stop_event = threading.Event()
+        self.fatal_error = None
+        # Watchdog: seconds a send may take in all, and after which an uncommitted one is retried elsewhere
+        self.message_timeout = message_timeout
+        self.hedge_after = hedge_after
+        self.in_flight = {} # Delivery thread id -> [started, transport, reason it was broken off or None]
+        self.in_flight_lock = threading.Lock()
+        self.requeued = deque() # Messages to send again; taken before the payload queue
+        self.requeue_counts = {}
+        self.profiler = None
+        if profile:
+            # Render processes split the message budget between them
+            render_settings = dict(profile, max_messages=math.ceil(profile["max_messages"] / self.render_processes))
+            self.campaign = dict(campaign, profile=render_settings)
+            self.profiler = RunProfiler(profile)
+        self.profile_dir = None
+        self.warm_transports = []
+        self.body_bytes = {BODY_BYTES.name: 0, BODY_BASELINE_BYTES.name: 0} # This run's share of the histograms
+
+    def warm_up(self):
+        """Opens every delivery connection up front; raises the first connect/login error."""
+        if self.warm_transports:
+            return
+        first = self.transport_factory()
+        first.open() # Full handshake once; its TLS session is what the others resume
+        transports = [first]
+        rest = [self.transport_factory() for _ in range(self.delivery_workers - 1)]
+        errors = []
+        if rest:
+            with ThreadPoolExecutor(max_workers=len(rest)) as pool:
+                for transport, error in zip(rest, pool.map(_open_transport, rest)):
+                    if error is None:
+                        transports.append(transport)
+                    else:
+                        errors.append(error)
+        if errors:
+            for transport in transports:
+                transport.close()
+            raise errors[0]
+        self.warm_transports = transports
+
+    def _plan_encoding(self):
+        # SMTP only; the SendGrid API does its own MIME encoding
+        capabilities = getattr(self.warm_transports[0], "capabilities", None)
+        if self.campaign["transport"] == "smtp" and capabilities is not None:
+            self.campaign = plan_campaign_encoding(self.campaign, capabilities())
+
+    # --- Render stage ---
+
+    def _feed(self, chunks):
+        try:
+            with ProcessPoolExecutor(max_workers=self.render_processes,
+                                     initializer=init_render_worker, initargs=(self.campaign,)) as pool:
+                pending = deque()
+                max_in_flight = self.render_processes * 2
+                for chunk in chunks:
+                    if self.stop_event.is_set():
+                        break
+                    pending.append(pool.submit(render_chunk, chunk))
+                    if len(pending) >= max_in_flight:
+                        self._enqueue(pending.popleft().result())
+                while pending and not self.stop_event.is_set():
+                    self._enqueue(pending.popleft().result())
+                for future in pending:
+                    future.cancel()
+        except Exception as e_render:
+            self._fail(e_render)
+        finally:
+            for _ in range(self.delivery_workers):
+                self._put(self.payload_queue, _DONE, force=True)
+
+    def _feed_rendered(self, messages):
+        # deliver(): messages rendered earlier (e.g. a spool), so there's no render stage
+        try:
+            for message in messages:
+                if self.stop_event.is_set() or not self._put(self.payload_queue, message):
+                    break
+                QUEUE_DEPTH.set(self.payload_queue.qsize())
+        except Exception as e_read:
+            self._fail(e_read)
+        finally:
+            for _ in range(self.delivery_workers):
+                self._put(self.payload_queue, _DONE, force=True)
+
+    def _enqueue(self, chunk_result):
+        rendered, metric_deltas = chunk_result
+        REGISTRY.merge_deltas(metric_deltas)
+        for name, _, delta in metric_deltas:
+            if name in self.body_bytes:
+                self.body_bytes[name] += delta[1] # Histogram sum
+        for message in rendered:
+            if message.error:
+                self.results.put(DeliveryResult(message.row_key, message.row_number, message.recipient, "skipped", message.error))
+            elif not self._put(self.payload_queue, message):
+                return
+            QUEUE_DEPTH.set(self.payload_queue.qsize())
+
+    def _put(self, q, item, force=False):
+        # Blocking put that gives up when the pipeline is stopped (unless forced)
+        while True:
+            try:
+                q.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                if self.stop_event.is_set() and not force:
+                    return False
+                if force and self.stop_event.is_set():
+                    # Make room for the sentinel, the run is over anyway; on a normal finish the workers free a slot
+                    try: q.get_nowait()
+                    except queue.Empty: pass
+
+    # --- Delivery stage ---
+
+    def _deliver(self):
+        try:
+            transport = self.warm_transports.pop()
+        except IndexError:
+            transport = self.transport_factory()
+            try:
+                transport.open()
+            except Exception as e_open:
+                self._fail(e_open)
+                self.results.put(_DONE)
+                return
+        latency = DELIVERY_SECONDS.labels(transport.name)
+        busy = WORKERS_BUSY.labels()
+        WORKERS_TOTAL.inc()
+        profile = self.profiler.profile_thread() if self.profiler else None
+        thread_id = threading.get_ident()
+        finished = False
+        try:
+            while True:
+                try:
+                    message = self.requeued.popleft()
+                except IndexError:
+                    if finished:
+                        break
+                    message = self.payload_queue.get()
+                    if message is _DONE:
+                        finished = True # Still send what other workers requeued
+                        continue
+                    QUEUE_DEPTH.set(self.payload_queue.qsize())
+                if self.stop_event.is_set():
+                    continue # Drain without sending
+                self.rate_limiter.acquire()
+                busy.inc()
+                started = time.perf_counter()
+                with self.in_flight_lock:
+                    self.in_flight[thread_id] = [time.monotonic(), transport, None]
+                error = None
+                try:
+                    accepted, detail = transport.send(message)
+                    status = "sent" if accepted else "failed"
+                except Exception as e_send:
+                    status, detail, error = "failed", str(e_send), e_send
+                with self.in_flight_lock:
+                    reason = self.in_flight.pop(thread_id)[2]
+                latency.observe(time.perf_counter() - started)
+                busy.dec()
+                if reason is not None and isinstance(error, DeliveryTimeout): # Otherwise it failed on its own; keep its detail
+                    if self._requeue(message, error, transport.name, reason):
+                        continue
+                    detail = (f"Broken off by the delivery watchdog ({reason}) after {time.perf_counter() - started:.0f}s"
+                              + ("; the relay may have it already, so it wasn't sent again" if error.committed else ""))
+                if profile is not None and not self.profiler.tick(profile):
+                    profile = None # Window closed; tick() disabled it
+                self.results.put(DeliveryResult(message.row_key, message.row_number, message.recipient, status, detail))
+        except Exception as e_worker:
+            self._fail(e_worker) # Unblocks the feeder, which would otherwise wait on a full queue
+        finally:
+            if profile is not None:
+                profile.disable()
+            WORKERS_TOTAL.dec()
+            transport.close()
+            self.results.put(_DONE)
+
+    def _requeue(self, message, error, transport_name, reason):
+        # Only if the relay can't have the message yet; otherwise a second send could deliver it twice
+        key = (message.row_key, message.row_number)
+        attempts = self.requeue_counts.get(key, 0)
+        if error.committed or attempts >= MAX_REQUEUES:
+            DELIVERY_TIMEOUTS.labels(transport_name, reason, "failed").inc()
+            return False
+        self.requeue_counts[key] = attempts + 1
+        self.requeued.append(message)
+        DELIVERY_TIMEOUTS.labels(transport_name, reason, "requeued").inc()
+        return True
+
+    def _watchdog(self):
+        interval = min(1.0, min(limit for limit in (self.message_timeout, self.hedge_after) if limit) / 4)
+        while not self.stop_event.wait(interval):
+            now = time.monotonic()
+            with self.in_flight_lock:
+                for entry in self.in_flight.values():
+                    started, transport, reason = entry
+                    if reason is not None or getattr(transport, "abort", None) is None:
+                        continue
+                    # Pooled transports report when they got a connection: queuing for one isn't the relay's fault
+                    started = getattr(transport, "send_started", started)
+                    if started is None:
+                        continue
+                    elapsed = now - started
+                    if self.message_timeout and elapsed > self.message_timeout:
+                        entry[2] = "timeout"
+                    elif self.hedge_after and elapsed > self.hedge_after and not _committed(transport):
+                        entry[2] = "hedge" # A slow tail that the relay hasn't got yet: retry it on another connection
+                    else:
+                        continue
+                    transport.abort()
+
+    def encoding_report(self):
+        """Body transfer encoding used and the bytes it saved against MIMEText's default."""
+        sent = int(self.body_bytes[BODY_BYTES.name])
+        baseline = int(self.body_bytes[BODY_BASELINE_BYTES.name])
+        return {"encoding": self.campaign.get("body_encoding", "default"), "body_bytes": sent,
+                "baseline_bytes": baseline, "saved_bytes": baseline - sent}
+
+    def _fail(self, error):
+        if self.fatal_error is None:
+            self.fatal_error = error
+        self.stop_event.set()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self, chunks):
+        """Runs the campaign and yields DeliveryResults as they complete.
+
+        Re-raises the first fatal error (e.g. SMTP authentication failure) once all
+        stages have shut down.
+        """
+        return self._run(self._feed, chunks, render=True)
+
+    def deliver(self, messages):
+        """Delivers already-rendered RenderedMessages; yields DeliveryResults like run()."""
+        return self._run(self._feed_rendered, messages, render=False)
+
+    def _run(self, feed, source, render):
+        feeder = threading.Thread(target=feed, args=(source,), daemon=True)
+        workers = [threading.Thread(target=self._deliver, daemon=True) for _ in range(self.delivery_workers)]
+        running = len(workers)
+        try:
+            self.warm_up()
+            if render:
+                self._plan_encoding() # Needs the relay's EHLO, so only once a connection is open
+                precompile_templates(self.campaign)
+            feeder.start()
+            for worker in workers:
+                worker.start()
+            if self.message_timeout or self.hedge_after:
+                threading.Thread(target=self._watchdog, name="delivery-watchdog", daemon=True).start()
+            while running:
+                result = self.results.get()
+                if result is _DONE:
+                    running -= 1
+                    continue
+                MESSAGES.labels(result.status).inc()
+                yield result
+            feeder.join()
+            while not self.results.empty(): # Skips reported after the last worker exited
+                result = self.results.get_nowait()
+                if result is not _DONE:
+                    MESSAGES.labels(result.status).inc()
+                    yield result
+        finally:
+            self.stop_event.set()
+            if self.profiler is not None:
+                self.profile_dir = self.profiler.finish()
+
+        if self.fatal_error is not None:
+            raise self.fatal_error
@@ -0,0 +1,440 @@
+"""SendGrid Event Webhook receiver: tracking events -> indexed store + rollups.
+
+    python sendgrid_events.py serve --port 8787 --public-key <key from SendGrid's Mail Settings>
+    python sendgrid_events.py post recorded_batch.json --url http://127.0.0.1:8787/events
+
+SendGrid POSTs JSON arrays of events (delivered, open, click, bounce,
+unsubscribe...). The handler verifies the batch's signature (ECDSA P-256 over
+timestamp + body, needs the `cryptography` package), puts the events on a
+bounded in-memory queue and answers right away; a single writer thread
+drains the queue and writes the events in bulk. A full queue answers 503, so
+SendGrid retries the batch later.
+
+Events are de-duplicated by sg_event_id (SendGrid delivers at least once).
+Each write transaction also updates per-campaign rollups - total events and
+distinct recipients per event type - so the dashboard reads a handful of
+rows instead of scanning raw events, and per-recipient engagement (count and
+latest time per event type) for segments.py. Messages are tied to a campaign by the
+campaign_id custom arg the SendGrid transport adds to every message.
+
+Bounces and drops also go to the suppression store when one is given, so
+they are skipped like the bounces bounces.py reads from DSNs.
+
+`post` replays a recorded payload against a running receiver, signed with
+--private-key if the receiver checks signatures.
+"""
+import argparse
+import base64
+import json
+import logging
+import math
+import queue
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from metrics import TRACKING_EVENTS
+
+DEFAULT_EVENTS_DB = "tracking_events.db"
+DEFAULT_WEBHOOK_PORT = 8787
+SIGNATURE_HEADER = "X-Twilio-Email-Event-Webhook-Signature"
+TIMESTAMP_HEADER = "X-Twilio-Email-Event-Webhook-Timestamp"
+MAX_SIGNATURE_AGE = 600 # Seconds; older signed batches are rejected as replays
+
+log = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 100000 # Events
+DEFAULT_BATCH_SIZE = 2000
+DEFAULT_FLUSH_INTERVAL = 1.0 # Seconds
+MAX_BODY_BYTES = 16 * 1024 * 1024
+
+# SendGrid's event types; anything else is labelled "other" in metrics, so a request body can't mint label values
+EVENT_TYPES = frozenset(("processed", "dropped", "delivered", "deferred", "bounce", "open", "click", "spamreport",
+                         "unsubscribe", "group_unsubscribe", "group_resubscribe"))
+
+
+def load_public_key(key):
+    """SendGrid shows the verification key as base64 DER; PEM works too."""
+    from cryptography.hazmat.primitives.serialization import load_der_public_key, load_pem_public_key
+
+    key = key.strip()
+    if key.startswith("-----BEGIN"):
+        return load_pem_public_key(key.encode())
+    return load_der_public_key(base64.b64decode(key))
+
+
+def verify_signature(public_key, payload, signature, timestamp, max_age=MAX_SIGNATURE_AGE):
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    if not signature or not timestamp:
+        return False
+    try:
+        if max_age and abs(time.time() - int(timestamp)) > max_age:
+            return False
+        public_key.verify(base64.b64decode(signature), timestamp.encode() + payload, ec.ECDSA(hashes.SHA256()))
+    except (InvalidSignature, ValueError):
+        return False
+    return True
+
+
+def sign_payload(private_key, payload, timestamp=None):
+    """(signature, timestamp) headers for a payload, as SendGrid would send them; for replaying recordings."""
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    timestamp = str(int(timestamp or time.time()))
+    signature = private_key.sign(timestamp.encode() + payload, ec.ECDSA(hashes.SHA256()))
+    return base64.b64encode(signature).decode(), timestamp
+
+
+_TEXT_FIELDS = ("campaign_id", "email", "event", "sg_event_id", "sg_message_id", "url")
+
+
+def _timestamp(value):
+    """Event time as float seconds; None if missing, ValueError if it isn't a number."""
+    if value is None:
+        return None
+    timestamp = float(value) # SendGrid sends ints; replayed or hand-made payloads may send strings
+    if not math.isfinite(timestamp):
+        raise ValueError(f"timestamp {value!r} is not finite")
+    return timestamp
+
+
+class EventStore:
+    def __init__(self, path=DEFAULT_EVENTS_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL") # WAL keeps it consistent; a crash loses at most the last batch
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS events (
+                sg_event_id TEXT PRIMARY KEY,
+                campaign_id TEXT,
+                email       TEXT,
+                event       TEXT NOT NULL,
+                timestamp   REAL,
+                url         TEXT,
+                payload     TEXT
+            );
+            CREATE INDEX IF NOT EXISTS events_campaign ON events (campaign_id, event, timestamp);
+            CREATE INDEX IF NOT EXISTS events_email ON events (email);
+            CREATE TABLE IF NOT EXISTS recipient_events (
+                campaign_id TEXT NOT NULL,
+                event       TEXT NOT NULL,
+                email       TEXT NOT NULL,
+                PRIMARY KEY (campaign_id, event, email)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS recipient_engagement (
+                email       TEXT NOT NULL,
+                event       TEXT NOT NULL,
+                count       INTEGER NOT NULL,
+                last_at     REAL,
+                PRIMARY KEY (email, event)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS rollups (
+                campaign_id TEXT NOT NULL,
+                event       TEXT NOT NULL,
+                total       INTEGER NOT NULL,
+                recipients  INTEGER NOT NULL,
+                first_at    REAL,
+                last_at     REAL,
+                PRIMARY KEY (campaign_id, event)
+            );
+        """)
+        self.conn.commit()
+        if self.conn.execute("SELECT NOT EXISTS (SELECT 1 FROM recipient_engagement) AND EXISTS (SELECT 1 FROM events)").fetchone()[0]:
+            with self.conn: # Store written before the table existed
+                self.conn.execute("INSERT INTO recipient_engagement SELECT email, event, COUNT(*), MAX(timestamp) "
+                                  "FROM events GROUP BY email, event")
+
+    def write_batch(self, events):
+        """Inserts new events and folds them into the rollups, in one transaction; returns the new events.
+
+        Events whose timestamp isn't a number, or whose text fields aren't strings, are dropped.
+        """
+        added = []
+        deltas = {} # (campaign, event) -> [total, recipients, first, last]
+        engagement = {} # (email, event) -> [count, last]
+        with self.lock, self.conn:
+            for event in events:
+                if not all(isinstance(event.get(field), (str, type(None))) for field in _TEXT_FIELDS):
+                    continue # Not something SendGrid sends; don't let it fail the whole batch
+                campaign_id = event.get("campaign_id") or ""
+                email = (event.get("email") or "").lower()
+                event_type = event.get("event") or "unknown"
+                try:
+                    timestamp = _timestamp(event.get("timestamp"))
+                except (TypeError, ValueError):
+                    continue
+                event_id = event.get("sg_event_id") or f"{email}:{event_type}:{event.get('timestamp')}:{event.get('sg_message_id')}"
+                event = dict(event, timestamp=timestamp)
+                if not self.conn.execute("INSERT OR IGNORE INTO events VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                         (event_id, campaign_id, email, event_type, timestamp, event.get("url"),
+                                          json.dumps(event, separators=(",", ":")))).rowcount:
+                    continue # A retried delivery of an event we already have
+                added.append(event)
+                first_for_recipient = self.conn.execute("INSERT OR IGNORE INTO recipient_events VALUES (?, ?, ?)",
+                                                        (campaign_id, event_type, email)).rowcount
+                delta = deltas.setdefault((campaign_id, event_type), [0, 0, timestamp, timestamp])
+                delta[0] += 1
+                delta[1] += first_for_recipient
+                if timestamp is not None:
+                    delta[2] = min(delta[2] or timestamp, timestamp)
+                    delta[3] = max(delta[3] or timestamp, timestamp)
+                seen = engagement.setdefault((email, event_type), [0, timestamp])
+                seen[0] += 1
+                if timestamp is not None:
+                    seen[1] = max(seen[1] or timestamp, timestamp)
+            self.conn.executemany("""
+                INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (campaign_id, event) DO UPDATE SET
+                    total = total + excluded.total,
+                    recipients = recipients + excluded.recipients,
+                    first_at = MIN(COALESCE(first_at, excluded.first_at), COALESCE(excluded.first_at, first_at)),
+                    last_at = MAX(COALESCE(last_at, excluded.last_at), COALESCE(excluded.last_at, last_at))""",
+                [(campaign_id, event_type, *delta) for (campaign_id, event_type), delta in deltas.items()])
+            self.conn.executemany("""
+                INSERT INTO recipient_engagement VALUES (?, ?, ?, ?)
+                ON CONFLICT (email, event) DO UPDATE SET
+                    count = count + excluded.count,
+                    last_at = MAX(COALESCE(last_at, excluded.last_at), COALESCE(excluded.last_at, last_at))""",
+                [(email, event_type, *seen) for (email, event_type), seen in engagement.items()])
+        return added
+
+    def rollup(self, campaign_id):
+        """{event: {"total", "recipients", "first_at", "last_at"}} for one campaign."""
+        with self.lock:
+            rows = self.conn.execute("SELECT event, total, recipients, first_at, last_at FROM rollups WHERE campaign_id = ?",
+                                     (campaign_id,)).fetchall()
+        return {event: {"total": total, "recipients": recipients, "first_at": first_at, "last_at": last_at}
+                for event, total, recipients, first_at, last_at in rows}
+
+    def engagement(self, events=None):
+        """(email, event, count, last_at) rows across all campaigns, optionally only some event types."""
+        with self.lock:
+            if events is None:
+                return self.conn.execute("SELECT email, event, count, last_at FROM recipient_engagement").fetchall()
+            events = list(events)
+            return self.conn.execute(f"SELECT email, event, count, last_at FROM recipient_engagement "
+                                     f"WHERE event IN ({','.join('?' * len(events))})", events).fetchall()
+
+    def campaigns(self, limit=20):
+        """Campaign ids with events, most recent activity first."""
+        with self.lock:
+            return [campaign_id for (campaign_id,) in self.conn.execute(
+                "SELECT campaign_id FROM rollups GROUP BY campaign_id ORDER BY MAX(last_at) DESC LIMIT ?", (limit,))]
+
+    def close(self):
+        self.conn.close()
+
+
+def bounces_from_events(events):
+    """SendGrid bounce/dropped events as bounces.Bounce tuples for the suppression store."""
+    from bounces import Bounce, classify
+
+    found = []
+    for event in events:
+        if event.get("event") not in ("bounce", "dropped"):
+            continue
+        reason = event.get("reason") or ""
+        status = event.get("status") or ""
+        if event.get("event") == "bounce" and event.get("type") != "blocked":
+            kind = classify("failed", status, reason)
+        else:
+            kind = "soft" # Blocks and drops say more about the sender than about the address
+        found.append(Bounce(event.get("sg_event_id") or f"sendgrid:{event.get('sg_message_id')}", event.get("email"),
+                            kind, status, reason[:500], event.get("timestamp")))
+    return found
+
+
+class EventIngestor:
+    """Bounded in-memory queue of events, written to the store in batches by one thread."""
+
+    def __init__(self, store, suppression_store=None, queue_size=DEFAULT_QUEUE_SIZE, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.store = store
+        self.suppression_store = suppression_store
+        self.events = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stop_event = threading.Event()
+        self.submit_lock = threading.Lock() # Handlers run on their own threads
+        self.written = 0
+        self.thread = threading.Thread(target=self._run, name="event-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, events):
+        """Queues a batch; False (nothing queued) if there isn't room for all of it."""
+        # All or nothing, so a retried batch isn't half-duplicated. Only submit() adds to the queue, so
+        # under submit_lock the room seen by the check can only grow until the batch is in.
+        with self.submit_lock:
+            with self.events.mutex:
+                if self.events.maxsize - len(self.events.queue) < len(events):
+                    return False
+            for event in events:
+                try:
+                    self.events.put_nowait(event)
+                except queue.Full:
+                    return False
+        return True
+
+    def _write(self, batch):
+        added = self.store.write_batch(batch)
+        self.written += len(added)
+        for event in added:
+            event_type = event.get("event")
+            TRACKING_EVENTS.labels(event_type if isinstance(event_type, str) and event_type in EVENT_TYPES else "other").inc()
+        if self.suppression_store is not None:
+            bounces = bounces_from_events(added)
+            if bounces:
+                self.suppression_store.record_bounces(bounces)
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while not (self.stop_event.is_set() and self.events.empty()):
+            try:
+                batch.append(self.events.get(timeout=max(0.0, min(0.2, deadline - time.monotonic()))))
+            except queue.Empty:
+                pass
+            if len(batch) >= self.batch_size or (batch and time.monotonic() >= deadline):
+                self._write_logged(batch)
+                batch = []
+            if time.monotonic() >= deadline:
+                deadline = time.monotonic() + self.flush_interval
+        if batch:
+            self._write_logged(batch)
+
+    def _write_logged(self, batch):
+        # The writer is the only consumer: one bad batch must not stop it, or the queue just fills up
+        try:
+            self._write(batch)
+        except Exception:
+            log.exception("Failed to write a batch of %d tracking events", len(batch))
+
+    def close(self):
+        """Stops after writing everything already queued."""
+        self.stop_event.set()
+        self.thread.join()
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        if self.path.split("?")[0] != server.path:
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY_BYTES:
+            self.send_error(413)
+            return
+        payload = self.rfile.read(length)
+        if server.public_key is not None and not verify_signature(
+                server.public_key, payload, self.headers.get(SIGNATURE_HEADER), self.headers.get(TIMESTAMP_HEADER)):
+            self.send_error(403, "Invalid signature")
+            return
+        try:
+            events = json.loads(payload)
+            if not isinstance(events, list):
+                raise ValueError("expected a JSON array of events")
+        except ValueError as e_payload:
+            self.send_error(400, str(e_payload))
+            return
+        if not server.ingestor.submit([event for event in events if isinstance(event, dict)]):
+            self.send_error(503, "Event queue full") # SendGrid retries
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, ingestor, public_key=None, path="/events"):
+        self.ingestor = ingestor
+        self.public_key = public_key
+        self.path = path
+        super().__init__(address, _WebhookHandler)
+
+
+def start_webhook_server(ingestor, port=DEFAULT_WEBHOOK_PORT, host="127.0.0.1", public_key=None, path="/events"):
+    """Serves the webhook from a daemon thread; returns the server (stop it with shutdown())."""
+    server = WebhookServer((host, port), ingestor, public_key, path)
+    threading.Thread(target=server.serve_forever, name="sendgrid-webhook", daemon=True).start()
+    return server
+
+
+def post_payload(url, payload, private_key=None):
+    """Posts a recorded event batch (bytes) to a receiver; returns the HTTP status."""
+    import urllib.error
+    import urllib.request
+
+    headers = {"Content-Type": "application/json"}
+    if private_key is not None:
+        headers[SIGNATURE_HEADER], headers[TIMESTAMP_HEADER] = sign_payload(private_key, payload)
+    request = urllib.request.Request(url, data=payload, headers=headers, method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.status
+    except urllib.error.HTTPError as e_http:
+        return e_http.code
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SendGrid Event Webhook receiver.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="Receive events")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_WEBHOOK_PORT)
+    serve_parser.add_argument("--path", default="/events")
+    serve_parser.add_argument("--db", default=DEFAULT_EVENTS_DB)
+    serve_parser.add_argument("--public-key", help="Verification key from SendGrid (base64 DER or PEM); unsigned if omitted")
+    serve_parser.add_argument("--suppression-db", help="Also record bounces and drops in this suppression store")
+    post_parser = commands.add_parser("post", help="Replay a recorded event batch")
+    post_parser.add_argument("payload", help="JSON file with an array of events")
+    post_parser.add_argument("--url", default=f"http://127.0.0.1:{DEFAULT_WEBHOOK_PORT}/events")
+    post_parser.add_argument("--private-key", help="PEM EC private key to sign the batch with")
+    args = parser.parse_args()
+
+    if args.command == "post":
+        private_key = None
+        if args.private_key:
+            from cryptography.hazmat.primitives.serialization import load_pem_private_key
+            with open(args.private_key, "rb") as f:
+                private_key = load_pem_private_key(f.read(), password=None)
+        with open(args.payload, "rb") as f:
+            print(post_payload(args.url, f.read(), private_key))
+        return
+
+    suppression_store = None
+    if args.suppression_db:
+        from suppression import SuppressionStore
+        suppression_store = SuppressionStore(args.suppression_db)
+    store = EventStore(args.db)
+    ingestor = EventIngestor(store, suppression_store)
+    server = WebhookServer((args.host, args.port), ingestor, load_public_key(args.public_key) if args.public_key else None,
+                           args.path)
+    print(f"Receiving SendGrid events on http://{args.host}:{args.port}{args.path} "
+          f"({'signature checked' if args.public_key else 'UNSIGNED'}) -> {args.db}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        ingestor.close()
+        store.close()
+        if suppression_store is not None:
+            suppression_store.close()
+
+
+if __name__ == "__main__":
+    main()
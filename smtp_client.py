@@ -0,0 +1,376 @@
+"""smtplib clients that cut per-message round trips.
+
+smtplib.SMTP.sendmail() waits for the reply to MAIL FROM, then to every RCPT
+TO, then to DATA, then to the end of data - four or more round trips per
+message. When the relay advertises them in its EHLO response, FastSMTP uses:
+
+* PIPELINING (RFC 2920): MAIL FROM and all RCPT TO commands go out in one
+  write and their replies are read back together.
+* CHUNKING (RFC 3030): the body is sent with BDAT in length-prefixed chunks,
+  so no dot-stuffing and no 354 round trip. With PIPELINING the BDAT chunks
+  are written together with the envelope.
+
+Relays that advertise neither get plain sendmail().
+
+TLS connections share one SSLContext per CA bundle and remember the last TLS
+session per relay, so pooled and reconnecting connections resume it instead
+of paying for a full handshake (certificate chain, key exchange) every time.
+measure_handshakes() reports the difference against a given relay:
+
+    python smtp_client.py --host localhost --port 2525 --security TLS --cafile stub-cert.pem
+
+PipeSMTP speaks the same protocol to a local process over its stdin/stdout
+(`sendmail -bs`), for handing messages to the host's MTA without a network
+hop.
+
+Replies are read under command_timeout, the message data and its final reply
+under data_timeout (socket timeouts; a stall raises SMTPServerDisconnected).
+data_committed tells whether the relay may already have the message: it is
+set when the data is sent (with PIPELINING and CHUNKING that is together with
+the envelope, unless defer_commit holds back the final BDAT LAST for a round
+trip), and until then a failed transaction can safely be sent again. abort() breaks off a transaction
+from another thread.
+"""
+import argparse
+import re
+import select
+import smtplib
+import socket
+import ssl
+import subprocess
+import threading
+import time
+
+from metrics import TLS_HANDSHAKES, TLS_HANDSHAKE_SECONDS
+
+CRLF = b"\r\n"
+DEFAULT_BDAT_CHUNK_SIZE = 1 << 20
+
+_EOL_RE = re.compile(rb"(?:\r\n|\n|\r(?!\n))")
+
+_tls_lock = threading.Lock()
+_tls_contexts = {}  # cafile -> SSLContext
+_tls_sessions = {}  # (id(context), host, port) -> SSLSession
+
+
+def shared_tls_context(cafile=None):
+    """One client SSLContext per CA bundle; sessions can only be resumed through the context that made them."""
+    with _tls_lock:
+        context = _tls_contexts.get(cafile)
+        if context is None:
+            context = ssl.create_default_context(cafile=cafile)
+            _tls_contexts[cafile] = context
+        return context
+
+
+def forget_tls_sessions():
+    with _tls_lock:
+        _tls_sessions.clear()
+
+
+class FastSMTPMixin:
+    bdat_chunk_size = DEFAULT_BDAT_CHUNK_SIZE
+    tls_session_key = None
+    command_timeout = None # Seconds; None keeps the connect timeout
+    data_timeout = None
+    data_committed = False
+    defer_commit = False # Pipelined BDAT: hold back LAST until the envelope and chunks are accepted (one more round trip)
+
+    def _phase_timeout(self, seconds):
+        if seconds and self.sock is not None:
+            self.sock.settimeout(seconds)
+
+    def _commit_data(self):
+        self.data_committed = True
+        self._phase_timeout(self.data_timeout)
+
+    def data(self, msg):
+        # Also reached through sendmail() for relays without PIPELINING/CHUNKING
+        self._commit_data()
+        return super().data(msg)
+
+    def _check_alive(self):
+        # A relay that dropped the idle connection has said so already (421 and/or EOF). Finding out here, before
+        # anything is sent, keeps the resend safe: otherwise it would only show after the data went out
+        sock = self.sock
+        if sock is not None and select.select([sock], [], [], 0)[0]:
+            self.close()
+            raise smtplib.SMTPServerDisconnected("Connection closed by the relay while idle")
+
+    def abort(self):
+        """Breaks off the transaction in progress (called from another thread); the connection is unusable after."""
+        sock = self.sock
+        if sock is not None:
+            try:
+                # socket.socket's shutdown, not SSLSocket's: no TLS close_notify while the owner thread is reading
+                socket.socket.shutdown(sock, socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def connect(self, host="localhost", port=0, source_address=None):
+        self._tls_port = port
+        return super().connect(host, port, source_address)
+
+    def _wrap_tls(self, sock, context):
+        """Handshakes over `sock`, offering the relay's last session for resumption."""
+        key = (id(context), self._host, self._tls_port)
+        with _tls_lock:
+            session = _tls_sessions.get(key)
+        started = time.perf_counter()
+        tls_sock = context.wrap_socket(sock, server_hostname=self._host, session=session)
+        mode = "resumed" if tls_sock.session_reused else "full"
+        TLS_HANDSHAKE_SECONDS.labels(mode).observe(time.perf_counter() - started)
+        TLS_HANDSHAKES.labels(mode).inc()
+        self.tls_session_key = key
+        return tls_sock
+
+    def save_tls_session(self):
+        """Remembers this connection's TLS session for the next connection to the same relay.
+
+        Call it after the first reply over TLS (EHLO/login): TLS 1.3 servers send
+        their session tickets after the handshake.
+        """
+        session = getattr(self.sock, "session", None)
+        if self.tls_session_key is not None and session is not None:
+            with _tls_lock:
+                _tls_sessions[self.tls_session_key] = session
+
+    def starttls(self, keyfile=None, certfile=None, context=None):
+        # smtplib.SMTP.starttls() with session resumption; keyfile/certfile are accepted for signature compatibility
+        self.ehlo_or_helo_if_needed()
+        if not self.has_extn("starttls"):
+            raise smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server.")
+        resp, reply = self.docmd("STARTTLS")
+        if resp != 220:
+            raise smtplib.SMTPResponseException(resp, reply)
+        self.sock = self._wrap_tls(self.sock, context or shared_tls_context())
+        self.file = None
+        # RFC 3207: forget everything learned from the server before TLS
+        self.helo_resp = None
+        self.ehlo_resp = None
+        self.esmtp_features = {}
+        self.does_esmtp = False
+        return resp, reply
+
+    def send_raw_message(self, from_addr, to_addrs, data, mail_options=(), rcpt_options=()):
+        """Sends an already-serialized message; same return value and exceptions as sendmail()."""
+        self.data_committed = False
+        self._phase_timeout(self.command_timeout)
+        self._check_alive()
+        self.ehlo_or_helo_if_needed()
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        if isinstance(data, str):
+            data = data.encode("ascii")
+        mail_options = list(mail_options)
+        # 8bit bodies and UTF-8 addresses have to be declared to relays that accept them
+        if not data.isascii() and self.has_extn("8bitmime"):
+            mail_options.append("BODY=8BITMIME")
+        if not (from_addr.isascii() and all(rcpt.isascii() for rcpt in to_addrs)) and self.has_extn("smtputf8"):
+            mail_options.append("SMTPUTF8")
+            self.command_encoding = "utf-8"
+        pipelining = self.does_esmtp and self.has_extn("pipelining")
+        chunking = self.does_esmtp and self.has_extn("chunking")
+        if not (pipelining or chunking):
+            return self.sendmail(from_addr, to_addrs, data, mail_options, rcpt_options)
+
+        data = _EOL_RE.sub(CRLF, data)
+        if self.has_extn("size"):
+            mail_options.append(f"SIZE={len(data)}")
+
+        envelope = [self._command("MAIL", f"FROM:{smtplib.quoteaddr(from_addr)}", mail_options)]
+        envelope += [self._command("RCPT", f"TO:{smtplib.quoteaddr(rcpt)}", rcpt_options) for rcpt in to_addrs]
+        deferred = pipelining and chunking and self.defer_commit
+        body = self._bdat_chunks(data, last=not deferred) if chunking else []
+
+        if pipelining:
+            # One write for the whole transaction (envelope + BDAT chunks), then collect the replies in order
+            if body and not deferred:
+                # The body goes out with the envelope, and relays may hold back every reply until they've processed
+                # it all: from here on it may be delivered
+                self._commit_data()
+            self.send(b"".join(envelope + body))
+            replies = [self.getreply() for _ in envelope]
+        else:
+            replies = []
+            for command in envelope:
+                self.send(command)
+                replies.append(self.getreply())
+                if len(replies) == 1 and replies[0][0] != 250:
+                    break
+
+        code, resp = replies[0]
+        if code != 250:
+            self._abort_transaction(len(body) if pipelining else 0)
+            if code == 421:
+                self.close()
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+
+        senderrs = {}
+        for rcpt, (code, resp) in zip(to_addrs, replies[1:]):
+            if code not in (250, 251):
+                senderrs[rcpt] = (code, resp)
+            if code == 421:
+                self.close()
+                raise smtplib.SMTPRecipientsRefused(senderrs)
+        if len(senderrs) == len(to_addrs):
+            self._abort_transaction(len(body) if pipelining else 0)
+            raise smtplib.SMTPRecipientsRefused(senderrs)
+
+        if chunking:
+            if not pipelining:
+                self._commit_data()
+                self.send(b"".join(body))
+            code, resp = None, None
+            for _ in body:
+                chunk_code, chunk_resp = self.getreply()
+                if chunk_code != 250 and code is None:
+                    code, resp = chunk_code, chunk_resp
+            if deferred and code is None:
+                # Everything so far accepted; the relay can only deliver the message once it sees LAST
+                self._commit_data()
+                self.send(b"BDAT 0 LAST\r\n")
+                code, resp = self.getreply()
+                if code == 250:
+                    code = None
+            if code is not None:
+                if code == 421:
+                    self.close()
+                else:
+                    self._rset()
+                raise smtplib.SMTPDataError(code, resp)
+        else:
+            code, resp = self.data(data)
+            if code != 250:
+                if code == 421:
+                    self.close()
+                else:
+                    self._rset()
+                raise smtplib.SMTPDataError(code, resp)
+        return senderrs
+
+    def _command(self, verb, argument, options):
+        line = f"{verb} {argument}"
+        if options:
+            line += " " + " ".join(options)
+        return (line + "\r\n").encode(self.command_encoding)
+
+    def _bdat_chunks(self, data, last=True):
+        size = self.bdat_chunk_size
+        chunks = []
+        for start in range(0, len(data), size):
+            piece = data[start:start + size]
+            marker = b" LAST" if last and start + size >= len(data) else b""
+            chunks.append(b"BDAT %d%s\r\n" % (len(piece), marker) + piece)
+        if not chunks and last:
+            chunks.append(b"BDAT 0 LAST\r\n")
+        return chunks
+
+    def _abort_transaction(self, pending_bdat_replies):
+        # Pipelined BDAT chunks still get (error) replies; consume them before RSET
+        for _ in range(pending_bdat_replies):
+            self.getreply()
+        self._rset()
+
+
+class FastSMTP(FastSMTPMixin, smtplib.SMTP):
+    pass
+
+
+class FastSMTP_SSL(FastSMTPMixin, smtplib.SMTP_SSL):
+    def __init__(self, host="", port=0, local_hostname=None, timeout=smtplib.socket._GLOBAL_DEFAULT_TIMEOUT,
+                 source_address=None, context=None):
+        super().__init__(host, port, local_hostname, timeout=timeout, source_address=source_address,
+                         context=context or shared_tls_context())
+
+    def _get_socket(self, host, port, timeout):
+        sock = smtplib.SMTP._get_socket(self, host, port, timeout)
+        return self._wrap_tls(sock, self.context)
+
+
+class PipeSMTP(FastSMTP):
+    """SMTP over the stdin/stdout of a child process, e.g. ["sendmail", "-bs"]. Connect with connect()."""
+
+    def __init__(self, command, local_hostname=None, timeout=smtplib.socket._GLOBAL_DEFAULT_TIMEOUT):
+        self.command = list(command)
+        self.process = None
+        super().__init__(local_hostname=local_hostname, timeout=timeout)
+
+    def _get_socket(self, host, port, timeout):
+        # A socketpair end as the child's stdin and stdout, so smtplib's socket I/O works unchanged
+        parent, child = socket.socketpair()
+        try:
+            self.process = subprocess.Popen(self.command, stdin=child, stdout=child)
+        except Exception:
+            parent.close()
+            raise
+        finally:
+            child.close()
+        if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            parent.settimeout(timeout)
+        return parent
+
+    def close(self):
+        super().close()
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+
+
+def open_tls_connection(host, port, security, context, timeout=30):
+    """Connects and completes TLS + EHLO; returns the client (caller quits it)."""
+    if security == "SSL":
+        server = FastSMTP_SSL(host, port, timeout=timeout, context=context)
+    else:
+        server = FastSMTP(host, port, timeout=timeout)
+        server.starttls(context=context)
+    server.ehlo()
+    server.save_tls_session()
+    return server
+
+
+def measure_handshakes(host, port, security="TLS", cafile=None, rounds=5):
+    """Times connect + TLS + EHLO, first without and then with session resumption.
+
+    Returns {"full": [seconds...], "resumed": [seconds...], "resumed_ok": n}.
+    """
+    results = {"full": [], "resumed": [], "resumed_ok": 0}
+    # A private context, so the warm sessions of the running app are left alone
+    context = ssl.create_default_context(cafile=cafile)
+    for phase in ("full", "resumed"):
+        for _ in range(rounds):
+            if phase == "full":
+                with _tls_lock:
+                    _tls_sessions.pop((id(context), host, port), None)
+            started = time.perf_counter()
+            server = open_tls_connection(host, port, security, context)
+            results[phase].append(time.perf_counter() - started)
+            if phase == "resumed" and server.sock.session_reused:
+                results["resumed_ok"] += 1
+            server.quit()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure TLS handshake cost with and without session resumption.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=587)
+    parser.add_argument("--security", choices=("TLS", "SSL"), default="TLS")
+    parser.add_argument("--cafile", help="CA bundle to trust (e.g. the stub's self-signed certificate)")
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+
+    results = measure_handshakes(args.host, args.port, args.security, args.cafile, args.rounds)
+    for phase in ("full", "resumed"):
+        times = sorted(results[phase])
+        print(f"{phase:8s} median {times[len(times) // 2] * 1000:7.2f} ms  "
+              f"min {times[0] * 1000:7.2f} ms  max {times[-1] * 1000:7.2f} ms")
+    print(f"sessions resumed: {results['resumed_ok']}/{args.rounds}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""Local SMTP stub for checking the delivery layer without a real relay.
+
+It accepts every message and logs each command with the time since the
+previous one, so you can see how many network round trips a transaction
+costs. --latency simulates a distant relay: replies to everything read in one
+recv() are held back by that long, so a pipelined batch pays the delay once
+and a lock-step client pays it per command.
+
+    python smtp_stub.py --port 2525 --latency 0.04 --extensions PIPELINING CHUNKING 8BITMIME
+
+Point the app at localhost:2525 with security "None" (any login is accepted).
+
+--tls adds STARTTLS with a throwaway self-signed certificate for localhost
+(--implicit-tls wraps the whole connection instead, for security "SSL"). Trust
+the printed certificate file on the client side, e.g.
+
+    python smtp_stub.py --port 2525 --latency 0.02 --tls
+    python smtp_client.py --port 2525 --security TLS --cafile <printed cert path>
+"""
+import argparse
+import os
+import socketserver
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+
+DEFAULT_EXTENSIONS = ("PIPELINING", "CHUNKING", "8BITMIME", "SMTPUTF8", "SIZE 52428800", "AUTH PLAIN LOGIN")
+
+
+def make_self_signed_cert(directory=None, hostname="localhost"):
+    """Writes a self-signed certificate and key with the openssl CLI; returns (cert path, key path)."""
+    directory = directory or tempfile.mkdtemp(prefix="smtp-stub-")
+    cert_path = os.path.join(directory, "stub-cert.pem")
+    key_path = os.path.join(directory, "stub-key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "2",
+                    "-subj", f"/CN={hostname}", "-addext", f"subjectAltName=DNS:{hostname},IP:127.0.0.1",
+                    "-keyout", key_path, "-out", cert_path],
+                   check=True, capture_output=True)
+    return cert_path, key_path
+
+
+def server_tls_context(cert_path, key_path):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_path, key_path)
+    return context
+
+
+class StubState:
+    def __init__(self, extensions=DEFAULT_EXTENSIONS, latency=0.0, verbose=False, tls_context=None, implicit_tls=False):
+        self.extensions = list(extensions)
+        self.latency = latency
+        self.verbose = verbose
+        self.tls_context = tls_context
+        self.implicit_tls = implicit_tls
+        self.tls_handshakes = {"full": 0, "resumed": 0}
+        self.lock = threading.Lock()
+        self.log = []       # (timestamp, session id, command)
+        self.messages = []  # (mail from, [rcpts], data bytes)
+
+    def record(self, session_id, command):
+        now = time.monotonic()
+        with self.lock:
+            previous = next((t for t, sid, _ in reversed(self.log) if sid == session_id), now)
+            self.log.append((now, session_id, command))
+        if self.verbose:
+            print(f"[{session_id}] +{(now - previous) * 1000:7.1f} ms  {command}")
+
+
+class StubHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.state = self.server.state
+        self.session_id = f"{self.client_address[1]}"
+        self.buffer = b""
+        self.replies = []
+        self.tls_active = False
+        self.reset()
+        if self.state.implicit_tls:
+            self.start_tls()
+
+    def start_tls(self):
+        self.request = self.state.tls_context.wrap_socket(self.request, server_side=True)
+        self.buffer = b""
+        self.tls_active = True
+        with self.state.lock:
+            self.state.tls_handshakes["resumed" if self.request.session_reused else "full"] += 1
+
+    def reset(self):
+        self.mail_from = None
+        self.rcpts = []
+        self.bdat_data = b""
+
+    def reply(self, line):
+        self.replies.append(line.encode() + b"\r\n")
+
+    def flush(self):
+        if self.replies:
+            if self.state.latency:
+                time.sleep(self.state.latency)
+            self.request.sendall(b"".join(self.replies))
+            self.replies = []
+
+    def read_more(self):
+        # Replies to everything already read are sent before blocking for more input
+        self.flush()
+        data = self.request.recv(65536)
+        if not data:
+            raise ConnectionError("client closed the connection")
+        self.buffer += data
+
+    def read_line(self):
+        while b"\r\n" not in self.buffer:
+            self.read_more()
+        line, self.buffer = self.buffer.split(b"\r\n", 1)
+        return line
+
+    def read_exact(self, size):
+        while len(self.buffer) < size:
+            self.read_more()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def read_dot_data(self):
+        lines = []
+        while True:
+            line = self.read_line()
+            if line == b".":
+                return b"\r\n".join(lines) + b"\r\n"
+            lines.append(line[1:] if line.startswith(b"..") else line)
+
+    def handle(self):
+        self.reply("220 smtp-stub ESMTP ready")
+        try:
+            while True:
+                line = self.read_line()
+                command = line.decode("utf-8", "replace")
+                self.state.record(self.session_id, command if not command.upper().startswith("AUTH") else "AUTH ***")
+                verb = command.split(" ", 1)[0].upper()
+                if not self.dispatch(verb, command):
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            try: self.flush()
+            except OSError: pass
+
+    def dispatch(self, verb, command):
+        if verb == "EHLO":
+            lines = ["smtp-stub"] + self.state.extensions
+            if self.state.tls_context is not None and not self.tls_active:
+                lines.append("STARTTLS")
+            for i, ext in enumerate(lines):
+                self.reply(f"250{'-' if i < len(lines) - 1 else ' '}{ext}")
+        elif verb == "HELO":
+            self.reply("250 smtp-stub")
+        elif verb == "AUTH":
+            parts = command.split()
+            # Challenges still owed: PLAIN needs one unless sent inline, LOGIN needs user and password
+            challenges = (2 if parts[1].upper() == "LOGIN" else 1) - (len(parts) - 2)
+            for _ in range(max(challenges, 0)):
+                self.reply("334 ")
+                self.flush()
+                self.read_line()
+            self.reply("235 Authentication successful")
+        elif verb == "MAIL":
+            self.reset()
+            self.mail_from = command[10:].strip()
+            self.reply("250 OK")
+        elif verb == "RCPT":
+            if self.mail_from is None:
+                self.reply("503 Need MAIL first")
+            else:
+                self.rcpts.append(command[8:].strip())
+                self.reply("250 OK")
+        elif verb == "DATA":
+            if not self.rcpts:
+                self.reply("554 No valid recipients")
+            else:
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                self.flush()
+                self.finish_message(self.read_dot_data())
+        elif verb == "BDAT":
+            parts = command.split()
+            chunk = self.read_exact(int(parts[1]))
+            if not self.rcpts:
+                self.reply("554 No valid recipients")
+            else:
+                self.bdat_data += chunk
+                if len(parts) > 2 and parts[2].upper() == "LAST":
+                    self.finish_message(self.bdat_data)
+                else:
+                    self.reply(f"250 {len(chunk)} octets received")
+        elif verb == "STARTTLS" and self.state.tls_context is not None and not self.tls_active:
+            self.reply("220 Ready to start TLS")
+            self.flush()
+            self.start_tls()
+            self.reset()
+        elif verb == "RSET":
+            self.reset()
+            self.reply("250 OK")
+        elif verb == "NOOP":
+            self.reply("250 OK")
+        elif verb == "QUIT":
+            self.reply("221 Bye")
+            return False
+        else:
+            self.reply("502 Command not implemented")
+        return True
+
+    def finish_message(self, data):
+        with self.state.lock:
+            self.state.messages.append((self.mail_from, list(self.rcpts), data))
+        self.reset()
+        self.reply("250 OK queued")
+
+
+class StubServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, state, handler=StubHandler):
+        self.state = state
+        super().__init__(address, handler)
+
+
+def start_stub(port=0, host="127.0.0.1", **state_kwargs):
+    """Starts a stub in a background thread; returns (server, state). Stop it with server.shutdown()."""
+    state = StubState(**state_kwargs)
+    server = StubServer((host, port), state)
+    threading.Thread(target=server.serve_forever, name="smtp-stub", daemon=True).start()
+    return server, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SMTP stub that logs command timing.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2525)
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated round-trip delay in seconds")
+    parser.add_argument("--extensions", nargs="*", default=list(DEFAULT_EXTENSIONS),
+                        help="EHLO keywords to advertise (pass none to disable all)")
+    parser.add_argument("--tls", action="store_true", help="Offer STARTTLS with a self-signed certificate")
+    parser.add_argument("--implicit-tls", action="store_true", help="Wrap connections in TLS from the start (SMTPS)")
+    parser.add_argument("--cert", help="PEM certificate to use instead of a generated one (needs --key)")
+    parser.add_argument("--key")
+    args = parser.parse_args()
+
+    tls_context = None
+    if args.tls or args.implicit_tls:
+        cert_path, key_path = (args.cert, args.key) if args.cert else make_self_signed_cert()
+        tls_context = server_tls_context(cert_path, key_path)
+        print(f"TLS certificate: {cert_path}")
+    state = StubState(args.extensions, args.latency, verbose=True, tls_context=tls_context, implicit_tls=args.implicit_tls)
+    server = StubServer((args.host, args.port), state)
+    print(f"SMTP stub listening on {args.host}:{args.port} advertising {', '.join(args.extensions) or 'nothing'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""Offline spool: render a campaign to disk now, deliver it later.
+
+Spool mode runs the regular SendPipeline with SpoolTransport in place of the
+relay connection: the render processes build the messages as usual and the
+delivery threads become parallel writers. Formats:
+
+    maildir  tmp/, new/, cur/; each message is written to tmp/ and renamed into new/
+    eml      one .eml file per message, written as .tmp and renamed
+    mbox     a single campaign.mbox (mboxrd quoting), appended under a lock
+
+Every message also gets a line in manifest.jsonl (file, offset and length,
+recipient, row key). The line is appended only once the message is in place,
+so the manifest never points at a partial file.
+
+`drain` streams the manifest through the pipeline's delivery stage, so
+rendering and delivery can run at different times, on different machines:
+
+    python spool.py drain campaign_output/spool-20260101-120000 --config smtp.json
+    python spool.py status campaign_output/spool-20260101-120000
+
+Delivered entries are appended to drained.jsonl and skipped by the next drain,
+so an interrupted drain resumes where it stopped (messages that were in flight
+at the interruption may be sent twice).
+"""
+import argparse
+import itertools
+import json
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+from ledger import row_key_value
+from rendering import RenderedMessage
+from send_pipeline import DEFAULT_DELIVERY_WORKERS, SendPipeline
+
+SPOOL_FORMATS = ("maildir", "eml", "mbox")
+MANIFEST_NAME = "manifest.jsonl"
+DRAINED_NAME = "drained.jsonl"
+INFO_NAME = "spool.json"
+MBOX_NAME = "campaign.mbox"
+
+SpoolEntry = namedtuple("SpoolEntry", "file offset length recipient row_key row_number")
+
+_MBOX_FROM = re.compile(rb"^(>*From )", re.MULTILINE)
+_MBOX_QUOTED_FROM = re.compile(rb"^>(>*From )", re.MULTILINE)
+
+
+class Spool:
+    """A spool directory being written. Thread-safe: one instance is shared by all writer threads."""
+
+    def __init__(self, path, spool_format="maildir", fsync=False):
+        if spool_format not in SPOOL_FORMATS:
+            raise ValueError(f"Unknown spool format '{spool_format}' (expected one of {', '.join(SPOOL_FORMATS)})")
+        self.path = path
+        self.format = spool_format
+        self.fsync = fsync
+        os.makedirs(path, exist_ok=True)
+        if spool_format == "maildir":
+            for sub_dir in ("tmp", "new", "cur"):
+                os.makedirs(os.path.join(path, sub_dir), exist_ok=True)
+        info_path = os.path.join(path, INFO_NAME)
+        if not os.path.exists(info_path):
+            with open(info_path, "w", encoding="utf-8") as f:
+                json.dump({"format": spool_format, "created": time.time()}, f)
+        self.lock = threading.Lock() # Manifest appends (and mbox writes)
+        self.manifest = open(os.path.join(path, MANIFEST_NAME), "a", encoding="utf-8")
+        self.mbox = open(os.path.join(path, MBOX_NAME), "ab") if spool_format == "mbox" else None
+        self.hostname = socket.gethostname().replace("/", "_").replace(":", "_")
+        self.sequence = itertools.count()
+        self.written = 0
+
+    def _write_file(self, tmp_path, final_path, data):
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, final_path) # Readers see the whole message or nothing
+
+    def write(self, message):
+        """Writes one RenderedMessage; returns its SpoolEntry."""
+        data = message.payload
+        if self.format == "mbox":
+            data = _MBOX_FROM.sub(rb">\1", data.replace(b"\r\n", b"\n"))
+            with self.lock:
+                self.mbox.write(f"From MAILER-DAEMON {time.asctime()}\n".encode())
+                offset = self.mbox.tell()
+                self.mbox.write(data + b"\n")
+                self.mbox.flush()
+                if self.fsync:
+                    os.fsync(self.mbox.fileno())
+            file_name, length = MBOX_NAME, len(data)
+        else:
+            sequence = next(self.sequence)
+            if self.format == "maildir":
+                # Maildir's unique name (time, process, counter, host), with an .eml suffix for mail tools
+                base_name = f"{int(time.time())}.P{os.getpid()}Q{sequence}.{self.hostname}.eml"
+                tmp_path = os.path.join(self.path, "tmp", base_name)
+                file_name = f"new/{base_name}"
+            else:
+                file_name = f"row{message.row_number:07d}-{uuid.uuid4().hex[:8]}.eml"
+                tmp_path = os.path.join(self.path, file_name + ".tmp")
+            self._write_file(tmp_path, os.path.join(self.path, file_name), data)
+            offset, length = 0, len(data)
+        entry = SpoolEntry(file_name, offset, length, message.recipient, row_key_value(message.row_key), message.row_number)
+        line = json.dumps(entry._asdict()) + "\n"
+        with self.lock:
+            self.manifest.write(line)
+            self.manifest.flush()
+            self.written += 1
+        return entry
+
+    def close(self):
+        with self.lock:
+            self.manifest.close()
+            if self.mbox is not None:
+                self.mbox.close()
+
+
+class SpoolTransport:
+    """Delivery transport that writes to a Spool instead of a relay."""
+    name = "Spool"
+
+    def __init__(self, spool):
+        self.spool = spool
+
+    def open(self):
+        pass
+
+    def capabilities(self):
+        # The relay that drains the spool is unknown here, so no 8BITMIME: bodies go out as QP/base64
+        return set()
+
+    def send(self, message):
+        entry = self.spool.write(message)
+        return True, f"Spooled to {entry.file}"
+
+    def close(self):
+        pass
+
+
+def read_entries(path):
+    with open(os.path.join(path, MANIFEST_NAME), encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield SpoolEntry(**json.loads(line))
+
+
+def drained_entries(path):
+    """Manifest line numbers already delivered by earlier drains."""
+    drained_path = os.path.join(path, DRAINED_NAME)
+    if not os.path.exists(drained_path):
+        return set()
+    with open(drained_path, encoding="utf-8") as f:
+        return {json.loads(line)["entry"] for line in f if line.strip()}
+
+
+def read_message(path, entry, mbox=None):
+    """The wire bytes of one spooled message (CRLF line endings)."""
+    if mbox is not None:
+        mbox.seek(entry.offset)
+        data = mbox.read(entry.length)
+        return _MBOX_QUOTED_FROM.sub(rb"\1", data).replace(b"\n", b"\r\n")
+    with open(os.path.join(path, entry.file), "rb") as f:
+        return f.read()
+
+
+def drain(path, transport_factory, delivery_workers=DEFAULT_DELIVERY_WORKERS, rate_limit=None, deadlines=None):
+    """Delivers a spool; yields DeliveryResults (with the original row keys) as they complete.
+
+    deadlines: SendPipeline watchdog settings (transports.delivery_deadlines()).
+    """
+    with open(os.path.join(path, INFO_NAME), encoding="utf-8") as f:
+        spool_format = json.load(f)["format"]
+    skip = drained_entries(path)
+    in_flight = {} # Manifest line number -> entry, until its result is back
+
+    def messages(mbox):
+        for number, entry in enumerate(read_entries(path)):
+            if number in skip:
+                continue
+            in_flight[number] = entry
+            # Read lazily: the pipeline's bounded queue keeps only a few messages in memory
+            yield RenderedMessage(number, entry.row_number, entry.recipient, read_message(path, entry, mbox), None)
+
+    pipeline = SendPipeline({"transport": "smtp"}, transport_factory, delivery_workers=delivery_workers,
+                            rate_limit=rate_limit, **(deadlines or {}))
+    mbox = open(os.path.join(path, MBOX_NAME), "rb") if spool_format == "mbox" else None
+    try:
+        with open(os.path.join(path, DRAINED_NAME), "a", encoding="utf-8") as drained_log:
+            for result in pipeline.deliver(messages(mbox)):
+                entry = in_flight.pop(result.row_key)
+                if result.status == "sent":
+                    drained_log.write(json.dumps({"entry": result.row_key, "row_key": entry.row_key,
+                                                  "recipient": entry.recipient, "drained": time.time()}) + "\n")
+                    drained_log.flush()
+                yield result._replace(row_key=entry.row_key)
+    finally:
+        if mbox is not None:
+            mbox.close()
+
+
+def spool_status(path):
+    total = sum(1 for _ in read_entries(path))
+    return {"messages": total, "drained": len(drained_entries(path))}
+
+
+def main():
+    from transports import SmtpTransport, delivery_deadlines
+
+    parser = argparse.ArgumentParser(description="Deliver or inspect a campaign spool.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    drain_parser = commands.add_parser("drain", help="Deliver the spooled messages over SMTP")
+    drain_parser.add_argument("path")
+    drain_parser.add_argument("--config", required=True,
+                              help="JSON file with the SMTP settings (smtp_server, smtp_port, smtp_security, "
+                                   "sender_email, email_password, optionally the smtp_*_timeout, message_deadline "
+                                   "and hedge_after seconds); SMTP_PASSWORD overrides the password")
+    drain_parser.add_argument("--connections", type=int, default=DEFAULT_DELIVERY_WORKERS)
+    drain_parser.add_argument("--rate", type=float, default=0, help="Max emails/second (0 = unlimited)")
+    status_parser = commands.add_parser("status", help="Count spooled and drained messages")
+    status_parser.add_argument("path")
+    args = parser.parse_args()
+
+    if args.command == "status":
+        print(json.dumps(spool_status(args.path)))
+        return
+
+    with open(args.config, encoding="utf-8") as f:
+        config = json.load(f)
+    if os.environ.get("SMTP_PASSWORD"):
+        config["email_password"] = os.environ["SMTP_PASSWORD"]
+    counts = {}
+    try:
+        for result in drain(args.path, lambda: SmtpTransport(config), args.connections, args.rate or None,
+                            delivery_deadlines(config)):
+            counts[result.status] = counts.get(result.status, 0) + 1
+            if result.status != "sent":
+                print(f"{result.status}: {result.recipient} (row {result.row_number}): {result.detail}")
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(counts))
+
+
+if __name__ == "__main__":
+    main()
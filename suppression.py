@@ -0,0 +1,122 @@
+"""Recipient suppression store: addresses campaigns should no longer send to.
+
+Fed by the bounce processor (bounces.py). A hard bounce suppresses the
+address at once; soft bounces (mailbox full, greylisting, policy blocks) only
+while SOFT_BOUNCE_LIMIT of them arrived within the last
+SOFT_BOUNCE_WINDOW_DAYS, so an address whose trouble has passed is tried
+again. Each DSN is recorded by its (Message-ID, recipient), so processing the
+same mailbox twice changes nothing.
+
+Campaigns look up only their own recipients (suppressed()), in batches, and
+the render processes skip those addresses.
+"""
+import sqlite3
+import threading
+import time
+
+DEFAULT_SUPPRESSION_DB = "suppressions.db"
+SOFT_BOUNCE_LIMIT = 3
+SOFT_BOUNCE_WINDOW_DAYS = 30
+
+# Soft bounces that still count, per suppressions row s; bound to the window's start
+_RECENT_SOFT = "(SELECT COUNT(*) FROM bounce_events e WHERE e.email = s.email AND e.kind = 'soft' AND e.arrived >= ?)"
+
+HARD = "hard"
+SOFT = "soft"
+
+
+def normalize_address(address):
+    return (address or "").strip().lower()
+
+
+class SuppressionStore:
+    def __init__(self, path=DEFAULT_SUPPRESSION_DB, soft_limit=SOFT_BOUNCE_LIMIT, soft_window_days=SOFT_BOUNCE_WINDOW_DAYS):
+        self.path = path
+        self.soft_limit = soft_limit
+        self.soft_window_days = soft_window_days
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS suppressions (
+                email       TEXT PRIMARY KEY,
+                hard_count  INTEGER NOT NULL DEFAULT 0,
+                soft_count  INTEGER NOT NULL DEFAULT 0,
+                status      TEXT,
+                diagnostic  TEXT,
+                first_seen  REAL,
+                last_seen   REAL
+            )""")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS bounce_events (
+                message_id  TEXT NOT NULL,
+                email       TEXT NOT NULL,
+                kind        TEXT NOT NULL,
+                status      TEXT,
+                arrived     REAL,
+                PRIMARY KEY (message_id, email)
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS bounce_events_email ON bounce_events (email, kind, arrived)")
+        self.conn.commit()
+
+    def record_bounces(self, bounces):
+        """Upserts a batch of Bounces in one transaction; returns how many were new."""
+        now = time.time()
+        added = 0
+        with self.lock, self.conn:
+            for bounce in bounces:
+                email = normalize_address(bounce.email)
+                inserted = self.conn.execute(
+                    "INSERT OR IGNORE INTO bounce_events VALUES (?, ?, ?, ?, ?)",
+                    (bounce.message_id, email, bounce.kind, bounce.status, bounce.arrived or now)).rowcount
+                if not inserted:
+                    continue # Already processed in an earlier run
+                added += 1
+                hard, soft = (1, 0) if bounce.kind == HARD else (0, 1)
+                self.conn.execute("""
+                    INSERT INTO suppressions VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (email) DO UPDATE SET
+                        hard_count = hard_count + excluded.hard_count,
+                        soft_count = soft_count + excluded.soft_count,
+                        -- Keep the details of the hard bounce once there is one
+                        status = CASE WHEN hard_count = 0 OR excluded.hard_count > 0 THEN excluded.status ELSE status END,
+                        diagnostic = CASE WHEN hard_count = 0 OR excluded.hard_count > 0 THEN excluded.diagnostic ELSE diagnostic END,
+                        last_seen = excluded.last_seen""",
+                    (email, hard, soft, bounce.status, bounce.diagnostic, now, now))
+        return added
+
+    def _window_start(self):
+        return time.time() - self.soft_window_days * 86400
+
+    def suppressed(self, emails):
+        """{address: reason} for the given addresses that are suppressed (addresses normalized)."""
+        emails = list({normalize_address(email) for email in emails if isinstance(email, str) and email.strip()})
+        found = {}
+        with self.lock:
+            for start in range(0, len(emails), 500): # Stay under SQLite's host parameter limit
+                batch = emails[start:start + 500]
+                for email, hard_count, soft_count, status, diagnostic in self.conn.execute(
+                        f"SELECT email, hard_count, recent_soft, status, diagnostic FROM ("
+                        f"SELECT s.*, {_RECENT_SOFT} AS recent_soft FROM suppressions s "
+                        f"WHERE s.email IN ({','.join('?' * len(batch))})) WHERE hard_count > 0 OR recent_soft >= ?",
+                        [self._window_start(), *batch, self.soft_limit]):
+                    kind = "hard bounce" if hard_count else f"{soft_count} soft bounces in {self.soft_window_days:g} days"
+                    found[email] = f"{kind} ({status}{': ' + diagnostic if diagnostic else ''})"
+        return found
+
+    def remove(self, emails):
+        """Takes addresses off the list (e.g. after the recipient fixed their mailbox)."""
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM suppressions WHERE email = ?", [(normalize_address(e),) for e in emails])
+
+    def summary(self):
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT SUM(hard_count > 0), SUM(hard_count = 0 AND recent_soft >= ?), "
+                f"SUM(hard_count = 0 AND recent_soft BETWEEN 1 AND ? - 1) FROM ("
+                f"SELECT s.hard_count, {_RECENT_SOFT} AS recent_soft FROM suppressions s)",
+                (self.soft_limit, self.soft_limit, self._window_start())).fetchone()
+        return {"hard": row[0] or 0, "soft_suppressed": row[1] or 0, "soft_watch": row[2] or 0}
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,118 @@
+"""Template syntaxes for the subject and body.
+
+"placeholders" is the original `{Column}` substitution. "jinja" is Jinja2 in
+a sandbox, for conditionals, loops, filters and defaults:
+
+    {% if Plan == "Pro" %}Thanks for going Pro, {{ Name | default("there") }}!{% endif %}
+    {% for item in Products | split(";") %}<li>{{ item }}</li>{% endfor %}
+    {{ row["First Name"] }}   (columns whose names aren't identifiers)
+
+Empty cells are left undefined, so `default` applies to them. The body is
+HTML-autoescaped (use `| safe` for trusted HTML in a column), the subject is
+not.
+
+Templates are loaded under a name derived from their hash, through a
+FileSystemBytecodeCache: the app compiles them once when it validates the
+campaign, and render processes (and campaign workers on the same host) load
+the compiled code from disk instead of compiling again.
+"""
+import hashlib
+import os
+
+import pandas as pd
+
+PLACEHOLDERS = "placeholders"
+JINJA = "jinja"
+TEMPLATE_SYNTAXES = (PLACEHOLDERS, JINJA)
+
+DEFAULT_BYTECODE_CACHE_DIR = ".template_cache"
+
+
+def split_list(value, separator=","):
+    """Jinja filter: a list column stored as delimited text ("a; b; c") -> list of items."""
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [item.strip() for item in str(value).split(separator) if item.strip()]
+
+
+def template_name(kind, source):
+    extension = "html" if kind == "body" else "txt" # Drives autoescaping
+    return f"{kind}-{hashlib.sha256(source.encode('utf-8')).hexdigest()[:32]}.{extension}"
+
+
+def jinja_environment(templates, cache_dir=DEFAULT_BYTECODE_CACHE_DIR):
+    from jinja2 import DictLoader, FileSystemBytecodeCache, select_autoescape
+    from jinja2.sandbox import SandboxedEnvironment
+
+    os.makedirs(cache_dir, exist_ok=True)
+    environment = SandboxedEnvironment(
+        loader=DictLoader(templates),
+        bytecode_cache=FileSystemBytecodeCache(cache_dir),
+        autoescape=select_autoescape(enabled_extensions=("html",), default_for_string=False, default=False),
+    )
+    environment.filters["split"] = split_list
+    return environment
+
+
+def referenced_names(template_ast, meta):
+    """Top-level names a template reads, plus the keys of `row["..."]` lookups; None if `row` is used otherwise."""
+    from jinja2 import nodes
+
+    names = set(meta.find_undeclared_variables(template_ast))
+    if "row" in names:
+        names.discard("row")
+        lookups = [node for node in template_ast.find_all(nodes.Getitem)
+                   if isinstance(node.node, nodes.Name) and node.node.name == "row" and isinstance(node.arg, nodes.Const)]
+        uses = [node for node in template_ast.find_all(nodes.Name) if node.name == "row"]
+        names.update(node.arg.value for node in lookups)
+        if len(lookups) != len(uses):
+            names.add(None)
+    return names
+
+
+class JinjaRenderer:
+    """Compiled subject and body templates of one campaign."""
+
+    def __init__(self, subject_template, body_template, columns, cache_dir=DEFAULT_BYTECODE_CACHE_DIR, text_template=None):
+        from jinja2 import meta
+
+        sources = {template_name("subject", subject_template): subject_template,
+                   template_name("body", body_template): body_template}
+        if text_template is not None:
+            sources[template_name("text", text_template)] = text_template
+        environment = jinja_environment(sources, cache_dir)
+        self.subject, self.body, *text = [environment.get_template(name) for name in sources]
+        self.text = text[0] if text else None
+
+        names = set()
+        for source in sources.values():
+            names |= referenced_names(environment.parse(source), meta)
+        columns = list(columns)
+        # None: `row` is used in a way that can reach any column
+        self.referenced = list(range(len(columns))) if None in names else [
+            i for i, col_name in enumerate(columns) if col_name in names]
+
+    def render(self, columns, values):
+        """(subject, body, text) - text is None without a plain-text template."""
+        context = {col_name: value for col_name, value in zip(columns, values) if pd.notna(value)}
+        context["row"] = dict(context)
+        text = self.text.render(context) if self.text is not None else None
+        return self.subject.render(context), self.body.render(context), text
+
+
+def check_templates(syntax, subject_template, body_template, columns, cache_dir=DEFAULT_BYTECODE_CACHE_DIR,
+                    text_template=None):
+    """Compiles the templates (warming the bytecode cache); returns an error message or None."""
+    if syntax != JINJA:
+        return None
+    try:
+        JinjaRenderer(subject_template, body_template, columns, cache_dir, text_template)
+    except ImportError:
+        return "The Jinja template syntax needs the jinja2 package."
+    except Exception as e_template:
+        where = (getattr(e_template, "name", None) or "").split("-")[0] # "subject" or "body"
+        line = getattr(e_template, "lineno", None)
+        return f"Template error{f' in {where}' if where else ''}{f' on line {line}' if line else ''}: {e_template}"
+    return None
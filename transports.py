@@ -0,0 +1,357 @@
+"""Delivery transports used by the send pipeline's delivery workers.
+
+Each delivery worker owns one transport instance (one SMTP connection, one
+SendGrid client, one local sendmail process) and hands it already-rendered
+payloads. transport_for() picks the class from the config.
+
+pooled_transport_factory() wraps them so the connections come from the
+server-wide pools in resource_pools.py instead: a delivery worker checks a
+connection out per message, so concurrent campaigns with the same login
+share (and fairly split) one set of connections.
+
+Deadlines: SMTP connects, command replies and message data each have a
+timeout (smtp_connect_timeout, smtp_command_timeout, smtp_data_timeout) and
+SendGrid requests have http_timeout. On top of those, the pipeline's watchdog
+calls abort() on a send that overruns its overall deadline (message_deadline)
+and, with hedge_after set, on a slow one that hasn't committed its data yet,
+so the message can be retried on another connection without being sent twice.
+(With PIPELINING and CHUNKING the whole message normally goes out in one
+write; with hedge_after set the final BDAT LAST waits for the envelope's
+replies instead, so stalls before it can be hedged, at one more round trip
+per message.)
+"""
+import os
+import shlex
+import smtplib
+import subprocess
+import time
+import uuid
+
+from encoding_policy import relay_capabilities
+from metrics import DELIVERY_RETRIES, RESPONSES
+from resource_pools import credential_fingerprint, get_pool, sendgrid_client
+from smtp_client import FastSMTP, FastSMTP_SSL, PipeSMTP, shared_tls_context
+
+DEFAULT_SENDMAIL_COMMAND = "/usr/sbin/sendmail"
+SENDMAIL_TIMEOUT = 60 # Seconds for one `sendmail -t` run
+DEFAULT_CONNECT_TIMEOUT = 30.0
+DEFAULT_COMMAND_TIMEOUT = 60.0
+DEFAULT_DATA_TIMEOUT = 120.0
+DEFAULT_HTTP_TIMEOUT = 30.0
+
+
+class DeliveryTimeout(Exception):
+    """A send broken off by the delivery watchdog. committed: the relay may have the message anyway."""
+
+    def __init__(self, detail, committed):
+        super().__init__(detail)
+        self.committed = committed
+
+
+def delivery_deadlines(config):
+    """SendPipeline keyword arguments for the watchdog settings in config (0 / missing = off)."""
+    return {"message_timeout": float(config.get('message_deadline') or 0) or None,
+            "hedge_after": float(config.get('hedge_after') or 0) or None}
+
+
+class SmtpTransport:
+    name = "SMTP"
+
+    def __init__(self, config):
+        self.config = config
+        self.server = None
+        self.aborted = False
+
+    def _set_timeouts(self, server):
+        server.command_timeout = float(self.config.get('smtp_command_timeout') or DEFAULT_COMMAND_TIMEOUT)
+        server.data_timeout = float(self.config.get('smtp_data_timeout') or DEFAULT_DATA_TIMEOUT)
+        # Hedging needs to know when a message can no longer be taken back
+        server.defer_commit = bool(float(self.config.get('hedge_after') or 0))
+        server._phase_timeout(server.command_timeout)
+
+    def open(self):
+        config = self.config
+        timeout = float(config.get('smtp_connect_timeout') or DEFAULT_CONNECT_TIMEOUT)
+        # One context for every connection, so the TLS session of one can be resumed by the next
+        context = shared_tls_context(config.get('smtp_ca_file') or None)
+        if config['smtp_security'] == "SSL":
+            server = FastSMTP_SSL(config['smtp_server'], config['smtp_port'], context=context, timeout=timeout)
+        else: # TLS or None
+            server = FastSMTP(config['smtp_server'], config['smtp_port'], timeout=timeout)
+            if config['smtp_security'] == "TLS":
+                server.starttls(context=context)
+        self._set_timeouts(server)
+        server.login(config['sender_email'], config['email_password'])
+        server.save_tls_session()
+        self.server = server
+
+    def configure(self, config):
+        """Takes on another campaign's settings for the same login (a pooled connection changing hands)."""
+        self.config = config
+        if self.server is not None:
+            self._set_timeouts(self.server)
+
+    def capabilities(self):
+        """The relay's EHLO keywords (after STARTTLS), lower-cased."""
+        return relay_capabilities(self.server.esmtp_features if self.server else ())
+
+    def send(self, message):
+        """Returns (accepted, detail)."""
+        # send_raw_message uses PIPELINING/CHUNKING when the relay offers them
+        self.aborted = False
+        try:
+            try:
+                self.server.send_raw_message(self.config['sender_email'], message.recipient, message.payload)
+            except (smtplib.SMTPServerDisconnected, OSError):
+                if self.aborted or self.committed():
+                    raise # Timed out or dropped after the data went out: the relay may have it, don't send it twice
+                # Relays drop idle or long-lived connections; reconnect once and retry
+                DELIVERY_RETRIES.labels(self.name).inc()
+                self.close()
+                self.open()
+                self.server.send_raw_message(self.config['sender_email'], message.recipient, message.payload)
+        except (smtplib.SMTPServerDisconnected, OSError) as e_disconnected:
+            if self.aborted:
+                raise DeliveryTimeout("Broken off by the delivery watchdog", self.committed()) from e_disconnected
+            raise
+        except smtplib.SMTPRecipientsRefused as e_refused:
+            for code, _ in e_refused.recipients.values():
+                RESPONSES.labels(self.name, code).inc()
+            raise
+        except smtplib.SMTPResponseException as e_response:
+            RESPONSES.labels(self.name, e_response.smtp_code).inc()
+            raise
+        RESPONSES.labels(self.name, 250).inc()
+        return True, "Successfully sent"
+
+    def committed(self):
+        """Whether the relay may already have the message of the send in progress."""
+        return bool(self.server is not None and self.server.data_committed)
+
+    def abort(self):
+        self.aborted = True
+        server = self.server
+        if server is not None:
+            server.abort()
+
+    def close(self):
+        if self.server:
+            try: self.server.quit()
+            except Exception: pass
+            self.server = None
+
+
+class SendGridTransport:
+    name = "SendGrid"
+
+    def __init__(self, config):
+        self.config = config
+        self.client = None
+
+    def open(self):
+        # Thread-safe; one per API key (and timeout) for the server
+        self.client = sendgrid_client(self.config['sendgrid_api_key'],
+                                      float(self.config.get('http_timeout') or DEFAULT_HTTP_TIMEOUT))
+
+    def configure(self, config):
+        self.config = config
+        if self.client is not None:
+            self.open() # The shared client for this config's timeout
+
+    def send(self, message):
+        # Same request SendGridAPIClient.send() makes, with the body already built by the render pool
+        try:
+            response = self.client.client.mail.send.post(request_body=message.payload)
+        except Exception as e_http:
+            # python_http_client raises for 4xx/5xx; the status is on the exception
+            RESPONSES.labels(self.name, getattr(e_http, "status_code", "error")).inc()
+            raise
+        RESPONSES.labels(self.name, response.status_code).inc()
+        if 200 <= response.status_code < 300: # Typically 202 Accepted
+            return True, f"accepted. Status: {response.status_code}"
+        return False, f"Status: {response.status_code}. Body: {response.body}"
+
+    def close(self):
+        self.client = None
+
+
+class SendmailTransport(SmtpTransport):
+    """Hands messages to the local MTA through its sendmail binary.
+
+    Mode "bs" (default) keeps one `sendmail -bs` process per delivery worker
+    and speaks SMTP to it over stdin/stdout, so a batch pays for one process
+    start, not one per message (Postfix, Exim and Sendmail all support -bs).
+    Mode "t" runs `sendmail -t -oi` per message, for sendmail-compatible
+    binaries without -bs (msmtp, ssmtp).
+    """
+    name = "Sendmail"
+
+    def command(self):
+        return shlex.split(self.config.get('sendmail_command') or DEFAULT_SENDMAIL_COMMAND)
+
+    def open(self):
+        if self.config.get('sendmail_mode', "bs") != "bs":
+            return
+        server = PipeSMTP(self.command() + ["-bs"], timeout=float(self.config.get('smtp_connect_timeout') or DEFAULT_CONNECT_TIMEOUT))
+        server.connect()
+        self._set_timeouts(server)
+        server.ehlo_or_helo_if_needed()
+        self.server = server
+
+    def send(self, message):
+        if self.server is not None:
+            return super().send(message) # Also restarts the process once if it exited
+        # sendmail -t reads the recipients from the headers and wants local (LF) line endings
+        completed = subprocess.run(self.command() + ["-t", "-oi", "-f", self.config['sender_email']],
+                                   input=message.payload.replace(b"\r\n", b"\n"), capture_output=True,
+                                   timeout=SENDMAIL_TIMEOUT)
+        RESPONSES.labels(self.name, f"exit {completed.returncode}").inc()
+        if completed.returncode != 0:
+            return False, f"sendmail exited with {completed.returncode}: {completed.stderr.decode(errors='replace').strip()}"
+        return True, "Handed to sendmail"
+
+
+class PickupDirectoryTransport:
+    """Writes each message as an .eml file into an MTA pickup directory.
+
+    Files are written under .tmp/ inside the directory and renamed into place,
+    so the MTA never picks up a partial message. X-Sender/X-Receiver envelope
+    headers (the IIS/Exchange pickup convention) are prepended unless
+    pickup_envelope_headers is off.
+    """
+    name = "Pickup"
+
+    def __init__(self, config):
+        self.config = config
+        self.directory = None
+        self.tmp_directory = None
+
+    def open(self):
+        self.directory = self.config['pickup_dir']
+        self.tmp_directory = os.path.join(self.directory, ".tmp") # Same filesystem, so the rename is atomic
+        os.makedirs(self.tmp_directory, exist_ok=True)
+
+    def send(self, message):
+        data = message.payload
+        if self.config.get('pickup_envelope_headers', True):
+            data = (f"X-Sender: {self.config['sender_email']}\r\nX-Receiver: {message.recipient}\r\n".encode()
+                    + data)
+        file_name = f"{time.time_ns()}-{uuid.uuid4().hex[:12]}.eml"
+        tmp_path = os.path.join(self.tmp_directory, file_name)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            if self.config.get('pickup_fsync'):
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.directory, file_name))
+        RESPONSES.labels(self.name, "written").inc()
+        return True, f"Written to pickup directory as {file_name}"
+
+    def close(self):
+        pass
+
+
+# Selectable with config['delivery_transport']; SendGrid is chosen by its tracking switch
+TRANSPORTS = {cls.name: cls for cls in (SmtpTransport, SendGridTransport, SendmailTransport, PickupDirectoryTransport)}
+
+
+def transport_for(config):
+    if config.get('enable_sendgrid_tracking') and config.get('sendgrid_api_key'):
+        return SendGridTransport
+    return TRANSPORTS.get(config.get('delivery_transport'), SmtpTransport)
+
+
+def _transport_fingerprint(transport_class, config):
+    # Everything that decides where a connection goes and who it's logged in as
+    if transport_class is SendGridTransport:
+        return credential_fingerprint(config.get('sendgrid_api_key'))
+    if transport_class is SendmailTransport:
+        return credential_fingerprint(config.get('sendmail_command') or DEFAULT_SENDMAIL_COMMAND)
+    return credential_fingerprint(config.get('smtp_server'), config.get('smtp_port'), config.get('smtp_security'),
+                                  config.get('smtp_ca_file'), config.get('sender_email'), config.get('email_password'))
+
+
+def _keeps_connection(error):
+    # The relay answered (refused a recipient, 4xx/5xx, HTTP error status): the connection itself is fine
+    return isinstance(error, (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused)) or hasattr(error, "status_code")
+
+
+class PooledTransport:
+    """A transport whose connection is checked out of a shared pool for each message.
+
+    The pool is shared by every campaign on the same login, so a checked-out
+    connection is configured with this campaign's settings (timeouts, hedging)
+    before it sends, whichever campaign opened it.
+    """
+
+    def __init__(self, pool, transport_class, owner, config):
+        self.pool = pool
+        self.name = transport_class.name
+        self.owner = owner
+        self.config = config
+        self.features = None
+        self.current = None # The connection checked out for the send in progress
+        self.send_started = None # time.monotonic() once it was checked out; the wait for a slot doesn't count
+        if hasattr(transport_class, "capabilities"):
+            self.capabilities = lambda: self.features or set()
+
+    def open(self):
+        # Checks one connection out and back in: surfaces login errors and warms the pool
+        with self.pool.resource(self.owner) as transport:
+            if hasattr(transport, "capabilities"):
+                self.features = transport.capabilities()
+
+    def send(self, message):
+        transport = self.current = self.pool.checkout(self.owner)
+        self.send_started = time.monotonic()
+        try:
+            configure = getattr(transport, "configure", None)
+            if configure is not None:
+                configure(self.config)
+            result = transport.send(message)
+        except Exception as e_send:
+            self.pool.checkin(transport, self.owner, broken=not _keeps_connection(e_send))
+            raise
+        except BaseException:
+            self.pool.checkin(transport, self.owner, broken=True)
+            raise
+        finally:
+            self.current = self.send_started = None
+        self.pool.checkin(transport, self.owner)
+        return result
+
+    def committed(self):
+        committed = getattr(self.current, "committed", None)
+        return True if committed is None else committed() # Unknown: assume the worst
+
+    def abort(self):
+        abort = getattr(self.current, "abort", None)
+        if abort is not None:
+            abort() # The aborted connection fails its send and is closed as broken on check-in
+
+    def close(self):
+        pass # The connections stay in the pool
+
+
+def _open_pooled(transport_class, config):
+    transport = transport_class(config)
+    transport.open()
+    return transport
+
+
+def pooled_transport_factory(config, owner, transport_class=None):
+    """A transport factory for SendPipeline that draws on the server-wide pool for this config.
+
+    owner (the campaign id) is what the pool's fair share is split between.
+    Pickup directories (no connection) and `sendmail -t` (one process per
+    message) aren't pooled.
+    """
+    transport_class = transport_class or transport_for(config)
+    if transport_class is PickupDirectoryTransport or (
+            transport_class is SendmailTransport and config.get('sendmail_mode', "bs") != "bs"):
+        return lambda: transport_class(config)
+    pool = get_pool(transport_class.name, _transport_fingerprint(transport_class, config),
+                    lambda: _open_pooled(transport_class, config), lambda transport: transport.close(),
+                    max_size=int(config.get('pool_max_connections') or 0) or None,
+                    idle_timeout=float(config.get('pool_idle_timeout') or 0) or None)
+    return lambda: PooledTransport(pool, transport_class, owner, config)
@@ -0,0 +1,310 @@
+"""Shared work queue for distributed campaign workers.
+
+A campaign is split into shards of recipient rows. Workers claim a shard with
+a time-limited lease, renew the lease while they deliver it and mark it done
+at the end. A shard whose lease runs out (its worker died or hung) becomes
+claimable again. Scheduled shards (scheduler.py) carry a not_before time and
+can't be claimed earlier, so workers are fed just in time.
+
+The send rate ceiling is global: every worker draws tokens from one bucket
+per campaign stored next to the shards.
+
+Backends are selected with open_queue():
+    sqlite:///path/to/campaigns.db   shared by all worker processes on one host
+    memory://                        in-process stand-in for tests
+"""
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+from ledger import DeliveryLedger, MemoryLedger
+
+Shard = namedtuple("Shard", "id campaign_id seq rows attempts")
+CampaignRecord = namedtuple("CampaignRecord", "id campaign config rate_limit")
+
+DEFAULT_LEASE_SECONDS = 60
+MAX_SHARD_ATTEMPTS = 5
+
+
+def new_campaign_id():
+    return time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+
+
+class SQLiteShardQueue:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # Autocommit mode; claims and token grabs use explicit BEGIN IMMEDIATE transactions
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS campaigns (
+                id TEXT PRIMARY KEY, campaign BLOB, config BLOB, rate_limit REAL, created REAL
+            );
+            CREATE TABLE IF NOT EXISTS shards (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                campaign_id TEXT NOT NULL, seq INTEGER, rows BLOB,
+                status TEXT NOT NULL DEFAULT 'pending',
+                worker_id TEXT, lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0,
+                not_before REAL
+            );
+            CREATE INDEX IF NOT EXISTS shards_claim ON shards (status, lease_expires);
+            CREATE TABLE IF NOT EXISTS rate_buckets (
+                campaign_id TEXT PRIMARY KEY, tokens REAL, updated REAL
+            );
+        """)
+        if "not_before" not in {row[1] for row in self.conn.execute("PRAGMA table_info(shards)")}:
+            self.conn.execute("ALTER TABLE shards ADD COLUMN not_before REAL") # Queue created before scheduling
+        self.ledger = DeliveryLedger(path)
+
+    def _transaction(self, fn):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self.conn)
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+            return result
+
+    def add_campaign(self, campaign_id, campaign, config, rate_limit, shards):
+        self.add_scheduled_campaign(campaign_id, campaign, config, rate_limit, ((None, rows) for rows in shards))
+
+    def add_scheduled_campaign(self, campaign_id, campaign, config, rate_limit, scheduled_shards):
+        """Like add_campaign, with (not_before epoch time or None, rows) pairs."""
+        def add(conn):
+            conn.execute("INSERT INTO campaigns VALUES (?, ?, ?, ?, ?)",
+                         (campaign_id, pickle.dumps(campaign), pickle.dumps(config), rate_limit, time.time()))
+            conn.executemany("INSERT INTO shards (campaign_id, seq, rows, not_before) VALUES (?, ?, ?, ?)",
+                             ((campaign_id, seq, pickle.dumps(rows), not_before)
+                              for seq, (not_before, rows) in enumerate(scheduled_shards)))
+        self._transaction(add)
+
+    def get_campaign(self, campaign_id):
+        with self.lock:
+            row = self.conn.execute("SELECT id, campaign, config, rate_limit FROM campaigns WHERE id = ?",
+                                    (campaign_id,)).fetchone()
+        if row is None:
+            return None
+        return CampaignRecord(row[0], pickle.loads(row[1]), pickle.loads(row[2]), row[3])
+
+    def claim(self, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        def claim(conn):
+            now = time.time()
+            row = conn.execute(
+                "SELECT id, campaign_id, seq, rows, attempts FROM shards "
+                "WHERE (status = 'pending' AND (not_before IS NULL OR not_before <= ?)) "
+                "OR (status = 'leased' AND lease_expires < ?) "
+                "ORDER BY COALESCE(not_before, 0), id LIMIT 1", (now, now)).fetchone()
+            if row is None:
+                return None
+            if row[4] >= MAX_SHARD_ATTEMPTS:
+                # Keeps killing its workers; park it instead of handing it out forever
+                conn.execute("UPDATE shards SET status = 'dead', worker_id = NULL WHERE id = ?", (row[0],))
+                return claim(conn)
+            conn.execute("UPDATE shards SET status = 'leased', worker_id = ?, lease_expires = ?, "
+                         "attempts = attempts + 1 WHERE id = ?", (worker_id, now + lease_seconds, row[0]))
+            return Shard(row[0], row[1], row[2], pickle.loads(row[3]), row[4] + 1)
+        return self._transaction(claim)
+
+    def renew(self, shard_id, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """Extends the lease. Returns False if the shard was reclaimed by someone else."""
+        def renew(conn):
+            return conn.execute("UPDATE shards SET lease_expires = ? WHERE id = ? AND worker_id = ? AND status = 'leased'",
+                                (time.time() + lease_seconds, shard_id, worker_id)).rowcount == 1
+        return self._transaction(renew)
+
+    def complete(self, shard_id, worker_id):
+        def complete(conn):
+            return conn.execute("UPDATE shards SET status = 'done', lease_expires = NULL "
+                                "WHERE id = ? AND worker_id = ? AND status = 'leased'",
+                                (shard_id, worker_id)).rowcount == 1
+        return self._transaction(complete)
+
+    def release(self, shard_id, worker_id, retry_after=None):
+        """Hands a leased shard back; with retry_after (seconds) nobody can claim it again before then."""
+        def release(conn):
+            not_before = None if retry_after is None else time.time() + retry_after
+            conn.execute("UPDATE shards SET status = 'pending', worker_id = NULL, lease_expires = NULL, "
+                         "not_before = CASE WHEN ? IS NULL THEN not_before ELSE MAX(COALESCE(not_before, 0), ?) END "
+                         "WHERE id = ? AND worker_id = ? AND status = 'leased'", (not_before, not_before, shard_id, worker_id))
+        self._transaction(release)
+
+    def take_tokens(self, campaign_id, wanted, rate, burst):
+        """Takes up to `wanted` send tokens from the campaign's global bucket; returns how many were granted."""
+        def take(conn):
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated FROM rate_buckets WHERE campaign_id = ?", (campaign_id,)).fetchone()
+            tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+            granted = min(wanted, int(tokens))
+            conn.execute("INSERT OR REPLACE INTO rate_buckets VALUES (?, ?, ?)", (campaign_id, tokens - granted, now))
+            return granted
+        return self._transaction(take)
+
+    def progress(self, campaign_id):
+        """Shard counts by status; pending shards that aren't due yet count as 'scheduled'."""
+        with self.lock:
+            return dict(self.conn.execute(
+                "SELECT CASE WHEN status = 'pending' AND not_before > ? THEN 'scheduled' ELSE status END, COUNT(*) "
+                "FROM shards WHERE campaign_id = ? GROUP BY 1", (time.time(), campaign_id)))
+
+    def next_due(self, campaign_id):
+        """When the campaign's next scheduled shard becomes claimable (None if none is waiting)."""
+        with self.lock:
+            return self.conn.execute("SELECT MIN(not_before) FROM shards WHERE campaign_id = ? AND status = 'pending' "
+                                     "AND not_before > ?", (campaign_id, time.time())).fetchone()[0]
+
+    def cancel(self, campaign_id):
+        """Cancels the shards no worker has claimed yet; returns how many."""
+        def cancel(conn):
+            return conn.execute("UPDATE shards SET status = 'cancelled' WHERE campaign_id = ? AND status = 'pending'",
+                                (campaign_id,)).rowcount
+        return self._transaction(cancel)
+
+    def close(self):
+        self.ledger.close()
+        self.conn.close()
+
+
+class MemoryShardQueue:
+    """Single-process stand-in for SQLiteShardQueue with the same interface."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.campaigns = {}
+        self.shards = {}     # id -> dict
+        self.buckets = {}
+        self.next_id = 1
+        self.ledger = MemoryLedger()
+
+    def add_campaign(self, campaign_id, campaign, config, rate_limit, shards):
+        self.add_scheduled_campaign(campaign_id, campaign, config, rate_limit, ((None, rows) for rows in shards))
+
+    def add_scheduled_campaign(self, campaign_id, campaign, config, rate_limit, scheduled_shards):
+        with self.lock:
+            self.campaigns[campaign_id] = CampaignRecord(campaign_id, campaign, config, rate_limit)
+            for seq, (not_before, rows) in enumerate(scheduled_shards):
+                self.shards[self.next_id] = {"campaign_id": campaign_id, "seq": seq, "rows": list(rows),
+                                             "status": "pending", "worker_id": None, "lease_expires": None, "attempts": 0,
+                                             "not_before": not_before}
+                self.next_id += 1
+
+    def get_campaign(self, campaign_id):
+        return self.campaigns.get(campaign_id)
+
+    def claim(self, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        with self.lock:
+            now = time.time()
+            for shard_id, shard in sorted(self.shards.items(), key=lambda item: (item[1]["not_before"] or 0, item[0])):
+                if ((shard["status"] == "pending" and (shard["not_before"] or 0) <= now)
+                        or (shard["status"] == "leased" and shard["lease_expires"] < now)):
+                    if shard["attempts"] >= MAX_SHARD_ATTEMPTS:
+                        shard.update(status="dead", worker_id=None)
+                        continue
+                    shard.update(status="leased", worker_id=worker_id, lease_expires=now + lease_seconds,
+                                 attempts=shard["attempts"] + 1)
+                    return Shard(shard_id, shard["campaign_id"], shard["seq"], shard["rows"], shard["attempts"])
+        return None
+
+    def _owned(self, shard_id, worker_id):
+        shard = self.shards.get(shard_id)
+        return shard if shard and shard["worker_id"] == worker_id and shard["status"] == "leased" else None
+
+    def renew(self, shard_id, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        with self.lock:
+            shard = self._owned(shard_id, worker_id)
+            if shard:
+                shard["lease_expires"] = time.time() + lease_seconds
+            return shard is not None
+
+    def complete(self, shard_id, worker_id):
+        with self.lock:
+            shard = self._owned(shard_id, worker_id)
+            if shard:
+                shard.update(status="done", lease_expires=None)
+            return shard is not None
+
+    def release(self, shard_id, worker_id, retry_after=None):
+        with self.lock:
+            shard = self._owned(shard_id, worker_id)
+            if shard:
+                shard.update(status="pending", worker_id=None, lease_expires=None)
+                if retry_after is not None:
+                    shard["not_before"] = max(shard["not_before"] or 0, time.time() + retry_after)
+
+    def take_tokens(self, campaign_id, wanted, rate, burst):
+        with self.lock:
+            now = time.time()
+            tokens, updated = self.buckets.get(campaign_id, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            granted = min(wanted, int(tokens))
+            self.buckets[campaign_id] = (tokens - granted, now)
+            return granted
+
+    def progress(self, campaign_id):
+        counts = {}
+        now = time.time()
+        with self.lock:
+            for shard in self.shards.values():
+                if shard["campaign_id"] == campaign_id:
+                    status = "scheduled" if shard["status"] == "pending" and (shard["not_before"] or 0) > now else shard["status"]
+                    counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    def next_due(self, campaign_id):
+        now = time.time()
+        with self.lock:
+            due = [shard["not_before"] for shard in self.shards.values() if shard["campaign_id"] == campaign_id
+                   and shard["status"] == "pending" and (shard["not_before"] or 0) > now]
+        return min(due) if due else None
+
+    def cancel(self, campaign_id):
+        with self.lock:
+            pending = [shard for shard in self.shards.values()
+                       if shard["campaign_id"] == campaign_id and shard["status"] == "pending"]
+            for shard in pending:
+                shard["status"] = "cancelled"
+        return len(pending)
+
+    def close(self):
+        pass
+
+
+def open_queue(url):
+    if url.startswith("sqlite:///"):
+        return SQLiteShardQueue(url[len("sqlite:///"):])
+    if url == "memory://":
+        return MemoryShardQueue()
+    raise ValueError(f"Unsupported work queue URL: {url!r} (use sqlite:///path or memory://)")
+
+
+class SharedRateLimiter:
+    """RateLimiter-compatible limiter drawing from the campaign's global bucket in the queue.
+
+    Tokens are fetched a few at a time so workers don't hit the shared store once per message.
+    """
+
+    def __init__(self, work_queue, campaign_id, rate, batch=5):
+        self.work_queue = work_queue
+        self.campaign_id = campaign_id
+        self.rate = rate
+        self.batch = max(1, min(batch, int(rate) or 1)) if rate else batch
+        self.burst = max(float(self.batch), rate or 0)
+        self.local_tokens = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                if self.local_tokens == 0:
+                    self.local_tokens = self.work_queue.take_tokens(self.campaign_id, self.batch, self.rate, self.burst)
+                if self.local_tokens > 0:
+                    self.local_tokens -= 1
+                    return
+            time.sleep(self.batch / self.rate)